@@ -1,42 +1,36 @@
 from __future__ import annotations
 
+import asyncio
 import json
-from typing import Dict, Any, List, Optional
+import logging
+import random
+import time
+from typing import Dict, Any, Iterable, List, Optional
 from uuid import uuid4
-from openai import OpenAI
-from pydantic import BaseModel, Field, ValidationError
+from openai import AsyncOpenAI, OpenAIError
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from pymongo import ReturnDocument
 
 from ..config import get_settings
 from ..db import users_col, utcnow
+from ..metrics import observe_llm_call, observe_llm_parse, observe_llm_retry
+from ..quest_events import quest_events
+from .circuit_breaker import model_breaker
+from .fallback_quests import fallback_templates
+from .prompts import build_request
+from .quest_cache import quest_cache
 
 settings = get_settings()
-client = OpenAI(api_key=settings.API_TOKEN)
-
-SYSTEM_INSTRUCTIONS = """
-You are a game designer for a fitness RPG.
-Generate simple daily quests for users.
-Return ONLY valid JSON with no extra commentary.
-Return a JSON array with exactly ONE object, using this schema:
-
-[
-  {
-    "title": "string, concise user-facing quest name",
-    "type": "counter",
-    "target": number (positive integer),
-    "rewards": { "xp": number (int), "coins": number (int) }
-  }
-]
-Consider equipment and experience. If equipment is "none", use bodyweight or walking tasks.
-Consider preferred_days_per_week for realistic volume.
-Align with primary_goal.
-Use "type": "counter".
-Target must be a positive integer.
-rewards.xp and rewards.coins must be non-negative integers.
-Return ONLY the JSON array.
-"""
-
-def _build_user_prompt(onboarding: Dict[str, Any]) -> str:
-    return json.dumps(onboarding or {}, ensure_ascii=False, separators=(",", ":"))
+log = logging.getLogger(__name__)
+client = AsyncOpenAI(api_key=settings.API_TOKEN, timeout=settings.QUEST_GEN_TIMEOUT_SEC, max_retries=0)
+
+ACTIVE_QUEST_TARGET = 3
+
+# Caps in-flight model calls for the whole process, across users and pool refills.
+_model_slots = asyncio.Semaphore(max(1, settings.QUEST_GEN_CONCURRENCY))
+
+class ModelUnavailable(Exception):
+    """The circuit breaker is open; no call was made."""
 
 class QuestRewards(BaseModel):
     xp: int = Field(ge=0)
@@ -48,85 +42,280 @@ class RawQuest(BaseModel):
     target: int
     rewards: QuestRewards
 
-def _ask_model_for_quest(client: OpenAI, onboarding: Dict[str, Any], model: str = "gpt-4o-mini") -> list[dict[str, Any]]:
-    user_prompt = _build_user_prompt(onboarding)
+_quest_list = TypeAdapter(List[RawQuest])
 
-    completion = client.responses.create(
-        model=model,
-        instructions=SYSTEM_INSTRUCTIONS,
-        input="\nUser data:\n" + user_prompt,
-    )
+_json_decoder = json.JSONDecoder()
 
-    msg = completion.output_text
-    text = msg if isinstance(msg, str) else str(msg or "")
+def _as_quest_list(value: Any) -> Optional[list]:
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict) and isinstance(value.get("quests"), list):
+        return value["quests"]
+    return None
 
+def extract_quest_list(text: str) -> tuple[list, bool]:
+    """The quest array in a model reply, and whether it had to be dug out.
+
+    Accepts a bare array or the structured-output object `{"quests": [...]}`.
+    Failing that, code fences and surrounding prose are skipped and the first
+    JSON array of objects (or quests object) in the text is used.
+    """
+    stripped = text.strip()
     try:
-        data = json.loads(text)
-    except Exception as e:
-        raise ValueError(f"Invalid JSON from model: {e}")
+        found = _as_quest_list(json.loads(stripped))
+    except ValueError:
+        found = None
+    if found is not None:
+        return found, False
 
-    if not isinstance(data, list):
-        raise ValueError("Top-level response must be a JSON array")
+    for i, ch in enumerate(stripped):
+        if ch not in "[{":
+            continue
+        try:
+            value, _ = _json_decoder.raw_decode(stripped, i)
+        except ValueError:
+            continue
+        found = _as_quest_list(value)
+        # Skip incidental arrays in the prose (e.g. "[1, 2]"); quests are objects.
+        if found and any(isinstance(item, dict) for item in found):
+            return found, True
+    raise ValueError("No JSON quest array in model response")
 
-    return data
+async def _ask_model_for_quest(
+    client: AsyncOpenAI, onboarding: Dict[str, Any], count: int = 1, timeout: Optional[float] = None,
+) -> list[dict[str, Any]]:
+    request = build_request(onboarding, count)
+    model = request["model"]
+    timeout = settings.QUEST_GEN_TIMEOUT_SEC if timeout is None else timeout
 
+    if not await model_breaker.allow():
+        raise ModelUnavailable("model circuit breaker is open")
+    try:
+        async with _model_slots:
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                completion = await asyncio.wait_for(client.responses.create(**request), timeout=timeout)
+                outcome = "ok"
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+                raise
+            except asyncio.CancelledError:
+                # The caller went away; says nothing about the provider's health.
+                outcome = "cancelled"
+                raise
+            finally:
+                seconds = time.perf_counter() - started
+                usage = getattr(completion, "usage", None) if outcome == "ok" else None
+                observe_llm_call(model, seconds, outcome, usage)
+                if outcome != "cancelled":
+                    await model_breaker.record(seconds, failed=outcome != "ok")
+    finally:
+        model_breaker.release_probe()
+    if usage is not None:
+        log.debug(
+            "quest generation: model=%s quests=%d input_tokens=%s cached=%s output_tokens=%s %.2fs",
+            model, count, usage.input_tokens, getattr(usage.input_tokens_details, "cached_tokens", None),
+            usage.output_tokens, seconds,
+        )
+
+    msg = completion.output_text
+    text = msg if isinstance(msg, str) else str(msg or "")
+
+    try:
+        data, extracted = extract_quest_list(text)
+    except ValueError:
+        observe_llm_parse("invalid")
+        raise
+    if extracted:
+        observe_llm_parse("extracted")
+    return data
 
 
-def _validate_and_normalize(quest_list: List[Dict[str, Any]]) -> RawQuest:
-    if not quest_list:
-        raise ValueError("Empty quest list.")
-    candidate = quest_list[0]
+def _validate_and_normalize(quest_list: List[Dict[str, Any]]) -> List[RawQuest]:
+    """Validate the whole list at once, keeping the valid items."""
     try:
-        return RawQuest.model_validate(candidate)
-    except ValidationError as ve:
-        raise ValueError(f"Invalid quest shape: {ve}")
+        valid = _quest_list.validate_python(quest_list)
+        observe_llm_parse("valid")
+        return valid
+    except ValidationError as e:
+        bad = {err["loc"][0] for err in e.errors() if err["loc"]}
+    # Second pass without the items that failed; anything left is valid.
+    valid = _quest_list.validate_python([q for i, q in enumerate(quest_list) if i not in bad])
+    observe_llm_parse("salvaged" if valid else "invalid")
+    return valid
+
+def new_active_quest(template: Dict[str, Any], now=None) -> Dict[str, Any]:
+    now = now or utcnow()
+    rewards = template.get("rewards") or {}
+    return {
+        "quest_id": str(uuid4()),
+        "title": template["title"],
+        "type": template["type"],
+        "target": int(template["target"]),
+        "progress": 0,
+        "rewards": {"xp": int(rewards.get("xp", 0)), "coins": int(rewards.get("coins", 0))},
+        "created_at": now,
+        "started_at": now,
+        # "model", "fallback" or "pool"; only "pool" quests may go back to the pool.
+        "source": template.get("source", "model"),
+    }
 
-def generate_personal_quest(user: Dict[str, Any]) -> Dict[str, Any]:
-    attempts = 3
+def _backoff_sec(attempt: int) -> float:
+    """Full-jitter exponential backoff before retry number `attempt` (1-based)."""
+    cap = min(settings.QUEST_GEN_BACKOFF_MAX_SEC, settings.QUEST_GEN_BACKOFF_BASE_SEC * 2 ** (attempt - 1))
+    return random.uniform(0, cap)
+
+async def _generate_batch(onboarding: Dict[str, Any], size: int) -> List[Dict[str, Any]]:
+    # One model call asks for the whole batch; retries only ask for what is still missing.
+    attempts = max(1, settings.QUEST_GEN_ATTEMPTS)
+    deadline = time.monotonic() + settings.QUEST_GEN_DEADLINE_SEC
     last_err: Optional[Exception] = None
-    onboarding = user.get("onboarding") or {}
+    templates: List[Dict[str, Any]] = []
+    retry_reason = "error"
 
-    for _ in range(attempts):
+    for attempt in range(attempts):
+        missing = size - len(templates)
+        if missing <= 0:
+            break
+        if attempt:
+            if retry_reason == "error":
+                await asyncio.sleep(min(_backoff_sec(attempt), max(0.0, deadline - time.monotonic())))
+            observe_llm_retry(retry_reason)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            last_err = last_err or asyncio.TimeoutError("quest generation deadline passed")
+            break
         try:
-            quest = _ask_model_for_quest(client, onboarding)
-            valid = _validate_and_normalize(quest)
-            now = utcnow()
-            return {
-                "quest_id": str(uuid4()),
-                "title": valid.title,
-                "type": valid.type,
-                "target": int(valid.target),
-                "progress": 0,
-                "rewards": {"xp": int(valid.rewards.xp), "coins": int(valid.rewards.coins)},
-                "created_at": now,
-                "started_at": now,
-            }
-        except Exception as e:
+            quests = await _ask_model_for_quest(
+                client, onboarding, missing, timeout=min(settings.QUEST_GEN_TIMEOUT_SEC, remaining)
+            )
+            valid = _validate_and_normalize(quests)
+            if not valid:
+                raise ValueError("No valid quests in model response")
+            templates.extend(q.model_dump() for q in valid[:missing])
+            retry_reason = "short_batch"
+        except ModelUnavailable as e:
             last_err = e
-            continue
+            break
+        except ValueError as e:
+            last_err = e
+            retry_reason = "invalid_output"
+        except (OpenAIError, asyncio.TimeoutError) as e:
+            last_err = e
+            retry_reason = "error"
+
+    if len(templates) < size:
+        log.warning("generated %d/%d quests: %s", len(templates), size, last_err)
+    return templates
+
+async def _generate_uncached(onboarding: Dict[str, Any], n: int) -> List[Dict[str, Any]]:
+    if n <= 0:
+        return []
+    batch_size = max(1, settings.QUEST_GEN_BATCH_SIZE)
+    sizes = [min(batch_size, n - i) for i in range(0, n, batch_size)]
+    batches = await asyncio.gather(*(_generate_batch(onboarding, size) for size in sizes))
+    return [template for batch in batches for template in batch]
+
+async def generate_quest_templates(
+    onboarding: Dict[str, Any],
+    n: int,
+    use_cache: bool = True,
+    fallback: bool = True,
+    exclude_titles: Iterable[str] = (),
+) -> List[Dict[str, Any]]:
+    """Generate up to `n` validated quest templates.
+
+    With `fallback`, whatever the model could not supply (breaker open, errors,
+    short batches) is made up from the deterministic fallback generator, which
+    skips `exclude_titles` and the titles already generated. The result then
+    has `n` templates unless the fallback catalogue runs out. Without
+    `fallback` it may be shorter.
+    """
+    if n <= 0:
+        return []
+    templates = await _generate_from_model(onboarding, n, use_cache)
+    if fallback and len(templates) < n:
+        taken = set(exclude_titles) | {t["title"] for t in templates}
+        templates += fallback_templates(onboarding, n - len(templates), taken)
+    return templates
+
+async def _generate_from_model(onboarding: Dict[str, Any], n: int, use_cache: bool) -> List[Dict[str, Any]]:
+    if not use_cache or not quest_cache.enabled:
+        return await _generate_uncached(onboarding, n)
+
+    cached = await quest_cache.pick(onboarding, n)
+    if len(cached) >= n:
+        return cached
 
-    raise RuntimeError(f"Failed to generate a valid quest after {attempts} attempts: {last_err}")
+    # On a miss, fill a whole batch so the key warms up faster.
+    fresh = await _generate_uncached(onboarding, max(n, settings.QUEST_GEN_BATCH_SIZE))
+    await quest_cache.add(onboarding, fresh)
+    return (cached + fresh)[:n]
 
+async def generate_personal_quest(user: Dict[str, Any]) -> Dict[str, Any]:
+    templates = await generate_quest_templates(user.get("onboarding") or {}, 1)
+    if not templates:
+        raise RuntimeError("Failed to generate a valid quest")
+    return new_active_quest(templates[0])
+
+
+async def push_active_quests(user_id, quests: List[Dict[str, Any]], target: int = ACTIVE_QUEST_TARGET, now=None) -> int:
+    """Append quests to the active list without ever exceeding `target`.
+
+    Returns how many were actually added (0 if the user was already full).
+    The added quests are published to the user's quest stream.
+    """
+    if not quests:
+        return 0
+    now = now or utcnow()
+    active = {"$ifNull": ["$quests.active", []]}
+    before = await users_col().find_one_and_update(
+        {"_id": user_id, "$expr": {"$lt": [{"$size": active}, target]}},
+        [{"$set": {
+            "quests.active": {"$slice": [{"$concatArrays": [active, {"$literal": quests}]}, target]},
+            "updated_at": now,
+        }}],
+        projection={"quests.active.quest_id": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if not before:
+        return 0
+    had = len((before.get("quests") or {}).get("active") or [])
+    added = min(target, had + len(quests)) - had
+    quest_events.publish_quests(user_id, quests[:added])
+    return added
+
+
+async def fill_missing_active_quests(user_id, target: int = ACTIVE_QUEST_TARGET) -> int:
+    from .quest_pool import take_quests, return_quests
 
-def fill_missing_active_quests(user_id, count_to_add=1):
     col = users_col()
-    doc = col.find_one({"_id": user_id}, {"quests.active": 1, "onboarding": 1, "progress": 1})
+    doc = await col.find_one(
+        {"_id": user_id},
+        {"quests.active.quest_id": 1, "quests.active.title": 1, "quests.recent.title": 1, "onboarding": 1},
+    )
     if not doc:
-        return
+        return 0
 
-    n = int(count_to_add) if count_to_add else 0
+    quests = doc.get("quests") or {}
+    n = target - len(quests.get("active") or [])
     if n <= 0:
-        return
+        return 0
 
     now = utcnow()
-    new_quests: List[Dict[str, Any]] = []
-    for _ in range(n):
-        q = generate_personal_quest(doc)
-        if not q.get("started_at"):
-            q["started_at"] = now
-        new_quests.append(q)
-
-    col.update_one(
-        {"_id": user_id},
-        {"$push": {"quests.active": {"$each": new_quests}}, "$set": {"updated_at": now}},
-    )
\ No newline at end of file
+    onboarding = doc.get("onboarding") or {}
+    # Pooled quests go in (and out to the quest stream) before waiting on the model.
+    pooled: List[Dict[str, Any]] = await take_quests(onboarding, n, now)
+    added = await push_active_quests(user_id, pooled, target, now)
+    await return_quests(onboarding, pooled[added:])
+    if added < len(pooled) or len(pooled) >= n:
+        return added
+
+    # Keeps fallback quests (the same catalogue all day) from repeating what the user has or just did.
+    seen = {q.get("title") for q in (quests.get("active") or []) + (quests.get("recent") or []) + pooled}
+    templates = await generate_quest_templates(onboarding, n - len(pooled), exclude_titles=seen)
+    generated = [new_active_quest(t, now) for t in templates]
+    # Leftovers are not pooled: they were made for this user's full profile or by the fallback generator.
+    pushed = await push_active_quests(user_id, generated, target, now)
+    return added + pushed
@@ -0,0 +1,143 @@
+"""Circuit breaker for the model provider, shared across workers.
+
+Each process records the outcome and latency of every model call over the
+last LLM_BREAKER_WINDOW_SEC. Once at least LLM_BREAKER_MIN_CALLS have been
+seen, the breaker trips when the failure rate reaches LLM_BREAKER_ERROR_RATE
+or the share of calls slower than LLM_BREAKER_SLOW_CALL_SEC reaches
+LLM_BREAKER_SLOW_RATE. A trip is written to the `circuit_breakers` collection
+as an `open_until` time, and every process reads that document at most every
+LLM_BREAKER_SYNC_SEC, so one worker seeing an incident opens the breaker for
+all of them.
+
+While open, `allow()` returns False and callers use the fallback generator.
+After `open_until`, each process lets one probe call through at a time
+(half-open). A successful probe closes the breaker everywhere; a failed one
+re-opens it.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from ..config import get_settings
+from ..db import circuit_breakers_col, utcnow
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()  # (monotonic, failed, slow)
+        self._open_until = None  # aware datetime, from this process or the shared doc
+        self._synced_at = float("-inf")
+        self._probe_task: Optional[asyncio.Task] = None  # the call holding the half-open slot
+        self.trips = 0
+        self.short_circuited = 0
+
+    def _prune(self, now: float) -> None:
+        horizon = now - settings.LLM_BREAKER_WINDOW_SEC
+        while self._calls and self._calls[0][0] < horizon:
+            self._calls.popleft()
+
+    async def _sync(self) -> None:
+        if time.monotonic() - self._synced_at < settings.LLM_BREAKER_SYNC_SEC:
+            return
+        self._synced_at = time.monotonic()
+        try:
+            doc = await circuit_breakers_col().find_one({"_id": self.name}, {"open_until": 1})
+        except Exception:
+            log.warning("circuit breaker sync failed; using local state", exc_info=True)
+            return
+        self._open_until = (doc or {}).get("open_until")
+
+    def state(self) -> str:
+        if self._open_until is None or utcnow() >= self._open_until:
+            return "half_open" if self._open_until is not None else "closed"
+        return "open"
+
+    async def allow(self) -> bool:
+        """Whether a model call may go out now."""
+        if not settings.LLM_BREAKER_ENABLED:
+            return True
+        await self._sync()
+        state = self.state()
+        if state == "closed":
+            return True
+        if state == "half_open" and self._probe_task is None:
+            self._probe_task = asyncio.current_task()
+            return True
+        self.short_circuited += 1
+        return False
+
+    async def record(self, seconds: float, failed: bool) -> None:
+        if not settings.LLM_BREAKER_ENABLED:
+            return
+        if self._probe_task is not None and self._probe_task is asyncio.current_task():
+            self._probe_task = None
+            if failed:
+                await self._trip("probe failed")
+            else:
+                await self._close()
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, failed, seconds >= settings.LLM_BREAKER_SLOW_CALL_SEC))
+        self._prune(now)
+        total = len(self._calls)
+        if total < settings.LLM_BREAKER_MIN_CALLS or self.state() == "open":
+            return
+        failures = sum(1 for _, f, _ in self._calls if f)
+        slow = sum(1 for _, _, s in self._calls if s)
+        if failures / total >= settings.LLM_BREAKER_ERROR_RATE:
+            await self._trip(f"{failures}/{total} calls failed")
+        elif slow / total >= settings.LLM_BREAKER_SLOW_RATE:
+            await self._trip(f"{slow}/{total} calls slower than {settings.LLM_BREAKER_SLOW_CALL_SEC}s")
+
+    def release_probe(self) -> None:
+        """Free the half-open slot if this task holds it and never recorded an outcome.
+
+        Call in a `finally` around the model call: a probe cancelled while
+        waiting for a slot or the response would otherwise keep the breaker
+        half-open and rejecting in this process for good.
+        """
+        if self._probe_task is not None and self._probe_task is asyncio.current_task():
+            self._probe_task = None
+
+    async def _trip(self, reason: str) -> None:
+        now = utcnow()
+        self._open_until = now + timedelta(seconds=settings.LLM_BREAKER_OPEN_SEC)
+        self._calls.clear()
+        self.trips += 1
+        log.warning("circuit breaker %s opened for %ss: %s", self.name, settings.LLM_BREAKER_OPEN_SEC, reason)
+        try:
+            await circuit_breakers_col().update_one(
+                {"_id": self.name},
+                {"$max": {"open_until": self._open_until}, "$set": {"reason": reason, "tripped_at": now}},
+                upsert=True,
+            )
+        except Exception:
+            log.warning("could not share circuit breaker trip", exc_info=True)
+
+    async def _close(self) -> None:
+        opened_until, self._open_until = self._open_until, None
+        log.info("circuit breaker %s closed after a successful probe", self.name)
+        try:
+            # Leave a newer trip from another worker in place.
+            await circuit_breakers_col().delete_one({"_id": self.name, "open_until": {"$lte": opened_until or utcnow()}})
+        except Exception:
+            log.warning("could not share circuit breaker close", exc_info=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "open": self.state() == "open",
+            "window_calls": len(self._calls),
+            "trips": self.trips,
+            "short_circuited": self.short_circuited,
+        }
+
+
+model_breaker = CircuitBreaker("openai")
@@ -0,0 +1,108 @@
+"""Deterministic quest templates for when the model is unavailable.
+
+Used while the circuit breaker is open and to top up a batch the model
+could not fill. Templates are picked from a fixed catalogue by goal category
+and available equipment. Targets scale with experience, training days and
+age, and rewards scale with experience. The same onboarding on the same UTC
+day always starts from the same place in the catalogue; titles the caller
+passes in `exclude_titles` (the user's active and recent quests) are skipped
+so a refill does not repeat them.
+"""
+import hashlib
+import json
+from typing import Any, Dict, Iterable, List, Mapping, Tuple
+
+from ..db import utcnow
+from .goals import goal_category
+
+EQUIPMENT_LEVEL = {"none": 0, "limited": 1, "full_gym": 2}
+EXPERIENCE_SCALE = {"beginner": 1.0, "intermediate": 1.5, "advanced": 2.0}
+BASE_XP = 100
+BASE_COINS = 10
+
+# category -> (title with {n}, beginner target, minimum equipment level)
+CATALOGUE: Dict[str, List[Tuple[str, int, int]]] = {
+    "weight_loss": [
+        ("Walk {n} steps", 6000, 0),
+        ("Do {n} jumping jacks", 50, 0),
+        ("Climb {n} flights of stairs", 10, 0),
+        ("Do {n} mountain climbers", 40, 0),
+        ("Do {n} kettlebell swings", 30, 1),
+        ("Row {n} meters", 1500, 2),
+    ],
+    "strength": [
+        ("Do {n} push-ups", 20, 0),
+        ("Do {n} bodyweight squats", 30, 0),
+        ("Do {n} lunges", 20, 0),
+        ("Hold a plank for {n} seconds", 60, 0),
+        ("Do {n} dumbbell rows", 24, 1),
+        ("Do {n} goblet squats", 24, 1),
+        ("Do {n} barbell deadlift reps", 15, 2),
+        ("Do {n} bench press reps", 20, 2),
+    ],
+    "endurance": [
+        ("Walk or jog for {n} minutes", 20, 0),
+        ("Do {n} burpees", 15, 0),
+        ("Do {n} high knees", 60, 0),
+        ("Jump rope {n} times", 100, 1),
+        ("Cycle for {n} minutes", 20, 2),
+        ("Row {n} meters", 2000, 2),
+    ],
+    "mobility": [
+        ("Stretch for {n} minutes", 10, 0),
+        ("Hold a deep squat for {n} seconds", 60, 0),
+        ("Do {n} cat-cow stretches", 20, 0),
+        ("Do {n} hip circles per side", 10, 0),
+        ("Do {n} resistance band pull-aparts", 30, 1),
+    ],
+    "general": [
+        ("Walk {n} steps", 5000, 0),
+        ("Do {n} push-ups", 15, 0),
+        ("Do {n} bodyweight squats", 25, 0),
+        ("Stretch for {n} minutes", 10, 0),
+        ("Do {n} dumbbell curls", 24, 1),
+        ("Cycle for {n} minutes", 15, 2),
+    ],
+}
+
+
+def _round_target(value: float, base: int) -> int:
+    step = 500 if base >= 1000 else 5
+    return max(step, int(round(value / step)) * step)
+
+
+def fallback_templates(
+    onboarding: Mapping[str, Any], n: int, exclude_titles: Iterable[str] = ()
+) -> List[Dict[str, Any]]:
+    """Up to `n` distinct templates in the model's shape, tagged `source="fallback"`."""
+    if n <= 0:
+        return []
+
+    level = EQUIPMENT_LEVEL.get(str(onboarding.get("equipment") or "none"), 0)
+    entries = [e for e in CATALOGUE[goal_category(onboarding.get("primary_goal"))] if e[2] <= level]
+    scale = EXPERIENCE_SCALE.get(str(onboarding.get("experience") or "beginner"), 1.0)
+    days = min(7, max(1, int(onboarding.get("preferred_days_per_week") or 3)))
+    volume = scale * (0.75 + days / 14)
+    if int(onboarding.get("age") or 0) >= 60:
+        volume *= 0.8
+
+    seed_source = json.dumps(dict(onboarding), sort_keys=True, default=str) + utcnow().date().isoformat()
+    start = int.from_bytes(hashlib.sha256(seed_source.encode("utf-8")).digest()[:4], "big")
+    exclude = set(exclude_titles)
+    templates = []
+    for i in range(len(entries)):
+        if len(templates) >= n:
+            break
+        title, base, _ = entries[(start + i) % len(entries)]
+        target = _round_target(base * volume, base)
+        title = title.format(n=f"{target:,}")
+        if title in exclude:
+            continue
+        templates.append({
+            "title": title,
+            "type": "counter",
+            "target": target,
+            "rewards": {"xp": int(round(BASE_XP * scale)), "coins": int(round(BASE_COINS * scale))},
+            "source": "fallback",
+        })
+    return templates
@@ -0,0 +1,17 @@
+from typing import Optional
+
+# First matching keyword wins; anything else falls into "general".
+GOAL_CATEGORIES = (
+    ("weight_loss", ("lose", "loss", "weight", "fat", "slim", "cut", "lean", "tone")),
+    ("strength", ("strength", "strong", "muscle", "build", "bulk", "lift", "gain", "power")),
+    ("endurance", ("endurance", "cardio", "run", "stamina", "marathon", "5k", "10k", "cycl", "swim")),
+    ("mobility", ("mobility", "flexib", "stretch", "yoga", "posture", "pain", "balance")),
+)
+
+
+def goal_category(primary_goal: Optional[str]) -> str:
+    goal = (primary_goal or "").lower()
+    for category, keywords in GOAL_CATEGORIES:
+        if any(k in goal for k in keywords):
+            return category
+    return "general"
@@ -0,0 +1,107 @@
+"""Request construction for quest generation.
+
+Everything that does not vary between calls lives in module constants: the
+instructions, the response schema, and the prompt cache key. Those go first,
+byte for byte the same on every request, so the provider's prompt cache can
+reuse the prefix. The per-call part is the quest count plus the onboarding
+fields the instructions refer to, as compact JSON with a fixed key order.
+Height, weight and timestamps stay out of the prompt.
+
+Bump PROMPT_VERSION whenever the instructions or schema change, so cached
+prefixes and the cache key move together.
+"""
+import json
+from typing import Any, Dict, Mapping
+
+from ..config import get_settings
+
+settings = get_settings()
+
+PROMPT_VERSION = "2"
+
+# Onboarding fields the instructions use, in the order they are sent.
+PROMPT_FIELDS = ("experience", "equipment", "preferred_days_per_week", "primary_goal", "age")
+
+_RULES = """Consider equipment and experience. If equipment is "none", use bodyweight or walking tasks.
+Consider preferred_days_per_week for realistic volume and age for safe intensity.
+Align with primary_goal.
+Use "type": "counter". Target must be a positive integer.
+rewards.xp and rewards.coins must be non-negative integers.
+Make the quests in one response distinct from each other."""
+
+# With a json_schema response format the schema itself constrains the shape.
+STRUCTURED_INSTRUCTIONS = f"""You are a game designer for a fitness RPG.
+Generate simple daily quests for the user, exactly as many as requested.
+{_RULES}
+"""
+
+JSON_INSTRUCTIONS = f"""You are a game designer for a fitness RPG.
+Generate simple daily quests for the user.
+Return ONLY a JSON array with exactly the number of objects requested, no commentary:
+[{{"title": "concise quest name", "type": "counter", "target": positive integer, "rewards": {{"xp": int, "coins": int}}}}]
+{_RULES}
+"""
+
+# Structured output schema (strict mode needs an object root and every key required).
+QUESTS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "name": "quests",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "quests": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title": {"type": "string"},
+                        "type": {"type": "string", "enum": ["counter"]},
+                        "target": {"type": "integer"},
+                        "rewards": {
+                            "type": "object",
+                            "properties": {"xp": {"type": "integer"}, "coins": {"type": "integer"}},
+                            "required": ["xp", "coins"],
+                            "additionalProperties": False,
+                        },
+                    },
+                    "required": ["title", "type", "target", "rewards"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["quests"],
+        "additionalProperties": False,
+    },
+}
+
+
+def prompt_profile(onboarding: Mapping[str, Any]) -> Dict[str, Any]:
+    return {k: onboarding[k] for k in PROMPT_FIELDS if onboarding.get(k) is not None}
+
+
+def build_user_prompt(onboarding: Mapping[str, Any], count: int = 1) -> str:
+    data = json.dumps(prompt_profile(onboarding or {}), ensure_ascii=False, separators=(",", ":"))
+    return f"Quests requested: {count}\nUser data: {data}"
+
+
+def max_output_tokens(count: int) -> int:
+    per_quest = settings.QUEST_GEN_OUTPUT_TOKENS_PER_QUEST
+    return min(settings.QUEST_GEN_MAX_OUTPUT_TOKENS, 64 + per_quest * max(1, count))
+
+
+def build_request(onboarding: Mapping[str, Any], count: int = 1) -> Dict[str, Any]:
+    """Keyword arguments for `client.responses.create`."""
+    request: Dict[str, Any] = {
+        "model": settings.QUEST_GEN_MODEL,
+        "input": build_user_prompt(onboarding, count),
+        "max_output_tokens": max_output_tokens(count),
+    }
+    if settings.QUEST_GEN_STRUCTURED_OUTPUT:
+        request["instructions"] = STRUCTURED_INSTRUCTIONS
+        request["text"] = {"format": QUESTS_RESPONSE_FORMAT}
+    else:
+        request["instructions"] = JSON_INSTRUCTIONS
+    if settings.QUEST_GEN_PROMPT_CACHE_KEY:
+        request["prompt_cache_key"] = f"{settings.QUEST_GEN_PROMPT_CACHE_KEY}-v{PROMPT_VERSION}"
+    return request
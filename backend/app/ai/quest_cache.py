@@ -0,0 +1,161 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, List, Mapping, Optional, Protocol, Tuple
+
+from ..config import get_settings
+from ..db import quest_cache_col, utcnow
+
+settings = get_settings()
+
+# Band widths used to fold near-identical onboarding payloads onto one key.
+HEIGHT_BAND_IN = 4
+WEIGHT_BAND_LB = 25
+AGE_BAND_YEARS = 10
+
+
+def _band(value: Any, width: int) -> Optional[int]:
+    if value is None:
+        return None
+    return int(float(value) // width * width)
+
+
+def normalize_onboarding(onboarding: Mapping[str, Any]) -> Dict[str, Any]:
+    return {
+        "height_in": _band(onboarding.get("height_in"), HEIGHT_BAND_IN),
+        "weight_lb": _band(onboarding.get("weight_lb"), WEIGHT_BAND_LB),
+        "age": _band(onboarding.get("age"), AGE_BAND_YEARS),
+        "primary_goal": " ".join(str(onboarding.get("primary_goal") or "").lower().split()),
+        "experience": onboarding.get("experience"),
+        "equipment": onboarding.get("equipment"),
+        "preferred_days_per_week": onboarding.get("preferred_days_per_week"),
+    }
+
+
+def onboarding_fingerprint(onboarding: Mapping[str, Any]) -> str:
+    normalized = json.dumps(normalize_onboarding(onboarding), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class QuestCacheBackend(Protocol):
+    async def get(self, key: str) -> List[Dict[str, Any]]: ...
+
+    async def add(self, key: str, templates: List[Dict[str, Any]]) -> None: ...
+
+
+class MemoryQuestCacheBackend:
+    def __init__(self, max_keys: int, ttl_sec: float, max_variants: int):
+        self.max_keys = max(1, int(max_keys))
+        self.ttl_sec = float(ttl_sec)
+        self.max_variants = max(1, int(max_variants))
+        self._entries: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return []
+            if time.monotonic() - entry[0] > self.ttl_sec:
+                del self._entries[key]
+                return []
+            self._entries.move_to_end(key)
+            return list(entry[1])
+
+    async def add(self, key: str, templates: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            variants = (entry[1] if entry else []) + list(templates)
+            self._entries[key] = (time.monotonic(), variants[-self.max_variants:])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+
+class MongoQuestCacheBackend:
+    def __init__(self, ttl_sec: float, max_variants: int):
+        self.ttl_sec = float(ttl_sec)
+        self.max_variants = max(1, int(max_variants))
+
+    async def get(self, key: str) -> List[Dict[str, Any]]:
+        doc = await quest_cache_col().find_one(
+            {"_id": key, "expires_at": {"$gt": utcnow()}}, {"variants": 1}
+        )
+        return list((doc or {}).get("variants") or [])
+
+    async def add(self, key: str, templates: List[Dict[str, Any]]) -> None:
+        now = utcnow()
+        await quest_cache_col().update_one(
+            {"_id": key},
+            {
+                "$push": {"variants": {"$each": list(templates), "$slice": -self.max_variants}},
+                "$set": {"updated_at": now, "expires_at": now + timedelta(seconds=self.ttl_sec)},
+            },
+            upsert=True,
+        )
+
+
+class QuestGenerationCache:
+    """Serves random picks from previously generated quests for similar profiles.
+
+    A key counts as a hit once it holds at least `min_variants` quests, so early
+    users of a profile still see fresh generations that widen the variety.
+    """
+
+    def __init__(self, backend: Optional[QuestCacheBackend], min_variants: int):
+        self.backend = backend
+        self.min_variants = max(1, int(min_variants))
+        self.hits = 0
+        self.misses = 0
+        self.saved_model_calls = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    async def pick(self, onboarding: Mapping[str, Any], n: int) -> List[Dict[str, Any]]:
+        if not self.enabled or n <= 0:
+            return []
+        variants = await self.backend.get(onboarding_fingerprint(onboarding))
+        if len(variants) < self.min_variants:
+            self.misses += 1
+            return []
+        self.hits += 1
+        self.saved_model_calls += -(-n // max(1, settings.QUEST_GEN_BATCH_SIZE))
+        return random.sample(variants, min(n, len(variants)))
+
+    async def add(self, onboarding: Mapping[str, Any], templates: List[Dict[str, Any]]) -> None:
+        if self.enabled and templates:
+            await self.backend.add(onboarding_fingerprint(onboarding), templates)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": settings.QUEST_CACHE_BACKEND,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            "saved_model_calls": self.saved_model_calls,
+        }
+
+
+def _make_backend() -> Optional[QuestCacheBackend]:
+    if settings.QUEST_CACHE_BACKEND == "memory":
+        return MemoryQuestCacheBackend(
+            max_keys=settings.QUEST_CACHE_MAX_KEYS,
+            ttl_sec=settings.QUEST_CACHE_TTL_SEC,
+            max_variants=settings.QUEST_CACHE_MAX_VARIANTS,
+        )
+    if settings.QUEST_CACHE_BACKEND == "mongo":
+        return MongoQuestCacheBackend(
+            ttl_sec=settings.QUEST_CACHE_TTL_SEC,
+            max_variants=settings.QUEST_CACHE_MAX_VARIANTS,
+        )
+    return None
+
+
+quest_cache = QuestGenerationCache(_make_backend(), settings.QUEST_CACHE_MIN_VARIANTS)
@@ -0,0 +1,58 @@
+import logging
+import os
+import socket
+from datetime import timedelta
+from typing import Any, Dict
+from uuid import uuid4
+from pymongo.errors import DuplicateKeyError
+
+from ..config import get_settings
+from ..db import quest_fill_leases_col, utcnow
+from ..jobs import enqueue_job, job_handler
+from ..quest_events import quest_events
+from .ai import fill_missing_active_quests
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+async def acquire_fill_lease(user_id) -> bool:
+    """Claim the per-user fill lease; False if another worker holds a live one."""
+    now = utcnow()
+    try:
+        await quest_fill_leases_col().update_one(
+            {"_id": user_id, "expires_at": {"$lte": now}},
+            {"$set": {
+                "owner": WORKER_ID,
+                "acquired_at": now,
+                "expires_at": now + timedelta(seconds=settings.QUEST_FILL_LEASE_SEC),
+            }},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def release_fill_lease(user_id) -> None:
+    await quest_fill_leases_col().delete_one({"_id": user_id, "owner": WORKER_ID})
+
+
+@job_handler("quest_fill")
+async def run_fill_job(payload: Dict[str, Any]) -> None:
+    user_id = payload["user_id"]
+    if not await acquire_fill_lease(user_id):
+        return
+    added = 0
+    try:
+        added = await fill_missing_active_quests(user_id)
+    finally:
+        await release_fill_lease(user_id)
+        quest_events.publish(user_id, "fill_complete", {"added": added})
+
+
+async def request_quest_fill(user_id) -> bool:
+    """Queue a fill for the user; False if one is already queued or running."""
+    return await enqueue_job("quest_fill", {"user_id": user_id}, key=f"quest_fill:{user_id}")
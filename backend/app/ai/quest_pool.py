@@ -0,0 +1,113 @@
+import logging
+import time
+from typing import Any, Dict, List, Mapping, Optional
+from pymongo import ASCENDING
+
+from ..config import get_settings
+from ..db import quest_pool_col, utcnow
+from ..jobs import enqueue_job, job_handler
+from .ai import generate_quest_templates, new_active_quest
+from .goals import goal_category
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+# Takes happen on every quest load; don't try to enqueue a refill for each one.
+REFILL_REQUEST_INTERVAL_SEC = 10.0
+_refill_requested_at: Dict[str, float] = {}
+
+
+def profile_bucket(onboarding: Mapping[str, Any]) -> str:
+    return "|".join((
+        str(onboarding.get("experience") or "beginner"),
+        str(onboarding.get("equipment") or "none"),
+        str(int(onboarding.get("preferred_days_per_week") or 3)),
+        goal_category(onboarding.get("primary_goal")),
+    ))
+
+
+def bucket_onboarding(bucket: str) -> Dict[str, Any]:
+    """Representative onboarding used to generate quests shared by a bucket."""
+    experience, equipment, days, category = bucket.split("|")
+    return {
+        "experience": experience,
+        "equipment": equipment,
+        "preferred_days_per_week": int(days),
+        "primary_goal": category.replace("_", " "),
+    }
+
+
+async def take_quests(onboarding: Mapping[str, Any], n: int, now=None) -> List[Dict[str, Any]]:
+    """Pop up to `n` pooled quests for the user's bucket and start them."""
+    bucket = profile_bucket(onboarding)
+    now = now or utcnow()
+    taken: List[Dict[str, Any]] = []
+    for _ in range(max(0, n)):
+        doc = await quest_pool_col().find_one_and_delete(
+            {"bucket": bucket}, sort=[("created_at", ASCENDING)]
+        )
+        if not doc:
+            break
+        taken.append(new_active_quest({**doc["quest"], "source": "pool"}, now))
+    await schedule_refill(bucket)
+    return taken
+
+
+async def return_quests(onboarding: Mapping[str, Any], quests: List[Dict[str, Any]]) -> None:
+    """Put unused (never shown) pooled quests back into the user's bucket.
+
+    Anything that did not come out of the pool is dropped: fallback quests and
+    quests generated for one user's profile are not shared stock.
+    """
+    quests = [q for q in quests if q.get("source") == "pool"]
+    if not quests:
+        return
+    now = utcnow()
+    await quest_pool_col().insert_many(
+        [
+            {
+                "bucket": profile_bucket(onboarding),
+                "quest": {k: q[k] for k in ("title", "type", "target", "rewards")},
+                "created_at": now,
+            }
+            for q in quests
+        ],
+        ordered=False,
+    )
+
+
+async def refill_bucket(bucket: str) -> int:
+    """Top the bucket back up to the high watermark once it drops below the low one."""
+    col = quest_pool_col()
+    stock = await col.count_documents({"bucket": bucket})
+    if stock >= settings.QUEST_POOL_LOW_WATERMARK:
+        return 0
+
+    try:
+        templates = await generate_quest_templates(
+            bucket_onboarding(bucket), settings.QUEST_POOL_HIGH_WATERMARK - stock, use_cache=False, fallback=False
+        )
+    except Exception:
+        log.exception("quest pool refill failed for bucket %s", bucket)
+        return 0
+
+    if templates:
+        now = utcnow()
+        await col.insert_many(
+            [{"bucket": bucket, "quest": t, "created_at": now} for t in templates], ordered=False
+        )
+    return len(templates)
+
+
+@job_handler("quest_pool_refill")
+async def run_refill_job(payload: Dict[str, Any]) -> None:
+    await refill_bucket(payload["bucket"])
+
+
+async def schedule_refill(bucket: str) -> None:
+    """Queue a refill check for the bucket, at most once per REFILL_REQUEST_INTERVAL_SEC per process."""
+    now = time.monotonic()
+    if now - _refill_requested_at.get(bucket, float("-inf")) < REFILL_REQUEST_INTERVAL_SEC:
+        return
+    _refill_requested_at[bucket] = now
+    await enqueue_job("quest_pool_refill", {"bucket": bucket}, key=f"quest_pool_refill:{bucket}")
@@ -1,12 +1,16 @@
 from datetime import timedelta
-from typing import Optional, Mapping, Any, Dict
+from typing import Optional, Mapping, Any, Dict, Tuple
 from fastapi import HTTPException, Request, Body
-import uuid, secrets, hmac, hashlib
+import uuid, secrets, hmac, hashlib, math
 from pydantic import EmailStr
-from .db import users_col, utcnow
+from pymongo import UpdateOne
+from .db import login_failures_col, utcnow
 from .config import get_settings
 from .models import AuthedUser, LoginRequest
-import bcrypt
+from .session_cache import session_cache
+from .hashing import bcrypt_hash, bcrypt_verify, bcrypt_cost, run_hashing
+from . import users
+from .rate_limit import client_ip
 
 settings = get_settings()
 
@@ -53,15 +57,34 @@ def _truncate_password_bytes(raw: str) -> str:
 
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    return bcrypt_hash(password, settings.BCRYPT_ROUNDS)
 
 
 def verify_password(plain_password: str, hashed: str) -> bool:
     """Verify a password against its hash"""
-    return bcrypt.checkpw(
-        plain_password.encode("utf-8"),
-        hashed.encode("utf-8"),
-    )
+    return bcrypt_verify(plain_password, hashed)
+
+
+async def hash_password_async(password: str) -> str:
+    """Hash a password on the hashing pool"""
+    return await run_hashing(bcrypt_hash, password, settings.BCRYPT_ROUNDS)
+
+
+async def verify_password_async(plain_password: str, hashed: str) -> bool:
+    """Verify a password on the hashing pool"""
+    return await run_hashing(bcrypt_verify, plain_password, hashed)
+
+
+def password_needs_rehash(hashed: str) -> bool:
+    return bcrypt_cost(hashed) != settings.BCRYPT_ROUNDS
+
+
+async def rehash_password_if_needed(user: Mapping[str, Any], plain_password: str) -> None:
+    old_hash = user.get("password_hash", "")
+    if not password_needs_rehash(old_hash):
+        return
+    new_hash = await hash_password_async(plain_password)
+    await users.replace_password_hash(user, new_hash)
 
 
 def normalize_email(email: EmailStr) -> str:
@@ -84,37 +107,27 @@ def codes_equal(stored_hash: str, candidate: str) -> bool:
     return hmac.compare_digest(stored_hash, cand)
 
 
-def get_user_by_email(email: EmailStr) -> Optional[AuthedUser]:
-    return users_col().find_one({"email": normalize_email(email)})
+async def get_user_by_email(email: EmailStr) -> Optional[users.LoginUser]:
+    return await users.find_for_login(normalize_email(email))
 
 
-def get_user_by_token(token: str) -> Optional[AuthedUser]:
-    return users_col().find_one(
-        {"token": token},
-        {
-            "name": 1,
-            "email": 1,
-            "token_expiry": 1,
-            "verified": 1,
-            "onboarding": 1,
-        },
-    )
+async def get_user_by_token(token: str) -> Optional[AuthedUser]:
+    cached = session_cache.get(token)
+    if cached is not None:
+        return cached
 
+    user = await users.find_session(token)
+    if user:
+        settled = is_fully_onboarded_user(user) and (
+            bool(user.get("verified", False)) or not settings.REQUIRE_VERIFIED_FOR_LOGIN
+        )
+        session_cache.put(token, user, None if settled else settings.SESSION_CACHE_PENDING_TTL_SEC)
+    return user
 
-def rotate_token_for_user(user_id):
-    token = generate_token()
-    token_expiry = get_expiry_time()
-    users_col().update_one(
-        {"_id": user_id},
-        {
-            "$set": {
-                "token": token,
-                "token_expiry": token_expiry,
-                "updated_at": utcnow(),
-            }
-        },
-    )
-    return users_col().find_one({"_id": user_id}, {"password_hash": 0})
+
+async def rotate_token_for_user(user_id) -> Optional[users.TokenUser]:
+    session_cache.invalidate_user(user_id)
+    return await users.rotate_token(user_id, generate_token(), get_expiry_time())
 
 
 REQUIRED_ONBOARDING_FIELDS = (
@@ -153,10 +166,10 @@ def _extract_bearer_token(request: Request) -> str:
     return token
 
 
-def require_auth(request: Request) -> AuthedUser:
+async def require_auth(request: Request) -> AuthedUser:
     token = _extract_bearer_token(request)
 
-    user: Optional[AuthedUser] = get_user_by_token(token)
+    user: Optional[AuthedUser] = await get_user_by_token(token)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid token")
 
@@ -173,12 +186,79 @@ def require_auth(request: Request) -> AuthedUser:
     return user
 
 
-def authenticate_credentials(payload: LoginRequest = Body(...)) -> AuthedUser:
-    user = get_user_by_email(payload.email)
-    if not user or not verify_password(payload.password, user.get("password_hash", "")):
+# Failed logins are counted per account (email) and per (email, client IP).
+# One address is locked after LOGIN_MAX_FAILURES; the account is locked for
+# every address after LOGIN_MAX_ACCOUNT_FAILURES, so rotating IPs does not
+# reset the count. Unknown emails are counted the same way, so the responses
+# do not reveal which emails have accounts.
+def _lockout_keys(email: str, ip: str) -> Tuple[str, str]:
+    return email, f"{email}|{ip}"
+
+
+async def _failed_logins(keys: Tuple[str, str]) -> Dict[str, Dict[str, Any]]:
+    cursor = login_failures_col().find({"_id": {"$in": list(keys)}}, {"n": 1, "last_failed_at": 1})
+    return {doc["_id"]: doc async for doc in cursor}
+
+
+def login_locked_for(failures: Optional[Mapping[str, Any]], max_failures: int) -> int:
+    """Seconds left on a failed-login lockout, 0 if not locked."""
+    if not failures or int(failures.get("n") or 0) < max_failures:
+        return 0
+    remaining = settings.LOGIN_LOCKOUT_SEC - (utcnow() - failures["last_failed_at"]).total_seconds()
+    return math.ceil(remaining) if remaining > 0 else 0
+
+
+async def record_failed_login(keys: Tuple[str, str]) -> None:
+    now = utcnow()
+    update = {"$inc": {"n": 1}, "$set": {"last_failed_at": now, "expires_at": now + timedelta(seconds=settings.LOGIN_LOCKOUT_SEC)}}
+    await login_failures_col().bulk_write([UpdateOne({"_id": key}, update, upsert=True) for key in keys], ordered=False)
+
+
+_dummy_hash: Optional[str] = None
+
+
+async def _verify_against_dummy(password: str) -> None:
+    """Spend the same bcrypt time as a real check when the email is unknown."""
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = await hash_password_async(secrets.token_urlsafe(16))
+    await verify_password_async(password, _dummy_hash)
+
+
+async def authenticate_credentials(request: Request, payload: LoginRequest = Body(...)) -> users.LoginUser:
+    email = normalize_email(payload.email)
+    account_key, ip_key = keys = _lockout_keys(email, client_ip(request.scope))
+    failures = await _failed_logins(keys)
+
+    # Checked before the user lookup and bcrypt: a locked caller costs one query and
+    # gets the same answer whether or not the email exists.
+    locked_for = max(
+        login_locked_for(failures.get(account_key), settings.LOGIN_MAX_ACCOUNT_FAILURES),
+        login_locked_for(failures.get(ip_key), settings.LOGIN_MAX_FAILURES),
+    )
+    if locked_for:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many failed logins, please retry later",
+            headers={"Retry-After": str(locked_for)},
+        )
+
+    user = await users.find_for_login(email)
+    if not user:
+        await _verify_against_dummy(payload.password)
+        await record_failed_login(keys)
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    if not await verify_password_async(payload.password, user.get("password_hash", "")):
+        await record_failed_login(keys)
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    if failures:
+        await login_failures_col().delete_many({"_id": {"$in": list(keys)}})
+
     if settings.REQUIRE_VERIFIED_FOR_LOGIN and not bool(user.get("verified", False)):
         raise HTTPException(status_code=403, detail="Email not verified")
 
+    await rehash_password_if_needed(user, payload.password)
+
     return user
@@ -1,12 +1,30 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from functools import lru_cache
-from typing import Optional, List
+from typing import Optional, List, Literal
 
 class Settings(BaseSettings):
     MONGO_URI: str = "mongodb://localhost:27017"
     DB_NAME: str = "db_name"
+    ENSURE_INDEXES_ON_STARTUP: bool = True
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_MAX_IDLE_TIME_MS: Optional[int] = None
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = None
+    MONGO_CONNECT_TIMEOUT_MS: int = 5000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 5000
+    MONGO_SOCKET_TIMEOUT_MS: Optional[int] = None
     TOKEN_EXPIRY_DAYS: int = 2
+    SESSION_CACHE_MAX_ENTRIES: int = 10000
+    SESSION_CACHE_TTL_SEC: int = 30
+    SESSION_CACHE_PENDING_TTL_SEC: int = 2  # users not yet onboarded/verified
+
+    BCRYPT_ROUNDS: int = 12
+    HASH_EXECUTOR: Literal["process", "thread"] = "process"
+    HASH_POOL_SIZE: int = 0  # 0 = one worker per CPU core
+    HASH_QUEUE_MAX: int = 64
     CORS_ALLOW_ORIGINS: List[str] = ["*"]
+    METRICS_ENABLED: bool = False
+    METRICS_PATH: str = "/metrics"
 
     EMAIL_FROM: str = "noreply@example.com"
     SMTP_HOST: str = "localhost"
@@ -14,14 +32,104 @@ class Settings(BaseSettings):
     SMTP_STARTTLS: bool = False
     SMTP_USER: Optional[str] = None
     SMTP_PASS: Optional[str] = None
+    SMTP_TIMEOUT_SEC: float = 10.0
+    SMTP_POOL_SIZE: int = 2
+    SMTP_IDLE_TIMEOUT_SEC: float = 60.0
+
+    OUTBOX_WORKER_ENABLED: bool = True
+    OUTBOX_BATCH_SIZE: int = 20
+    OUTBOX_CONCURRENCY: int = 2
+    OUTBOX_POLL_INTERVAL_SEC: float = 1.0
+    OUTBOX_LEASE_SEC: int = 120
+    OUTBOX_MAX_ATTEMPTS: int = 6
+    OUTBOX_BACKOFF_BASE_SEC: float = 5.0
+    OUTBOX_BACKOFF_MAX_SEC: float = 600.0
+    OUTBOX_RETENTION_HOURS: int = 24
+
+    JOB_WORKER_IN_API: bool = True  # turn off once `python -m app.worker` processes run the queue
+    JOB_WORKER_CONCURRENCY: int = 4
+    JOB_POLL_INTERVAL_SEC: float = 1.0
+    JOB_LEASE_SEC: int = 120
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_BACKOFF_BASE_SEC: float = 2.0
+    JOB_BACKOFF_MAX_SEC: float = 300.0
+    JOB_RETENTION_HOURS: int = 24
+    JOB_DEAD_RETENTION_HOURS: int = 168
+    JOB_SHUTDOWN_GRACE_SEC: float = 30.0
 
     VERIFICATION_TTL_MIN: int = 15
     VERIFICATION_RESEND_COOLDOWN_SEC: int = 60
     VERIFICATION_MAX_ATTEMPTS: int = 10
     VERIFICATION_PEPPER: str = "change-me"
     REQUIRE_VERIFIED_FOR_LOGIN: bool = True
+
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_PATHS: List[str] = ["/auth/login", "/auth/signup", "/auth/verify-email", "/auth/resend-verification"]
+    RATE_LIMIT_WINDOW_SEC: int = 60
+    RATE_LIMIT_IP_LIMIT: int = 30  # requests per window per client IP
+    RATE_LIMIT_IP_BURST: int = 10
+    RATE_LIMIT_EMAIL_LIMIT: int = 10  # requests per window per normalized email
+    RATE_LIMIT_EMAIL_BURST: int = 5
+    RATE_LIMIT_SYNC_SEC: float = 2.0
+    RATE_LIMIT_MAX_KEYS: int = 100000
+    # Proxies in front of the app that append to X-Forwarded-For; 0 uses the socket peer address.
+    RATE_LIMIT_TRUSTED_PROXY_HOPS: int = 0
+    RATE_LIMIT_TRUSTED_PROXIES: List[str] = []  # peer IPs/CIDRs allowed to set X-Forwarded-For; empty = any
+    LOGIN_MAX_FAILURES: int = 5  # per email and client IP
+    LOGIN_MAX_ACCOUNT_FAILURES: int = 20  # per email, from any IP
+    LOGIN_LOCKOUT_SEC: int = 900
     API_TOKEN: str = "change-me"
 
+    LEADERBOARD_ENABLED: bool = True
+    LEADERBOARD_REFRESH_SEC: int = 60
+    LEADERBOARD_TOP_N: int = 1000
+    LEADERBOARD_RANK_BUCKETS: int = 200
+    LEADERBOARD_WEEKS_KEPT: int = 8
+
+    WORKOUT_INGEST_MAX_ITEMS: int = 1000
+    WORKOUT_STREAM_MAX_LIMIT: int = 5000
+    WORKOUT_STREAM_BATCH_SIZE: int = 500
+
+    QUEST_GEN_MODEL: str = "gpt-4o-mini"
+    QUEST_GEN_MAX_OUTPUT_TOKENS: int = 1024
+    QUEST_GEN_OUTPUT_TOKENS_PER_QUEST: int = 120
+    QUEST_GEN_PROMPT_CACHE_KEY: Optional[str] = "quest-gen"  # empty to omit prompt_cache_key
+    QUEST_GEN_BATCH_SIZE: int = 5
+    QUEST_GEN_CONCURRENCY: int = 4
+    QUEST_GEN_TIMEOUT_SEC: float = 20.0
+    QUEST_GEN_ATTEMPTS: int = 3
+    QUEST_GEN_STRUCTURED_OUTPUT: bool = True  # json_schema response format; off for providers without it
+    QUEST_GEN_DEADLINE_SEC: float = 45.0  # per batch, across attempts and backoff
+    QUEST_GEN_BACKOFF_BASE_SEC: float = 0.5
+    QUEST_GEN_BACKOFF_MAX_SEC: float = 4.0
+    QUEST_CACHE_BACKEND: Literal["memory", "mongo", "off"] = "memory"
+    QUEST_CACHE_MAX_KEYS: int = 5000
+    QUEST_CACHE_TTL_SEC: int = 86400
+    QUEST_CACHE_MIN_VARIANTS: int = 6
+    QUEST_CACHE_MAX_VARIANTS: int = 30
+    QUEST_FILL_LEASE_SEC: int = 120
+    QUEST_POOL_LOW_WATERMARK: int = 5
+    QUEST_POOL_HIGH_WATERMARK: int = 20
+
+    QUEST_PROGRESS_FLUSH_MS: int = 500
+    QUEST_PROGRESS_MAX_PENDING: int = 10000  # buffered (user, quest) keys; beyond this, writes go direct
+    QUEST_PROGRESS_MAX_AGE_SEC: float = 30.0  # unwritten increments older than this are dropped
+
+    LLM_BREAKER_ENABLED: bool = True
+    LLM_BREAKER_WINDOW_SEC: int = 60
+    LLM_BREAKER_MIN_CALLS: int = 10
+    LLM_BREAKER_ERROR_RATE: float = 0.5
+    LLM_BREAKER_SLOW_CALL_SEC: float = 10.0
+    LLM_BREAKER_SLOW_RATE: float = 0.5
+    LLM_BREAKER_OPEN_SEC: int = 30
+    LLM_BREAKER_SYNC_SEC: float = 5.0
+
+    QUEST_STREAM_HEARTBEAT_SEC: float = 15.0
+    QUEST_STREAM_MAX_SEC: int = 300
+    QUEST_STREAM_RETRY_MS: int = 3000
+    QUEST_EVENTS_QUEUE_SIZE: int = 100
+    QUEST_EVENTS_CHANGE_STREAM: bool = True  # cross-worker delivery; needs a replica set
+
     model_config = SettingsConfigDict(env_file=".env", case_sensitive=True)
 
 @lru_cache
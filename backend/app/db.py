@@ -1,37 +1,208 @@
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import AsyncMongoClient, ASCENDING, DESCENDING, IndexModel
 from datetime import datetime, timezone
+from typing import Dict, List
 from .config import get_settings
+from .metrics import mongo_event_listeners
 
 _settings = get_settings()
-_client = MongoClient(_settings.MONGO_URI, tz_aware=True, tzinfo=timezone.utc)
+_client = AsyncMongoClient(
+    _settings.MONGO_URI,
+    tz_aware=True,
+    tzinfo=timezone.utc,
+    maxPoolSize=_settings.MONGO_MAX_POOL_SIZE,
+    minPoolSize=_settings.MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=_settings.MONGO_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=_settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    connectTimeoutMS=_settings.MONGO_CONNECT_TIMEOUT_MS,
+    serverSelectionTimeoutMS=_settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    socketTimeoutMS=_settings.MONGO_SOCKET_TIMEOUT_MS,
+    event_listeners=mongo_event_listeners(),
+)
 _db = _client[_settings.DB_NAME]
+_collections = {}
+
+SCHEMA_INDEXES_COLLECTION = "schema_indexes"
+
+INDEX_SPECS: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True, name="uniq_email"),
+        IndexModel([("token", ASCENDING)], name="idx_token"),
+        IndexModel([("verified", ASCENDING)], name="idx_verified"),
+        IndexModel([("quests.active.quest_id", ASCENDING)], name="idx_active_qid"),
+        IndexModel([("quests.backlog.quest_id", ASCENDING)], name="idx_backlog_qid"),
+        IndexModel([("progress.level", DESCENDING)], name="idx_progress_level"),
+        IndexModel([("progress.xp_total", DESCENDING)], name="idx_progress_xp"),
+        IndexModel([("wallet.coins_balance", DESCENDING)], name="idx_wallet_coins"),
+    ],
+    "email_verifications": [
+        IndexModel([("email", ASCENDING)], name="idx_ev_email"),
+        IndexModel([("user_id", ASCENDING)], name="idx_ev_user"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_ev_expires"),
+    ],
+    "workout_logs": [
+        IndexModel([("user_id", ASCENDING), ("idempotency_key", ASCENDING)], unique=True, name="uniq_wl_user_idem"),
+        IndexModel([("user_id", ASCENDING), ("performed_at", DESCENDING), ("_id", DESCENDING)], name="idx_wl_user_performed"),
+        IndexModel([("user_id", ASCENDING), ("tags", ASCENDING), ("performed_at", DESCENDING), ("_id", DESCENDING)], name="idx_wl_user_tags_performed"),
+        IndexModel([("tags", ASCENDING)], name="idx_tags"),
+        IndexModel([("created_at", DESCENDING)], name="idx_created"),
+    ],
+    "workout_stats": [
+        IndexModel([("user_id", ASCENDING), ("period", ASCENDING), ("start", DESCENDING)], name="idx_ws_user_period_start"),
+    ],
+    "quest_history": [
+        IndexModel([("user_id", ASCENDING), ("quest_id", ASCENDING)], unique=True, name="uniq_qh_user_quest"),
+        IndexModel(
+            [("user_id", ASCENDING), ("completed_at", DESCENDING), ("_id", DESCENDING)],
+            name="idx_qh_user_completed",
+        ),
+    ],
+    "leaderboard_weekly": [
+        IndexModel([("week", ASCENDING), ("user_id", ASCENDING)], unique=True, name="uniq_lw_week_user"),
+        IndexModel([("week", ASCENDING), ("xp", DESCENDING)], name="idx_lw_week_xp"),
+        IndexModel([("week", ASCENDING), ("coins", DESCENDING)], name="idx_lw_week_coins"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_lw_expires"),
+    ],
+    "email_outbox": [
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="idx_eo_status_next"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_eo_expires"),
+    ],
+    "jobs": [
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="idx_jobs_status_next"),
+        IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="idx_jobs_status_lease"),
+        IndexModel(
+            [("active_key", ASCENDING)], unique=True,
+            partialFilterExpression={"active_key": {"$exists": True}}, name="uniq_jobs_active_key",
+        ),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_jobs_expires"),
+    ],
+    "quest_pool": [
+        IndexModel([("bucket", ASCENDING), ("created_at", ASCENDING)], name="idx_qp_bucket_created"),
+    ],
+    "quest_fill_leases": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_qfl_expires"),
+    ],
+    "rate_limits": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_rl_expires"),
+    ],
+    "login_failures": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_lf_expires"),
+    ],
+    "quest_cache": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_qc_expires"),
+    ],
+}
+
+# Indexes superseded by INDEX_SPECS; `python -m app.migrate indexes` drops them.
+RETIRED_INDEXES: Dict[str, List[str]] = {
+    "workout_logs": ["idx_user_performed"],
+    # email_verifications is keyed by user id, one document per user.
+    "email_verifications": ["idx_ev_email_created"],
+}
 
 def utcnow():
     return datetime.now(timezone.utc)
 
-def users_col():
-    col = _db["users"]
-    col.create_index([("email", ASCENDING)], unique=True, name="uniq_email")
-    col.create_index([("token", ASCENDING)], name="idx_token")
-    col.create_index([("verified", ASCENDING)], name="idx_verified")
-    col.create_index([("quests.active.quest_id", ASCENDING)], name="idx_active_qid")
-    col.create_index([("quests.backlog.quest_id", ASCENDING)], name="idx_backlog_qid")
-    col.create_index([("quests.completed.quest_id", ASCENDING)], name="idx_completed_qid")
-    col.create_index([("progress.level", DESCENDING)], name="idx_progress_level")
-    col.create_index([("wallet.coins_balance", DESCENDING)], name="idx_wallet_coins")
+def _collection(name: str):
+    col = _collections.get(name)
+    if col is None:
+        col = _collections[name] = _db[name]
     return col
 
+def users_col():
+    return _collection("users")
+
 def email_verifications_col():
-    col = _db["email_verifications"]
-    col.create_index([("email", ASCENDING)], name="idx_ev_email")
-    col.create_index([("user_id", ASCENDING)], name="idx_ev_user")
-    col.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0, name="ttl_ev_expires")
-    col.create_index([("email", ASCENDING), ("created_at", DESCENDING)], name="idx_ev_email_created")
-    return col
+    return _collection("email_verifications")
 
 def workout_logs_col():
-    col = _db["workout_logs"]
-    col.create_index([("user_id", ASCENDING), ("performed_at", DESCENDING)], name="idx_user_performed")
-    col.create_index([("tags", ASCENDING)], name="idx_tags")
-    col.create_index([("created_at", DESCENDING)], name="idx_created")
-    return col
\ No newline at end of file
+    return _collection("workout_logs")
+
+def workout_stats_col():
+    return _collection("workout_stats")
+
+def quest_history_col():
+    return _collection("quest_history")
+
+def leaderboard_weekly_col():
+    return _collection("leaderboard_weekly")
+
+def leaderboard_snapshots_col():
+    return _collection("leaderboard_snapshots")
+
+def email_outbox_col():
+    return _collection("email_outbox")
+
+def rate_limits_col():
+    return _collection("rate_limits")
+
+def login_failures_col():
+    return _collection("login_failures")
+
+def quest_pool_col():
+    return _collection("quest_pool")
+
+def quest_cache_col():
+    return _collection("quest_cache")
+
+def quest_fill_leases_col():
+    return _collection("quest_fill_leases")
+
+def circuit_breakers_col():
+    return _collection("circuit_breakers")
+
+def jobs_col():
+    return _collection("jobs")
+
+def _spec_record(collection: str, index: IndexModel) -> dict:
+    doc = dict(index.document)
+    return {
+        "_id": f"{collection}.{doc['name']}",
+        "collection": collection,
+        "name": doc["name"],
+        "key": [[field, direction] for field, direction in doc.pop("key").items()],
+        "options": {k: v for k, v in doc.items() if k != "name"},
+    }
+
+async def close_client() -> None:
+    await _client.close()
+
+async def ensure_indexes() -> List[str]:
+    """Create any index in INDEX_SPECS that has not been applied yet.
+
+    Applied specs are recorded in `schema_indexes`, so repeated runs only
+    cost a single read. Returns the ids of the specs created by this call.
+    """
+    registry = _collection(SCHEMA_INDEXES_COLLECTION)
+    applied = {
+        doc["_id"]: doc
+        async for doc in registry.find({}, {"key": 1, "options": 1})
+    }
+
+    created: List[str] = []
+    for collection, indexes in INDEX_SPECS.items():
+        pending = []
+        for index in indexes:
+            record = _spec_record(collection, index)
+            prev = applied.get(record["_id"])
+            if prev and prev.get("key") == record["key"] and prev.get("options") == record["options"]:
+                continue
+            pending.append((index, record))
+        if not pending:
+            continue
+
+        await _collection(collection).create_indexes([index for index, _ in pending])
+        now = utcnow()
+        for _, record in pending:
+            await registry.replace_one({"_id": record["_id"]}, {**record, "applied_at": now}, upsert=True)
+            created.append(record["_id"])
+    return created
+
+async def drop_retired_indexes() -> List[str]:
+    dropped: List[str] = []
+    for collection, names in RETIRED_INDEXES.items():
+        existing = await _collection(collection).index_information()
+        for name in names:
+            if name in existing:
+                await _collection(collection).drop_index(name)
+                dropped.append(f"{collection}.{name}")
+    return dropped
@@ -1,23 +1,51 @@
 import smtplib
+import time
 from email.message import EmailMessage
 from ..config import get_settings
+from ..metrics import observe_smtp
 
 settings = get_settings()
 
-def send_email_sync(to_email: str, subject: str, html: str, nohtml: str):
+def build_message(to_email: str, subject: str, html: str, nohtml: str) -> EmailMessage:
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = settings.EMAIL_FROM
     msg["To"] = to_email
     msg.set_content(nohtml)
     msg.add_alternative(html, subtype="html")
+    return msg
 
-    with smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT) as s:
+def open_smtp_connection() -> smtplib.SMTP:
+    started = time.perf_counter()
+    try:
+        s = smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT, timeout=settings.SMTP_TIMEOUT_SEC)
+    except Exception:
+        observe_smtp("connect", time.perf_counter() - started, "error")
+        raise
+    try:
         if settings.SMTP_STARTTLS:
             s.starttls()
         if settings.SMTP_USER and settings.SMTP_PASS:
             s.login(settings.SMTP_USER, settings.SMTP_PASS)
-        s.send_message(msg)
+    except Exception:
+        s.close()
+        observe_smtp("connect", time.perf_counter() - started, "error")
+        raise
+    observe_smtp("connect", time.perf_counter() - started, "ok")
+    return s
+
+def send_message_timed(conn: smtplib.SMTP, msg: EmailMessage) -> None:
+    started = time.perf_counter()
+    try:
+        conn.send_message(msg)
+    except Exception:
+        observe_smtp("send", time.perf_counter() - started, "error")
+        raise
+    observe_smtp("send", time.perf_counter() - started, "ok")
+
+def send_email_sync(to_email: str, subject: str, html: str, nohtml: str):
+    with open_smtp_connection() as s:
+        send_message_timed(s, build_message(to_email, subject, html, nohtml))
 
 def email_verification_html(name: str, code: str) -> str:
     return f"""
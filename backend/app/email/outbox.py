@@ -0,0 +1,315 @@
+"""Persistent outbound mail queue.
+
+Routes call `enqueue_email`, which only inserts into the `email_outbox`
+collection. `OutboxWorker` claims due messages in batches, sends them over
+pooled SMTP connections and reschedules failures with exponential backoff.
+A batch stops starting new sends once its lease is close to running out;
+the rest go back to pending without using up an attempt. Once a message is
+sent or has failed for good, its rendered subject and bodies (which can hold
+verification codes) are removed; only the envelope and status are kept for
+OUTBOX_RETENTION_HOURS.
+Point SMTP_HOST/SMTP_PORT at a local sink (e.g. `python -m aiosmtpd -n -l
+localhost:8025`) to exercise it end to end.
+"""
+import asyncio
+import logging
+import random
+import smtplib
+import socket
+import threading
+import time
+from datetime import timedelta
+from email.message import EmailMessage
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from uuid import uuid4
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from ..config import get_settings
+from ..db import email_outbox_col, utcnow
+from ..metrics import observe_queue_time
+from .email_manager import build_message, open_smtp_connection, send_message_timed
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+_wakeup = asyncio.Event()
+
+
+async def enqueue_email(to_email: str, subject: str, html: str, nohtml: str) -> None:
+    now = utcnow()
+    await email_outbox_col().insert_one({
+        "to": to_email,
+        "subject": subject,
+        "html": html,
+        "text": nohtml,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+    })
+    _wakeup.set()
+
+
+class SendFailure(NamedTuple):
+    error: str
+    permanent: bool  # 5xx or refused recipient: retrying will not help
+
+
+# Rendered content, dropped from the document once the message is sent or has failed for good.
+BODY_FIELDS = {"subject": "", "html": "", "text": ""}
+
+# Errors after which the connection is gone and one retry on a fresh connection is worthwhile.
+# (SMTPException subclasses OSError, so a bare OSError here would catch every SMTP error.)
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)
+
+
+def _describe(e: BaseException) -> str:
+    return f"{type(e).__name__}: {e}"
+
+
+def _close_quietly(conn: Optional[smtplib.SMTP]) -> None:
+    if conn is None:
+        return
+    try:
+        conn.quit()
+    except Exception:
+        conn.close()
+
+
+class SMTPConnectionPool:
+    """Keeps authenticated SMTP connections open between batches."""
+
+    def __init__(self, max_idle: int, idle_timeout_sec: float):
+        self.max_idle = max(0, int(max_idle))
+        self.idle_timeout_sec = float(idle_timeout_sec)
+        self._idle: List[Tuple[float, smtplib.SMTP]] = []
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def acquire(self) -> smtplib.SMTP:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                released_at, conn = self._idle.pop()
+            if time.monotonic() - released_at <= self.idle_timeout_sec:
+                return conn
+            _close_quietly(conn)
+        self.opened += 1
+        return open_smtp_connection()
+
+    def release(self, conn: smtplib.SMTP) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((time.monotonic(), conn))
+                return
+        _close_quietly(conn)
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, conn in idle:
+            _close_quietly(conn)
+
+    def send_batch(self, messages: List[EmailMessage], deadline: Optional[float] = None) -> List[Optional[SendFailure]]:
+        """Send messages over one connection; returns a failure (or None) per message.
+
+        No new message is started after `deadline` (time.monotonic()), so the
+        result can be shorter than `messages`; the first is always tried.
+        """
+        results: List[Optional[SendFailure]] = []
+        conn: Optional[smtplib.SMTP] = None
+        try:
+            for msg in messages:
+                if results and deadline is not None and time.monotonic() >= deadline:
+                    break
+                # A pooled connection may have been dropped by the relay; retry once on a fresh one.
+                for attempt in (0, 1):
+                    if conn is None:
+                        try:
+                            conn = self.acquire()
+                        except Exception as e:
+                            # Relay unreachable: fail the rest of the batch now rather than
+                            # spending a connect timeout on every remaining message.
+                            failure = SendFailure(_describe(e), permanent=False)
+                            results.extend([failure] * (len(messages) - len(results)))
+                            return results
+                    try:
+                        send_message_timed(conn, msg)
+                        results.append(None)
+                    except RECONNECT_ERRORS as e:
+                        _close_quietly(conn)
+                        conn = None
+                        if not attempt:
+                            continue
+                        results.append(SendFailure(_describe(e), permanent=False))
+                    except smtplib.SMTPRecipientsRefused as e:
+                        # Greylisting (4xx for every recipient) is the one refusal worth retrying.
+                        permanent = any(code >= 500 for code, _ in e.recipients.values())
+                        results.append(SendFailure(_describe(e), permanent=permanent))
+                    except smtplib.SMTPResponseException as e:
+                        results.append(SendFailure(_describe(e), permanent=e.smtp_code >= 500))
+                    except smtplib.SMTPException as e:
+                        results.append(SendFailure(_describe(e), permanent=False))
+                    except OSError as e:
+                        # Some other socket error; the connection is not safe to reuse.
+                        _close_quietly(conn)
+                        conn = None
+                        results.append(SendFailure(_describe(e), permanent=False))
+                    break
+        finally:
+            if conn is not None:
+                self.release(conn)
+        return results
+
+
+def _leased(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {"_id": doc["_id"], "lease_token": doc["lease_token"]}
+
+
+def backoff_delay(attempts: int) -> float:
+    delay = min(settings.OUTBOX_BACKOFF_MAX_SEC, settings.OUTBOX_BACKOFF_BASE_SEC * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class OutboxWorker:
+    def __init__(self, pool: SMTPConnectionPool):
+        self.pool = pool
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.deferred = 0
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    async def claim_batch(self) -> List[Dict[str, Any]]:
+        now = utcnow()
+        lease_until = now + timedelta(seconds=settings.OUTBOX_LEASE_SEC)
+        docs: List[Dict[str, Any]] = []
+        for _ in range(settings.OUTBOX_BATCH_SIZE):
+            doc = await email_outbox_col().find_one_and_update(
+                {"$or": [
+                    {"status": "pending", "next_attempt_at": {"$lte": now}},
+                    {"status": "sending", "lease_until": {"$lte": now}},
+                ]},
+                # Counting the attempt at claim time bounds re-sends by a worker that dies mid-send.
+                {"$set": {"status": "sending", "lease_until": lease_until, "lease_token": uuid4().hex},
+                 "$inc": {"attempts": 1}},
+                sort=[("next_attempt_at", ASCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if not doc:
+                break
+            if doc["attempts"] > settings.OUTBOX_MAX_ATTEMPTS:
+                # Its last attempt's lease ran out without a result.
+                self.failed += 1
+                await email_outbox_col().update_one(_leased(doc), {
+                    "$set": {
+                        "status": "failed",
+                        "attempts": settings.OUTBOX_MAX_ATTEMPTS,
+                        "last_error": "lease expired on the final attempt",
+                        "expires_at": now + timedelta(hours=settings.OUTBOX_RETENTION_HOURS),
+                    },
+                    "$unset": {"lease_until": "", "lease_token": "", **BODY_FIELDS},
+                })
+                continue
+            observe_queue_time("email_outbox", (now - doc["next_attempt_at"]).total_seconds())
+            docs.append(doc)
+        return docs
+
+    async def process_batch(self, docs: List[Dict[str, Any]], deadline: Optional[float] = None) -> None:
+        messages = [build_message(d["to"], d["subject"], d["html"], d["text"]) for d in docs]
+        errors = await asyncio.to_thread(self.pool.send_batch, messages, deadline)
+
+        now = utcnow()
+        purge_at = now + timedelta(hours=settings.OUTBOX_RETENTION_HOURS)
+        ops = []
+        for doc, failure in zip(docs, errors):
+            attempts = doc["attempts"]
+            unset = {"lease_until": "", "lease_token": ""}
+            if failure is None:
+                self.sent += 1
+                update = {"status": "sent", "sent_at": now, "expires_at": purge_at}
+                unset.update(BODY_FIELDS)
+            elif failure.permanent or attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                self.failed += 1
+                log.warning("giving up on email %s after %d attempts: %s", doc["_id"], attempts, failure.error)
+                update = {"status": "failed", "last_error": failure.error, "expires_at": purge_at}
+                unset.update(BODY_FIELDS)
+            else:
+                self.retried += 1
+                update = {
+                    "status": "pending",
+                    "last_error": failure.error,
+                    "next_attempt_at": now + timedelta(seconds=backoff_delay(attempts)),
+                }
+            # A worker whose lease ran out must not overwrite the row's new owner.
+            ops.append(UpdateOne(_leased(doc), {"$set": update, "$unset": unset}))
+        # Not tried before the deadline: hand back without counting the attempt.
+        for doc in docs[len(errors):]:
+            self.deferred += 1
+            ops.append(UpdateOne(_leased(doc), {
+                "$set": {"status": "pending", "next_attempt_at": now},
+                "$inc": {"attempts": -1},
+                "$unset": {"lease_until": "", "lease_token": ""},
+            }))
+        if ops:
+            await email_outbox_col().bulk_write(ops, ordered=False)
+
+    async def run_once(self) -> int:
+        # Leave room for one more send (connect, send and a reconnect) before the lease runs out.
+        deadline = time.monotonic() + settings.OUTBOX_LEASE_SEC - 4 * settings.SMTP_TIMEOUT_SEC
+        docs = await self.claim_batch()
+        if docs:
+            await self.process_batch(docs, deadline)
+        return len(docs)
+
+    async def _loop(self) -> None:
+        while not self._stopping:
+            try:
+                if await self.run_once():
+                    continue
+            except Exception:
+                log.exception("email outbox batch failed")
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=settings.OUTBOX_POLL_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        self._stopping = False
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._loop()) for _ in range(max(1, settings.OUTBOX_CONCURRENCY))]
+
+    async def stop(self) -> None:
+        self._stopping = True
+        _wakeup.set()
+        # Let in-flight batches finish; anything still leased is re-sent after OUTBOX_LEASE_SEC.
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=settings.SMTP_TIMEOUT_SEC)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.to_thread(self.pool.close_all)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "deferred": self.deferred,
+            "smtp_connections_opened": self.pool.opened,
+        }
+
+
+async def outbox_depth() -> Dict[str, int]:
+    """Message counts per status, e.g. {"pending": 3, "sending": 1, ...}."""
+    cursor = await email_outbox_col().aggregate([{"$group": {"_id": "$status", "n": {"$sum": 1}}}])
+    return {doc["_id"]: int(doc["n"]) async for doc in cursor}
+
+
+outbox_worker = OutboxWorker(
+    SMTPConnectionPool(max_idle=settings.SMTP_POOL_SIZE, idle_timeout_sec=settings.SMTP_IDLE_TIMEOUT_SEC)
+)
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+import bcrypt
+from fastapi import HTTPException
+
+from .config import get_settings
+from .metrics import ENABLED as METRICS_ENABLED, observe_queue_time
+
+settings = get_settings()
+
+_executor: Optional[Executor] = None
+_pending = 0
+
+
+def bcrypt_hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=rounds)).decode("utf-8")
+
+
+def bcrypt_verify(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+def bcrypt_cost(hashed: str) -> Optional[int]:
+    # "$2b$12$<salt+hash>" -> 12
+    parts = (hashed or "").split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def _timed_call(fn: Callable[..., Any], submitted_at: float, *args: Any) -> Tuple[float, Any]:
+    # Runs in the pool worker; wall-clock time is comparable across processes.
+    return time.time() - submitted_at, fn(*args)
+
+
+def pool_size() -> int:
+    return settings.HASH_POOL_SIZE or os.cpu_count() or 1
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if settings.HASH_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=pool_size())
+        else:
+            _executor = ThreadPoolExecutor(max_workers=pool_size(), thread_name_prefix="hashing")
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run_hashing(fn: Callable[..., Any], *args: Any) -> Any:
+    """Run a bcrypt call on the hashing pool, shedding load when its queue is full."""
+    global _pending
+    if _pending >= settings.HASH_QUEUE_MAX:
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy, please retry",
+            headers={"Retry-After": "1"},
+        )
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        if not METRICS_ENABLED:
+            return await loop.run_in_executor(get_executor(), fn, *args)
+        waited, result = await loop.run_in_executor(get_executor(), _timed_call, fn, time.time(), *args)
+        observe_queue_time("hashing", waited)
+        return result
+    finally:
+        _pending -= 1
+
+
+def queue_depth() -> int:
+    return _pending
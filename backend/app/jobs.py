@@ -0,0 +1,291 @@
+"""Persistent background job queue.
+
+Callers `enqueue_job`, which only inserts into the `jobs` collection.
+`JobWorker` claims due jobs one at a time per slot with `find_one_and_update`
+and a lease. While a handler runs, the lease is extended. Failures are
+retried with exponential backoff. If the lease cannot be renewed the handler
+is cancelled, since another worker may pick the job up. After
+JOB_MAX_ATTEMPTS the job is marked `dead` and kept for
+JOB_DEAD_RETENTION_HOURS for inspection and `requeue_dead_jobs`.
+
+A job enqueued with a `key` is deduplicated: while one with the same key is
+pending or running, enqueueing another is a no-op (unique `active_key`,
+removed when the job finishes).
+
+Handlers register with `@job_handler("type")` and take the job's payload.
+The worker runs inside the API process when JOB_WORKER_IN_API is on, or on
+its own with `python -m app.worker`.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+from uuid import uuid4
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .config import get_settings
+from .db import jobs_col, utcnow
+from .metrics import observe_queue_time
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+Handler = Callable[[Dict[str, Any]], Awaitable[None]]
+_handlers: Dict[str, Handler] = {}
+_wakeup = asyncio.Event()
+
+
+def job_handler(job_type: str) -> Callable[[Handler], Handler]:
+    def register(fn: Handler) -> Handler:
+        _handlers[job_type] = fn
+        return fn
+    return register
+
+
+async def enqueue_job(
+    job_type: str,
+    payload: Dict[str, Any],
+    key: Optional[str] = None,
+    delay_sec: float = 0,
+    max_attempts: Optional[int] = None,
+) -> bool:
+    """Queue a job; False if a job with the same key is already pending or running."""
+    now = utcnow()
+    doc = {
+        "type": job_type,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "max_attempts": max_attempts or settings.JOB_MAX_ATTEMPTS,
+        "next_attempt_at": now + timedelta(seconds=delay_sec),
+        "created_at": now,
+    }
+    if key is not None:
+        doc["active_key"] = key
+    try:
+        await jobs_col().insert_one(doc)
+    except DuplicateKeyError:
+        return False
+    _wakeup.set()
+    return True
+
+
+def backoff_delay(attempts: int) -> float:
+    delay = min(settings.JOB_BACKOFF_MAX_SEC, settings.JOB_BACKOFF_BASE_SEC * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class JobWorker:
+    def __init__(self):
+        self.types: Optional[List[str]] = None
+        self.succeeded = 0
+        self.retried = 0
+        self.dead = 0
+        self.aborted = 0
+        self.running = 0
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    async def claim(self) -> Optional[Dict[str, Any]]:
+        now = utcnow()
+        due = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "running", "lease_until": {"$lte": now}},
+        ]}
+        if self.types is not None:
+            due["type"] = {"$in": self.types}
+        doc = await jobs_col().find_one_and_update(
+            due,
+            {
+                "$set": {
+                    "status": "running",
+                    "owner": WORKER_ID,
+                    "lease_token": uuid4().hex,
+                    "lease_until": now + timedelta(seconds=settings.JOB_LEASE_SEC),
+                    "started_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("next_attempt_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc:
+            observe_queue_time(f"job:{doc['type']}", (now - doc["next_attempt_at"]).total_seconds())
+        return doc
+
+    async def _keep_leased(self, doc: Dict[str, Any]) -> None:
+        """Extend the lease while the handler runs; returns once the lease is gone.
+
+        A failed renewal is retried on the next beat as long as the last good
+        lease has not run out. A renewal that matches nothing means another
+        worker reclaimed the job.
+        """
+        loop = asyncio.get_running_loop()
+        interval = max(1.0, settings.JOB_LEASE_SEC / 3)
+        lease_end = loop.time() + settings.JOB_LEASE_SEC
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                result = await jobs_col().update_one(
+                    {"_id": doc["_id"], "lease_token": doc["lease_token"]},
+                    {"$set": {"lease_until": utcnow() + timedelta(seconds=settings.JOB_LEASE_SEC)}},
+                )
+            except Exception as e:
+                if loop.time() + interval >= lease_end:
+                    log.error("job %s (%s): lease renewal failed, giving up: %s", doc["_id"], doc["type"], e)
+                    return
+                log.warning("job %s (%s): lease renewal failed, retrying: %s", doc["_id"], doc["type"], e)
+                continue
+            if result.matched_count == 0:
+                log.error("job %s (%s): lease lost to another worker", doc["_id"], doc["type"])
+                return
+            lease_end = loop.time() + settings.JOB_LEASE_SEC
+
+    async def _finish(self, doc: Dict[str, Any], update: Dict[str, Any], keep_key: bool = False) -> None:
+        unset = {"lease_until": "", "lease_token": ""}
+        if not keep_key:
+            unset["active_key"] = ""
+        # Matching the lease token keeps a worker that lost its lease from overwriting the new owner.
+        await jobs_col().update_one(
+            {"_id": doc["_id"], "lease_token": doc["lease_token"]},
+            {"$set": {**update, "updated_at": utcnow()}, "$unset": unset},
+        )
+
+    async def run_job(self, doc: Dict[str, Any]) -> None:
+        handler = _handlers.get(doc["type"])
+        if handler is None:
+            self.dead += 1
+            log.error("no handler for job type %s (job %s)", doc["type"], doc["_id"])
+            await self._finish(doc, {
+                "status": "dead",
+                "last_error": "no handler registered",
+                "expires_at": utcnow() + timedelta(hours=settings.JOB_DEAD_RETENTION_HOURS),
+            })
+            return
+
+        self.running += 1
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(handler(doc.get("payload") or {}))
+        heartbeat = loop.create_task(self._keep_leased(doc))
+        try:
+            await asyncio.wait({task, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                # Without a lease another worker may already be running the job: stop this copy
+                # and leave the job document to whoever holds the lease now.
+                self.aborted += 1
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                log.error("job %s (%s) aborted: lease could not be renewed", doc["_id"], doc["type"])
+                return
+            task.result()
+        except asyncio.CancelledError:
+            # Shutting down: hand the job straight back instead of waiting out the lease.
+            task.cancel()
+            await asyncio.shield(self._finish(
+                doc, {"status": "pending", "attempts": max(0, doc["attempts"] - 1), "next_attempt_at": utcnow()},
+                keep_key=True,
+            ))
+            raise
+        except Exception as e:
+            err = f"{type(e).__name__}: {e}"
+            now = utcnow()
+            if doc["attempts"] >= doc.get("max_attempts", settings.JOB_MAX_ATTEMPTS):
+                self.dead += 1
+                log.warning("job %s (%s) dead after %d attempts: %s", doc["_id"], doc["type"], doc["attempts"], err)
+                await self._finish(doc, {
+                    "status": "dead",
+                    "last_error": err,
+                    "expires_at": now + timedelta(hours=settings.JOB_DEAD_RETENTION_HOURS),
+                })
+            else:
+                self.retried += 1
+                log.info("job %s (%s) failed, retrying: %s", doc["_id"], doc["type"], err)
+                await self._finish(doc, {
+                    "status": "pending",
+                    "last_error": err,
+                    "next_attempt_at": now + timedelta(seconds=backoff_delay(doc["attempts"])),
+                }, keep_key=True)
+        else:
+            self.succeeded += 1
+            now = utcnow()
+            await self._finish(doc, {
+                "status": "done",
+                "finished_at": now,
+                "expires_at": now + timedelta(hours=settings.JOB_RETENTION_HOURS),
+            })
+        finally:
+            self.running -= 1
+            heartbeat.cancel()
+
+    async def _loop(self) -> None:
+        while not self._stopping:
+            try:
+                doc = await self.claim()
+                if doc:
+                    await self.run_job(doc)
+                    continue
+            except Exception:
+                log.exception("job worker iteration failed")
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=settings.JOB_POLL_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, concurrency: Optional[int] = None, types: Optional[Iterable[str]] = None) -> None:
+        self._stopping = False
+        self.types = sorted(types) if types else None
+        loop = asyncio.get_running_loop()
+        slots = max(1, concurrency or settings.JOB_WORKER_CONCURRENCY)
+        self._tasks = [loop.create_task(self._loop()) for _ in range(slots)]
+
+    async def stop(self) -> None:
+        self._stopping = True
+        _wakeup.set()
+        # Let running jobs finish; whatever is cut off goes back to pending.
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=settings.JOB_SHUTDOWN_GRACE_SEC)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "dead": self.dead,
+            "aborted": self.aborted,
+        }
+
+
+async def job_depth() -> Dict[str, int]:
+    """Job counts per (type, status), e.g. {"quest_fill:pending": 3, ...}."""
+    cursor = await jobs_col().aggregate([
+        {"$group": {"_id": {"type": "$type", "status": "$status"}, "n": {"$sum": 1}}},
+    ])
+    return {f"{doc['_id']['type']}:{doc['_id']['status']}": int(doc["n"]) async for doc in cursor}
+
+
+async def requeue_dead_jobs(job_type: Optional[str] = None) -> int:
+    """Give dead jobs a fresh set of attempts."""
+    query: Dict[str, Any] = {"status": "dead"}
+    if job_type:
+        query["type"] = job_type
+    result = await jobs_col().update_many(
+        query,
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": utcnow()}, "$unset": {"expires_at": ""}},
+    )
+    if result.modified_count:
+        _wakeup.set()
+    return result.modified_count
+
+
+job_worker = JobWorker()
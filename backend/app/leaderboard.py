@@ -0,0 +1,302 @@
+"""Materialized leaderboards.
+
+Each (board, period) has a snapshot document in `leaderboard_snapshots` with
+the top N entries and a score histogram. Snapshots are rebuilt periodically by
+one worker at a time. Every process caches them in memory, so top-N pages and
+rank lookups don't touch the database. Ranks outside the top N are
+interpolated from the histogram. `record_quest_completion` applies each
+completion to the weekly counters and to the cached snapshots right away.
+
+`get_snapshot` reloads a stale snapshot at most once at a time per process,
+and serves the stale copy meanwhile. Only a process with no copy at all
+waits, and concurrent requests share that one load (or, if the document is
+missing, that one build).
+"""
+import asyncio
+import bisect
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo import DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .config import get_settings
+from .db import users_col, leaderboard_weekly_col, leaderboard_snapshots_col, utcnow
+from .timeutil import week_key
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+# board -> (score field, sort) for the all-time boards over users
+GLOBAL_BOARDS: Dict[str, Tuple[str, List[Tuple[str, int]]]] = {
+    "level": ("progress.level", [("progress.level", DESCENDING), ("progress.xp_total", DESCENDING)]),
+    "xp": ("progress.xp_total", [("progress.xp_total", DESCENDING)]),
+    "coins": ("wallet.coins_balance", [("wallet.coins_balance", DESCENDING)]),
+}
+# board -> secondary sort field; kept on snapshot entries as "tiebreak" so the
+# in-memory order matches the query's.
+GLOBAL_TIEBREAKS: Dict[str, str] = {
+    "level": "progress.xp_total",
+}
+# board -> score field for the per-week boards over leaderboard_weekly
+WEEKLY_BOARDS: Dict[str, str] = {
+    "xp": "xp",
+    "coins": "coins",
+}
+PERIODS = ("global", "weekly")
+
+
+def snapshot_id(board: str, period: str, week: Optional[str] = None) -> str:
+    return f"{board}:{period}:{week}" if period == "weekly" else f"{board}:{period}"
+
+
+def _get_path(doc: Dict[str, Any], path: str, default=0):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return default
+        doc = doc.get(part)
+    return default if doc is None else doc
+
+
+class Snapshot:
+    def __init__(self, doc: Dict[str, Any]):
+        self.id = doc["_id"]
+        self.generated_at = doc.get("generated_at")
+        self.total = int(doc.get("total", 0))
+        self.top: List[Dict[str, Any]] = list(doc.get("top") or [])
+        self.loaded_at = time.monotonic()
+        self._reindex()
+
+        # Histogram buckets arrive ascending by score; keep them descending with
+        # cumulative counts of everyone strictly above each bucket.
+        buckets = sorted(doc.get("buckets") or [], key=lambda b: b["min"], reverse=True)
+        self._neg_mins = [-b["min"] for b in buckets]
+        self._buckets = buckets
+        self._above: List[int] = []
+        running = 0
+        for b in buckets:
+            self._above.append(running)
+            running += int(b["count"])
+
+    def _reindex(self) -> None:
+        # build_snapshot's sort (score, then tiebreak), with user id fixing the order of exact ties
+        # so every process ranks them the same way.
+        self.top.sort(key=lambda e: (-e["score"], -e.get("tiebreak", 0), e["user_id"]))
+        del self.top[settings.LEADERBOARD_TOP_N:]
+        self._rank_by_user = {e["user_id"]: i + 1 for i, e in enumerate(self.top)}
+
+    def page(self, offset: int, limit: int) -> List[Dict[str, Any]]:
+        return [
+            {**e, "rank": offset + i + 1}
+            for i, e in enumerate(self.top[offset:offset + limit])
+        ]
+
+    def rank_of(self, user_id, score: float) -> Tuple[int, bool]:
+        """(rank, approximate) — exact inside the top N, histogram estimate outside."""
+        rank = self._rank_by_user.get(user_id)
+        if rank is not None:
+            return rank, False
+        if len(self.top) < settings.LEADERBOARD_TOP_N:
+            # Top list holds everyone with a score, so anyone else ranks after it.
+            return bisect.bisect_left([-e["score"] for e in self.top], -score) + 1, False
+        if not self._buckets:
+            return len(self.top) + 1, True
+        i = bisect.bisect_left(self._neg_mins, -score)
+        i = min(i, len(self._buckets) - 1)
+        b = self._buckets[i]
+        span = float(b["max"] - b["min"]) or 1.0
+        within = max(0.0, min(1.0, (b["max"] - score) / span)) * int(b["count"])
+        rank = int(self._above[i] + within) + 1
+        return max(rank, len(self.top) + 1), True
+
+    def apply(self, user_id, name: str, score: float, tiebreak: float = 0) -> None:
+        """Reflect a score change locally until the next refresh."""
+        if user_id not in self._rank_by_user:
+            if len(self.top) >= settings.LEADERBOARD_TOP_N and (score, tiebreak) <= (
+                self.top[-1]["score"], self.top[-1].get("tiebreak", 0)
+            ):
+                return
+            self.top.append({"user_id": user_id, "name": name, "score": score, "tiebreak": tiebreak})
+            self.total = max(self.total, len(self.top))
+        else:
+            for e in self.top:
+                if e["user_id"] == user_id:
+                    e["score"] = score
+                    e["tiebreak"] = tiebreak
+                    break
+        self._reindex()
+
+
+_snapshots: Dict[str, Snapshot] = {}
+_loads: Dict[str, "asyncio.Task[Snapshot]"] = {}
+
+
+async def _score_buckets(col, match: Dict[str, Any], field: str) -> List[Dict[str, Any]]:
+    cursor = await col.aggregate([
+        {"$match": match},
+        {"$bucketAuto": {"groupBy": f"${field}", "buckets": settings.LEADERBOARD_RANK_BUCKETS}},
+    ], allowDiskUse=True)
+    return [
+        {"min": d["_id"]["min"], "max": d["_id"]["max"], "count": d["count"]}
+        async for d in cursor
+    ]
+
+
+async def build_snapshot(board: str, period: str, week: Optional[str] = None) -> Dict[str, Any]:
+    top_n = settings.LEADERBOARD_TOP_N
+    if period == "global":
+        field, sort = GLOBAL_BOARDS[board]
+        tiebreak = GLOBAL_TIEBREAKS.get(board)
+        col, match = users_col(), {field: {"$gt": 0}}
+        projection = {"name": 1, field: 1, **({tiebreak: 1} if tiebreak else {})}
+        docs = await col.find(match, projection).sort(sort).limit(top_n).to_list(length=top_n)
+        top = [{"user_id": d["_id"], "name": d.get("name", ""), "score": _get_path(d, field)} for d in docs]
+        if tiebreak:
+            for entry, d in zip(top, docs):
+                entry["tiebreak"] = _get_path(d, tiebreak)
+    else:
+        field = WEEKLY_BOARDS[board]
+        col, match = leaderboard_weekly_col(), {"week": week, field: {"$gt": 0}}
+        docs = await col.find(match, {"user_id": 1, "name": 1, field: 1}) \
+            .sort([(field, DESCENDING)]).limit(top_n).to_list(length=top_n)
+        top = [{"user_id": d["user_id"], "name": d.get("name", ""), "score": d.get(field, 0)} for d in docs]
+
+    total = await col.count_documents(match)
+    buckets = await _score_buckets(col, match, field) if total > len(top) else []
+    doc = {
+        "_id": snapshot_id(board, period, week),
+        "board": board,
+        "period": period,
+        "week": week,
+        "generated_at": utcnow(),
+        "total": total,
+        "top": top,
+        "buckets": buckets,
+    }
+    await leaderboard_snapshots_col().replace_one({"_id": doc["_id"]}, doc, upsert=True)
+    _snapshots[doc["_id"]] = Snapshot(doc)
+    return doc
+
+
+def all_boards():
+    week = week_key()
+    for board in GLOBAL_BOARDS:
+        yield board, "global", None
+    for board in WEEKLY_BOARDS:
+        yield board, "weekly", week
+
+
+async def _claim_refresh() -> bool:
+    now = utcnow()
+    try:
+        await leaderboard_snapshots_col().update_one(
+            {"_id": "refresh_lease", "expires_at": {"$lte": now}},
+            {"$set": {"expires_at": now + timedelta(seconds=settings.LEADERBOARD_REFRESH_SEC)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def refresh_all(force: bool = False) -> bool:
+    """Rebuild every snapshot if this worker wins the refresh lease."""
+    if not force and not await _claim_refresh():
+        return False
+    for board, period, week in all_boards():
+        await build_snapshot(board, period, week)
+    return True
+
+
+async def _load_snapshot(board: str, period: str, week: Optional[str], sid: str) -> Snapshot:
+    doc = await leaderboard_snapshots_col().find_one({"_id": sid})
+    if doc is None:
+        doc = await build_snapshot(board, period, week)
+    snap = _snapshots[sid] = Snapshot(doc)
+    return snap
+
+
+def _load_done(sid: str, task: "asyncio.Task[Snapshot]") -> None:
+    _loads.pop(sid, None)
+    if not task.cancelled() and task.exception() is not None:
+        log.warning("loading leaderboard snapshot %s failed", sid, exc_info=task.exception())
+
+
+async def get_snapshot(board: str, period: str) -> Snapshot:
+    week = week_key() if period == "weekly" else None
+    sid = snapshot_id(board, period, week)
+    snap = _snapshots.get(sid)
+    if snap and time.monotonic() - snap.loaded_at < settings.LEADERBOARD_REFRESH_SEC:
+        return snap
+    task = _loads.get(sid)
+    if task is None:
+        task = _loads[sid] = asyncio.get_running_loop().create_task(_load_snapshot(board, period, week, sid))
+        task.add_done_callback(lambda t: _load_done(sid, t))
+    if snap is not None:
+        return snap
+    # Shielded so a cancelled request does not cancel the load the others are waiting on.
+    return await asyncio.shield(task)
+
+
+async def current_score(user_id, board: str, period: str) -> float:
+    if period == "global":
+        field, _ = GLOBAL_BOARDS[board]
+        doc = await users_col().find_one({"_id": user_id}, {field: 1}) or {}
+        return _get_path(doc, field)
+    field = WEEKLY_BOARDS[board]
+    doc = await leaderboard_weekly_col().find_one({"week": week_key(), "user_id": user_id}, {field: 1}) or {}
+    return doc.get(field, 0)
+
+
+async def record_quest_completion(user_id, name: str, user_after: Dict[str, Any], xp: int, coins: int) -> None:
+    """Apply a completed quest to the weekly counters and the cached snapshots."""
+    now = utcnow()
+    week = week_key(now)
+    weekly = await leaderboard_weekly_col().find_one_and_update(
+        {"week": week, "user_id": user_id},
+        {
+            "$inc": {"xp": xp, "coins": coins, "quests": 1},
+            "$set": {"name": name, "updated_at": now, "expires_at": now + timedelta(weeks=settings.LEADERBOARD_WEEKS_KEPT)},
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+    scores = {
+        snapshot_id("level", "global"): _get_path(user_after, "progress.level", 1),
+        snapshot_id("xp", "global"): _get_path(user_after, "progress.xp_total"),
+        snapshot_id("coins", "global"): _get_path(user_after, "wallet.coins_balance"),
+        snapshot_id("xp", "weekly", week): weekly.get("xp", 0),
+        snapshot_id("coins", "weekly", week): weekly.get("coins", 0),
+    }
+    tiebreaks = {snapshot_id("level", "global"): _get_path(user_after, "progress.xp_total")}
+    for sid, score in scores.items():
+        snap = _snapshots.get(sid)
+        if snap is not None:
+            snap.apply(user_id, name, score, tiebreaks.get(sid, 0))
+
+
+class LeaderboardRefresher:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await refresh_all()
+            except Exception:
+                log.exception("leaderboard refresh failed")
+            await asyncio.sleep(settings.LEADERBOARD_REFRESH_SEC)
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+leaderboard_refresher = LeaderboardRefresher()
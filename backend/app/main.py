@@ -1,12 +1,54 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 from .config import get_settings
+from .db import ensure_indexes, close_client
+from .hashing import shutdown_executor
+from .email.outbox import outbox_worker
+from .jobs import job_worker
+from .leaderboard import leaderboard_refresher
+from .quest_progress import progress_buffer
+from .quest_events import quest_change_watcher
+from .rate_limit import RateLimitMiddleware, rate_limiter
+from .metrics import MetricsMiddleware, router as metrics_router
 from .routes.auth_routes import router as auth_router
 from .routes.protected_routes import router as protected_router
+from .routes.leaderboard_routes import router as leaderboard_router
+from .routes.workout_routes import router as workout_router
+from .routes.stats_routes import router as stats_router
 
 settings = get_settings()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    if settings.ENSURE_INDEXES_ON_STARTUP:
+        await ensure_indexes()
+    if settings.OUTBOX_WORKER_ENABLED:
+        outbox_worker.start()
+    if settings.JOB_WORKER_IN_API:
+        job_worker.start()
+    if settings.LEADERBOARD_ENABLED:
+        leaderboard_refresher.start()
+    if settings.RATE_LIMIT_ENABLED:
+        rate_limiter.start()
+    progress_buffer.start()
+    if settings.QUEST_EVENTS_CHANGE_STREAM:
+        quest_change_watcher.start()
+    yield
+    await quest_change_watcher.stop()
+    await progress_buffer.stop()
+    await rate_limiter.stop()
+    await leaderboard_refresher.stop()
+    await job_worker.stop()
+    await outbox_worker.stop()
+    shutdown_executor()
+    await close_client()
+
+app = FastAPI(lifespan=lifespan)
+
+if settings.RATE_LIMIT_ENABLED:
+    # Added before CORS so 429 responses still carry CORS headers.
+    app.add_middleware(RateLimitMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,9 +58,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics_router)
+
 app.include_router(auth_router)
 app.include_router(protected_router)
+app.include_router(leaderboard_router)
+app.include_router(workout_router)
+app.include_router(stats_router)
 
 @app.get("/")
-def root():
+async def root():
     return {"ok": True}
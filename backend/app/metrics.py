@@ -0,0 +1,260 @@
+"""Prometheus instrumentation.
+
+Enabled with METRICS_ENABLED. When it is off, nothing is installed: no
+middleware, no pymongo command listener, no /metrics route, and the
+`observe_*` helpers return immediately.
+
+* `MetricsMiddleware`: latency per route template, plus the number and total
+  time of Mongo commands each request issued (tracked through a contextvar
+  that the command listener updates).
+* `MongoCommandMetrics`: pymongo CommandListener passed to the client in db.py.
+* `observe_llm_call`, `observe_llm_retry`, `observe_llm_parse`, `observe_smtp`,
+  `observe_queue_time`: called from the model, mail and background-task code
+  paths.
+* `StatsCollector`: reads the existing in-process `stats()` (session cache,
+  quest cache, outbox, job worker, rate limiter, progress buffer, quest events, model
+  circuit breaker, hashing queue) at scrape time, so those cost nothing
+  between scrapes.
+* `refresh_queue_depth`: the /metrics route counts outbox and job documents
+  per status before rendering. The queues are shared, so any API process
+  reports the same depth; `python -m app.worker --metrics-port` does not
+  serve it.
+
+With several worker processes each one serves its own /metrics; scrape them
+individually or run prometheus_client in multiprocess mode.
+"""
+import contextvars
+import logging
+import time
+from typing import Any, Dict, Iterable, Optional
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+from .config import get_settings
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+ENABLED = settings.METRICS_ENABLED
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+HTTP_MONGO_COMMANDS = Histogram(
+    "http_request_mongo_commands", "Mongo commands issued per HTTP request.",
+    ["method", "route"], buckets=COUNT_BUCKETS,
+)
+HTTP_MONGO_SECONDS = Histogram(
+    "http_request_mongo_seconds", "Time spent in Mongo commands per HTTP request.",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+MONGO_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "Mongo command latency.",
+    ["command", "outcome"], buckets=LATENCY_BUCKETS,
+)
+LLM_LATENCY = Histogram(
+    "llm_request_duration_seconds", "Model call latency.",
+    ["model", "outcome"], buckets=LATENCY_BUCKETS,
+)
+LLM_RETRIES = Counter("llm_retries_total", "Model calls retried after a failed or short batch.", ["reason"])
+LLM_PARSE = Counter(
+    "llm_response_parse_total",
+    "Model replies by parse result: valid, extracted (array dug out of fences/prose), salvaged (invalid items dropped), invalid.",
+    ["outcome"],
+)
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens reported by model responses.", ["model", "kind"])
+LLM_CALL_TOKENS = Histogram(
+    "llm_call_tokens", "Tokens per model call (input, cached_input, output).",
+    ["model", "kind"], buckets=(25, 50, 100, 200, 400, 800, 1600, 3200, 6400),
+)
+SMTP_LATENCY = Histogram(
+    "smtp_operation_duration_seconds", "SMTP connect/send latency.",
+    ["operation", "outcome"], buckets=LATENCY_BUCKETS,
+)
+QUEUE_DEPTH = Gauge(
+    "background_queue_depth", "Documents per status in the Mongo-backed queues, read at scrape time.", ["queue", "status"]
+)
+QUEUE_TIME = Histogram(
+    "background_queue_seconds", "Time work waited before a background worker picked it up.",
+    ["queue"], buckets=LATENCY_BUCKETS + (60, 300, 900),
+)
+
+
+class _RequestStats:
+    __slots__ = ("commands", "mongo_seconds")
+
+    def __init__(self):
+        self.commands = 0
+        self.mongo_seconds = 0.0
+
+
+_request_stats: contextvars.ContextVar[Optional[_RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def _record(self, event, outcome: str) -> None:
+        seconds = event.duration_micros / 1e6
+        MONGO_LATENCY.labels(event.command_name, outcome).observe(seconds)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.commands += 1
+            stats.mongo_seconds += seconds
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._record(event, "ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._record(event, "error")
+
+
+def mongo_event_listeners() -> list:
+    return [MongoCommandMetrics()] if ENABLED else []
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and attributes the Mongo commands it issued."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == settings.METRICS_PATH:
+            return await self.app(scope, receive, send)
+
+        status = 500
+        stats = _RequestStats()
+        token = _request_stats.set(stats)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_stats.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            HTTP_LATENCY.labels(method, route, str(status)).observe(time.perf_counter() - started)
+            HTTP_MONGO_COMMANDS.labels(method, route).observe(stats.commands)
+            HTTP_MONGO_SECONDS.labels(method, route).observe(stats.mongo_seconds)
+
+
+def observe_llm_call(model: str, seconds: float, outcome: str, usage: Any = None) -> None:
+    if not ENABLED:
+        return
+    LLM_LATENCY.labels(model, outcome).observe(seconds)
+    if usage is None:
+        return
+    counts = {
+        "input": getattr(usage, "input_tokens", None),
+        "cached_input": getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None),
+        "output": getattr(usage, "output_tokens", None),
+    }
+    for kind, tokens in counts.items():
+        if tokens is None:
+            continue
+        LLM_CALL_TOKENS.labels(model, kind).observe(tokens)
+        if tokens:
+            LLM_TOKENS.labels(model, kind).inc(tokens)
+
+
+def observe_llm_retry(reason: str) -> None:
+    if ENABLED:
+        LLM_RETRIES.labels(reason).inc()
+
+
+def observe_llm_parse(outcome: str) -> None:
+    if ENABLED:
+        LLM_PARSE.labels(outcome).inc()
+
+
+def observe_smtp(operation: str, seconds: float, outcome: str) -> None:
+    if ENABLED:
+        SMTP_LATENCY.labels(operation, outcome).observe(seconds)
+
+
+def observe_queue_time(queue: str, seconds: float) -> None:
+    if ENABLED:
+        QUEUE_TIME.labels(queue).observe(max(0.0, seconds))
+
+
+class StatsCollector:
+    """Exposes the components' own stats() counters as gauges at scrape time."""
+
+    def _sources(self) -> Dict[str, Dict[str, Any]]:
+        from .session_cache import session_cache
+        from .ai.quest_cache import quest_cache
+        from .email.outbox import outbox_worker
+        from .jobs import job_worker
+        from .rate_limit import rate_limiter
+        from .quest_progress import progress_buffer
+        from .quest_events import quest_events
+        from .ai.circuit_breaker import model_breaker
+        from .hashing import queue_depth
+        return {
+            "session_cache": session_cache.stats(),
+            "quest_cache": quest_cache.stats(),
+            "email_outbox": outbox_worker.stats(),
+            "job_worker": job_worker.stats(),
+            "rate_limiter": rate_limiter.stats(),
+            "quest_progress_buffer": progress_buffer.stats(),
+            "quest_events": quest_events.stats(),
+            "llm_breaker": model_breaker.stats(),
+            "hashing": {"queue_depth": queue_depth()},
+        }
+
+    def describe(self) -> Iterable[GaugeMetricFamily]:
+        # Metric names depend on the components' stats; skip the registration-time collect().
+        return []
+
+    def collect(self) -> Iterable[GaugeMetricFamily]:
+        for component, stats in self._sources().items():
+            for name, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                yield GaugeMetricFamily(f"app_{component}_{name}", f"{component} {name.replace('_', ' ')}", value=value)
+
+
+router = APIRouter(tags=["metrics"])
+
+
+async def refresh_queue_depth() -> None:
+    """Reset `background_queue_depth` from the outbox and job collections (one aggregation each)."""
+    from .email.outbox import outbox_depth
+    from .jobs import job_depth
+    try:
+        outbox, jobs = await outbox_depth(), await job_depth()
+    except Exception:
+        log.warning("could not read queue depth", exc_info=True)
+        return
+    QUEUE_DEPTH.clear()
+    # Keep the states worth alerting on present at zero.
+    for status in ("pending", "sending"):
+        QUEUE_DEPTH.labels("email_outbox", status).set(0)
+    for status, n in outbox.items():
+        QUEUE_DEPTH.labels("email_outbox", status).set(n)
+    for key, n in jobs.items():
+        job_type, status = key.rsplit(":", 1)
+        QUEUE_DEPTH.labels(f"job:{job_type}", status).set(n)
+
+
+@router.get(settings.METRICS_PATH, include_in_schema=False)
+async def metrics():
+    await refresh_queue_depth()
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
+if ENABLED:
+    REGISTRY.register(StatsCollector())
@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import sys
+from .db import ensure_indexes, drop_retired_indexes, close_client, users_col
+from .quest_history import migrate_completed_history
+from .workout_stats import backfill_rollups
+
+
+async def migrate_indexes(_: argparse.Namespace) -> None:
+    created = await ensure_indexes()
+    if created:
+        for spec_id in created:
+            print(f"applied {spec_id}")
+    else:
+        print("indexes up to date")
+    for spec_id in await drop_retired_indexes():
+        print(f"dropped {spec_id}")
+
+
+async def migrate_quest_history(args: argparse.Namespace) -> None:
+    await ensure_indexes()
+    migrated = await migrate_completed_history(batch_size=args.batch_size)
+    print(f"moved completed quests to quest_history for {migrated} users")
+    if "idx_completed_qid" in await users_col().index_information():
+        await users_col().drop_index("idx_completed_qid")
+        print("dropped users.idx_completed_qid")
+
+
+async def migrate_workout_stats(args: argparse.Namespace) -> None:
+    await ensure_indexes()
+    processed = await backfill_rollups(batch_size=args.batch_size)
+    print(f"rebuilt workout stats for {processed} users")
+
+
+COMMANDS = {
+    "indexes": migrate_indexes,
+    "quest-history": migrate_quest_history,
+    "workout-stats": migrate_workout_stats,
+}
+
+
+async def run(args: argparse.Namespace) -> int:
+    try:
+        await COMMANDS[args.command](args)
+    finally:
+        await close_client()
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.migrate")
+    parser.add_argument("command", nargs="?", default="indexes", choices=sorted(COMMANDS))
+    parser.add_argument("--batch-size", type=int, default=100)
+    return asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,9 @@
-from typing import TypedDict, Literal
-from pydantic import BaseModel, EmailStr, Field
+from typing import TypedDict, Literal, List, Optional
+from pydantic import BaseModel, EmailStr, Field, field_validator
 from datetime import datetime
+from .config import get_settings
+
+settings = get_settings()
 
 
 
@@ -48,3 +51,32 @@ class VerifyEmailRequest(BaseModel):
 
 class ResendVerificationRequest(BaseModel):
     email: EmailStr
+
+class WorkoutSetIn(BaseModel):
+    # Client-supplied dedupe key (e.g. the wearable's sample id); derived from the set's content when omitted.
+    idempotency_key: Optional[str] = Field(default=None, min_length=1, max_length=128)
+    performed_at: datetime
+    exercise: str = Field(min_length=1, max_length=80)
+    reps: Optional[int] = Field(default=None, ge=0, le=10000)
+    weight_lb: Optional[float] = Field(default=None, ge=0, lt=2000)
+    duration_sec: Optional[int] = Field(default=None, ge=0, le=86400)
+    distance_m: Optional[float] = Field(default=None, ge=0, le=1000000)
+    tags: List[str] = Field(default_factory=list, max_length=20)
+    source: Optional[str] = Field(default=None, max_length=40)
+
+    @field_validator("tags")
+    @classmethod
+    def normalize_tags(cls, tags: List[str]) -> List[str]:
+        out: List[str] = []
+        for tag in tags:
+            tag = tag.strip().lower()
+            # Tags become field names in the stats rollups, so no '.' or leading '$'.
+            if not tag or len(tag) > 32 or "." in tag or tag.startswith("$"):
+                raise ValueError("tags must be 1-32 characters, without '.' or a leading '$'")
+            if tag not in out:
+                out.append(tag)
+        return out
+
+class WorkoutBatchIn(BaseModel):
+    # Enforced during validation, which stops at the first item past the limit.
+    items: List[WorkoutSetIn] = Field(min_length=1, max_length=settings.WORKOUT_INGEST_MAX_ITEMS)
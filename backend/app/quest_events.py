@@ -0,0 +1,156 @@
+"""Pushes newly activated quests to connected clients.
+
+`push_active_quests` publishes every quest it adds to `quest_events`, an
+in-process pub/sub keyed by user. `/protected/quests/stream` subscribes and
+relays the events as server-sent events, so a client waiting on a fill holds
+one connection instead of polling `/protected/quests/load`.
+
+A fill can run in a different process from the one holding the client's
+stream (whichever job worker claims the fill job). When QUEST_EVENTS_CHANGE_STREAM
+is on and MongoDB supports change streams (replica set or sharded cluster),
+`QuestChangeWatcher` watches `users` for changes to `quests.active` and
+republishes them locally. Without change streams the in-process bus only
+covers fills run by the API process's own job worker (JOB_WORKER_IN_API).
+Subscribers drop quests they have already sent, so a quest seen through both
+paths is delivered once.
+"""
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, Optional, Set
+from pymongo.errors import OperationFailure
+
+from .config import get_settings
+from .db import users_col
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+# Server codes for "change streams are not available on this deployment".
+CHANGE_STREAM_UNSUPPORTED = {40573, 40324, 20}
+
+
+class QuestEventBus:
+    def __init__(self, queue_size: int):
+        self.queue_size = max(1, int(queue_size))
+        self._subscribers: Dict[Any, Set[asyncio.Queue]] = {}
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user_id) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def has_subscribers(self, user_id) -> bool:
+        return user_id in self._subscribers
+
+    def publish(self, user_id, event: str, data: Dict[str, Any]) -> None:
+        for queue in self._subscribers.get(user_id, ()):
+            try:
+                queue.put_nowait((event, data))
+                self.published += 1
+            except asyncio.QueueFull:
+                # A stalled client loses events; it resyncs from /quests/load on reconnect.
+                self.dropped += 1
+
+    def publish_quests(self, user_id, quests: Iterable[Dict[str, Any]]) -> None:
+        if user_id in self._subscribers:
+            for quest in quests:
+                self.publish(user_id, "quest", quest)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "users": len(self._subscribers),
+            "subscribers": sum(len(q) for q in self._subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+quest_events = QuestEventBus(queue_size=settings.QUEST_EVENTS_QUEUE_SIZE)
+
+# Entries of updateDescription.updatedFields that add or replace whole quests:
+# "quests.active" (the array) or "quests.active.<n>" (one element). Progress
+# `$inc`s show up as "quests.active.<n>.progress" and are left out, so the
+# frequent counter updates never reach this process.
+_QUEST_FIELDS = {"$filter": {
+    "input": {"$objectToArray": "$updateDescription.updatedFields"},
+    "cond": {"$regexMatch": {"input": "$$this.k", "regex": r"^quests\.active(\.[0-9]+)?$"}},
+}}
+_STREAMED = {"quest_id": 1, "title": 1, "type": 1, "started_at": 1, "rewards": 1}
+
+# The added quests are read from the change event itself (no updateLookup of
+# the user document), trimmed to the fields the stream sends.
+_WATCH_PIPELINE = [
+    {"$match": {"operationType": "update", "$expr": {"$gt": [{"$size": _QUEST_FIELDS}, 0]}}},
+    {"$project": {
+        "documentKey": 1,
+        "quests": {"$map": {
+            "input": {"$reduce": {
+                "input": _QUEST_FIELDS,
+                "initialValue": [],
+                "in": {"$concatArrays": [
+                    "$$value", {"$cond": [{"$isArray": "$$this.v"}, "$$this.v", ["$$this.v"]]},
+                ]},
+            }},
+            "as": "q",
+            "in": {k: f"$$q.{k}" for k in _STREAMED},
+        }},
+    }},
+]
+
+
+class QuestChangeWatcher:
+    """Republishes other workers' quest additions from a `users` change stream."""
+
+    def __init__(self, bus: QuestEventBus):
+        self.bus = bus
+        self.supported: Optional[bool] = None
+        self._resume_token = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _watch(self) -> None:
+        stream = await users_col().watch(_WATCH_PIPELINE, resume_after=self._resume_token)
+        async with stream:
+            self.supported = True
+            async for change in stream:
+                self._resume_token = stream.resume_token
+                user_id = change["documentKey"]["_id"]
+                if not self.bus.has_subscribers(user_id):
+                    continue
+                quests = [q for q in change.get("quests") or [] if q.get("quest_id")]
+                self.bus.publish_quests(user_id, quests)
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self._watch()
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED:
+                    self.supported = False
+                    log.info("change streams unavailable (%s); quest events are in-process only", e.code)
+                    return
+                log.warning("quest change stream failed: %s", e)
+                self._resume_token = None
+            except Exception:
+                log.exception("quest change stream interrupted")
+            await asyncio.sleep(5)
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+quest_change_watcher = QuestChangeWatcher(quest_events)
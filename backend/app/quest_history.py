@@ -0,0 +1,124 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from .db import quest_history_col, users_col, utcnow
+
+log = logging.getLogger(__name__)
+
+# How many completed quests stay embedded on the user document (`quests.recent`).
+RECENT_COMPLETED_LIMIT = 10
+
+
+def history_doc(user_id, quest: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "user_id": user_id,
+        "quest_id": quest["quest_id"],
+        "title": quest.get("title"),
+        "type": quest.get("type"),
+        "target": quest.get("target"),
+        "progress": quest.get("progress"),
+        "rewards": quest.get("rewards") or {},
+        "started_at": quest.get("started_at"),
+        "completed_at": quest.get("completed_at") or utcnow(),
+    }
+
+
+async def record_completion(user_id, quest: Dict[str, Any]) -> None:
+    """Idempotent on (user_id, quest_id): a retried or racing completion writes one row."""
+    doc = history_doc(user_id, quest)
+    key = {"user_id": doc.pop("user_id"), "quest_id": doc.pop("quest_id")}
+    try:
+        await quest_history_col().update_one(key, {"$setOnInsert": doc}, upsert=True)
+    except DuplicateKeyError:
+        # Two upserts raced on the unique index; the other one wrote the row.
+        pass
+
+
+async def is_completed(user_id, quest_id: str) -> bool:
+    doc = await quest_history_col().find_one({"user_id": user_id, "quest_id": quest_id}, {"_id": 1})
+    if doc is not None:
+        return True
+    # A completion whose history write was cut off is still on `quests.recent`; write its row now.
+    recent = await users_col().find_one(
+        {"_id": user_id, "quests.recent.quest_id": quest_id}, {"quests.recent.$": 1}
+    )
+    if recent is not None:
+        await record_completion(user_id, recent["quests"]["recent"][0])
+        return True
+    # Until `python -m app.migrate quest-history` has run, older completions are still embedded.
+    legacy = await users_col().find_one(
+        {"_id": user_id, "quests.completed.quest_id": quest_id}, {"_id": 1}
+    )
+    return legacy is not None
+
+
+def encode_cursor(doc: Dict[str, Any], field: str = "completed_at") -> str:
+    return f"{doc[field].isoformat()}_{doc['_id']}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """Parse a cursor from encode_cursor; raises ValueError if malformed."""
+    when, _, oid = cursor.rpartition("_")
+    if not ObjectId.is_valid(oid):
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    return datetime.fromisoformat(when), ObjectId(oid)
+
+
+async def history_page(user_id, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Newest-first page of completed quests plus the cursor for the next page."""
+    query: Dict[str, Any] = {"user_id": user_id}
+    if cursor:
+        completed_at, oid = decode_cursor(cursor)
+        query["$or"] = [
+            {"completed_at": {"$lt": completed_at}},
+            {"completed_at": completed_at, "_id": {"$lt": oid}},
+        ]
+    docs = await quest_history_col().find(query, {"user_id": 0}) \
+        .sort([("completed_at", DESCENDING), ("_id", DESCENDING)]) \
+        .limit(limit + 1) \
+        .to_list(length=limit + 1)
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    return docs[:limit], next_cursor
+
+
+async def migrate_completed_history(batch_size: int = 100) -> int:
+    """Move legacy `quests.completed` arrays into quest_history.
+
+    Safe to run while the API is serving: new completions no longer touch
+    `quests.completed`, and history inserts are idempotent on (user_id, quest_id).
+    Returns the number of users migrated.
+    """
+    migrated = 0
+    while True:
+        users = await users_col().find(
+            {"quests.completed.0": {"$exists": True}}, {"quests.completed": 1}
+        ).limit(batch_size).to_list(length=batch_size)
+        if not users:
+            return migrated
+
+        for user in users:
+            completed = user["quests"]["completed"]
+            docs = [history_doc(user["_id"], q) for q in completed if q.get("quest_id")]
+            if docs:
+                try:
+                    await quest_history_col().insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                        raise
+            tail = completed[-RECENT_COMPLETED_LIMIT:]
+            await users_col().update_one(
+                {"_id": user["_id"]},
+                [
+                    {"$set": {"quests.recent": {"$slice": [
+                        {"$concatArrays": [{"$literal": tail}, {"$ifNull": ["$quests.recent", []]}]},
+                        -RECENT_COMPLETED_LIMIT,
+                    ]}}},
+                    {"$unset": "quests.completed"},
+                ],
+            )
+            migrated += 1
+        log.info("migrated quest history for %d users", migrated)
@@ -0,0 +1,184 @@
+"""Coalescing buffer for high-frequency quest progress.
+
+Step counters and similar sources send many small increments. Instead of one
+update per request, `ProgressBuffer.add` merges them per (user, quest) in
+memory and the flusher writes each merged increment with one unordered
+bulk_write every QUEST_PROGRESS_FLUSH_MS. Quests whose target was reached are
+then completed through the regular completion path.
+
+The buffer lives in process memory and is not durable. A request answered
+with 202 has only been buffered:
+
+* a crash or SIGKILL loses whatever was buffered, normally up to
+  QUEST_PROGRESS_FLUSH_MS worth of increments;
+* failed writes are put back and retried on every flush, but an increment
+  still unwritten QUEST_PROGRESS_MAX_AGE_SEC after it was first buffered is
+  dropped and logged (`dropped` in stats), so a Mongo outage loses at most
+  that window rather than growing the buffer without end;
+* `stop` flushes what is left on a graceful shutdown.
+
+`add` refuses new keys once QUEST_PROGRESS_MAX_PENDING are buffered, and the
+route then writes the increment directly. Clients that cannot tolerate the
+loss window send `coalesce=false`.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .config import get_settings
+from .db import users_col, utcnow
+from .quests import complete_active_quest, target_reached
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+Key = Tuple[Any, str]
+
+
+class ProgressBuffer:
+    def __init__(self, flush_interval_sec: float, max_pending: int):
+        self.flush_interval_sec = flush_interval_sec
+        self.max_pending = max(1, int(max_pending))
+        self._pending: Dict[Key, int] = {}
+        self._names: Dict[Any, str] = {}
+        self._since: Dict[Key, float] = {}  # monotonic time each key was first buffered
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.accepted = 0
+        self.writes = 0  # updates Mongo acknowledged
+        self.write_failures = 0  # updates whose write failed and were put back (or dropped)
+        self.completed = 0
+        self.dropped = 0
+
+    def add(self, user_id, name: str, quest_id: str, amount: int) -> bool:
+        """Buffer an increment; False if the buffer is full and the caller should write it itself."""
+        key = (user_id, quest_id)
+        if key not in self._pending and len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+            return False
+        self._pending[key] = self._pending.get(key, 0) + amount
+        self._since.setdefault(key, time.monotonic())
+        self._names[user_id] = name
+        self.accepted += 1
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+        return True
+
+    def _requeue(self, batch: Dict[Key, int], since: Dict[Key, float]) -> None:
+        expire_before = time.monotonic() - settings.QUEST_PROGRESS_MAX_AGE_SEC
+        expired = []
+        for key, amount in batch.items():
+            first = since.get(key, time.monotonic())
+            if first < expire_before:
+                expired.append((key, amount))
+                continue
+            self._pending[key] = self._pending.get(key, 0) + amount
+            self._since[key] = min(first, self._since.get(key, first))
+        if expired:
+            self.dropped += len(expired)
+            log.error("dropped %d quest progress updates unwritten for over %ss: %r",
+                      len(expired), settings.QUEST_PROGRESS_MAX_AGE_SEC, expired)
+
+    async def flush(self) -> int:
+        """Write everything buffered so far; returns the number of updates acknowledged."""
+        async with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            names, self._names = self._names, {}
+            since, self._since = self._since, {}
+            keys = list(batch)
+            now = utcnow()
+            ops = [
+                UpdateOne(
+                    {"_id": user_id, "quests.active": {"$elemMatch": {"quest_id": quest_id, "type": "counter"}}},
+                    {"$inc": {"quests.active.$.progress": batch[(user_id, quest_id)]}, "$set": {"updated_at": now}},
+                )
+                for user_id, quest_id in keys
+            ]
+            failed: set = set()
+            try:
+                await users_col().bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                failed = {keys[err["index"]] for err in e.details.get("writeErrors", [])}
+                self._requeue({key: batch[key] for key in failed}, since)
+                self._names = {**names, **self._names}
+                log.warning("requeued %d quest progress updates after write errors", len(failed))
+            except Exception:
+                self.write_failures += len(ops)
+                self._requeue(batch, since)
+                self._names = {**names, **self._names}
+                raise
+            self.write_failures += len(failed)
+            written = [key for key in keys if key not in failed]
+            self.writes += len(written)
+
+        if written:
+            await self._complete_reached(written, names)
+        return len(written)
+
+    async def _complete_reached(self, keys: List[Key], names: Dict[Any, str]) -> None:
+        touched: Dict[Any, set] = {}
+        for user_id, quest_id in keys:
+            touched.setdefault(user_id, set()).add(quest_id)
+        docs = await users_col().find(
+            {"_id": {"$in": list(touched)}},
+            {"quests.active.quest_id": 1, "quests.active.progress": 1, "quests.active.target": 1},
+        ).to_list(length=None)
+        for doc in docs:
+            for quest in (doc.get("quests") or {}).get("active") or []:
+                if quest.get("quest_id") in touched[doc["_id"]] and target_reached(quest):
+                    if await complete_active_quest(doc["_id"], names.get(doc["_id"], ""), quest["quest_id"]):
+                        self.completed += 1
+
+    async def _loop(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("quest progress flush failed")
+
+    def start(self) -> None:
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for attempt in range(3):
+            try:
+                await self.flush()
+                break
+            except Exception:
+                log.exception("final quest progress flush failed (attempt %d)", attempt + 1)
+        if self._pending:
+            log.error("dropping %d buffered quest progress updates on shutdown: %r", len(self._pending), self._pending)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "accepted": self.accepted,
+            "writes": self.writes,
+            "write_failures": self.write_failures,
+            "completed": self.completed,
+            "dropped": self.dropped,
+        }
+
+
+progress_buffer = ProgressBuffer(
+    flush_interval_sec=settings.QUEST_PROGRESS_FLUSH_MS / 1000,
+    max_pending=settings.QUEST_PROGRESS_MAX_PENDING,
+)
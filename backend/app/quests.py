@@ -0,0 +1,121 @@
+"""Quest completion and counter progress.
+
+Both go through single atomic updates on the user document: progress is a
+positional `$inc` on the matching active quest, and completion is an update
+pipeline that only matches while the quest is still active, so a quest can
+never be rewarded twice however many requests race on it.
+
+The `quest_history` row is written after the guarded update, from the quest
+it returned, as an upsert keyed on (user_id, quest_id). So history only ever
+records a completion that actually happened. If the process dies between the
+two writes, the quest is still on the user's `quests.recent`, and
+`is_completed` (asked when a retry finds the quest no longer active) writes
+the missing row from there.
+"""
+from typing import Any, Dict, Optional, Tuple
+from pymongo import ReturnDocument
+
+from .db import users_col, utcnow
+from .ai.quest_fill import request_quest_fill
+from .quest_history import RECENT_COMPLETED_LIMIT, record_completion
+from .leaderboard import record_quest_completion
+
+XP_PER_LEVEL = 1000
+
+def level_from_xp(total_xp: int) -> int:  # TODO: more complex level formula
+    return max(1, total_xp // XP_PER_LEVEL + 1)
+
+def xp_to_next(total_xp: int) -> int:
+    return XP_PER_LEVEL - (total_xp % XP_PER_LEVEL)
+
+# Aggregation-expression twins of the two functions above; keep them in sync.
+def level_from_xp_expr(total_xp) -> dict:
+    return {"$max": [1, {"$toInt": {"$add": [{"$floor": {"$divide": [total_xp, XP_PER_LEVEL]}}, 1]}}]}
+
+def xp_to_next_expr(total_xp) -> dict:
+    return {"$subtract": [XP_PER_LEVEL, {"$mod": [total_xp, XP_PER_LEVEL]}]}
+
+def complete_quest_pipeline(quest_id: str, now) -> list:
+    quest = "$_completing"
+    return [
+        {"$set": {"_completing": {"$arrayElemAt": [
+            {"$filter": {"input": "$quests.active", "cond": {"$eq": ["$$this.quest_id", quest_id]}}}, 0,
+        ]}}},
+        {"$set": {
+            "quests.active": {"$filter": {"input": "$quests.active", "cond": {"$ne": ["$$this.quest_id", quest_id]}}},
+            "quests.recent": {"$slice": [
+                {"$concatArrays": [
+                    {"$ifNull": ["$quests.recent", []]},
+                    [{"$mergeObjects": [quest, {"completed_at": now}]}],
+                ]},
+                -RECENT_COMPLETED_LIMIT,
+            ]},
+            "progress.xp_total": {"$add": [
+                {"$ifNull": ["$progress.xp_total", 0]}, {"$toInt": {"$ifNull": [quest + ".rewards.xp", 0]}},
+            ]},
+            "progress.quests_completed_count": {"$add": [{"$ifNull": ["$progress.quests_completed_count", 0]}, 1]},
+            "wallet.coins_balance": {"$add": [
+                {"$ifNull": ["$wallet.coins_balance", 0]}, {"$toInt": {"$ifNull": [quest + ".rewards.coins", 0]}},
+            ]},
+            "updated_at": now,
+        }},
+        {"$set": {
+            "progress.level": level_from_xp_expr("$progress.xp_total"),
+            "progress.xp_to_next_level": xp_to_next_expr("$progress.xp_total"),
+        }},
+        {"$unset": "_completing"},
+    ]
+
+
+async def apply_completion(user_id, quest_id: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Move the quest to `quests.recent` with its rewards, then record its history row.
+
+    Returns (user progress/wallet after the update, completed quest), or None
+    if the quest was not active.
+    """
+    doc = await users_col().find_one_and_update(
+        {"_id": user_id, "quests.active.quest_id": quest_id},
+        complete_quest_pipeline(quest_id, utcnow()),
+        projection={"progress": 1, "wallet.coins_balance": 1, "quests.recent": {"$slice": -1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not doc:
+        return None
+    quest = doc["quests"]["recent"][-1]
+    await record_completion(user_id, quest)
+    return doc, quest
+
+
+async def complete_active_quest(user_id, name: str, quest_id: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Complete an active quest, apply its rewards and update leaderboards.
+
+    Returns (user progress/wallet after the update, completed quest), or None
+    if the quest was not active.
+    """
+    completed = await apply_completion(user_id, quest_id)
+    if not completed:
+        return None
+
+    doc, quest = completed
+    rewards = quest.get("rewards", {}) or {}
+    await record_quest_completion(user_id, name, doc, int(rewards.get("xp", 0)), int(rewards.get("coins", 0)))
+    await request_quest_fill(user_id)
+    return doc, quest
+
+
+async def add_quest_progress(user_id, quest_id: str, amount: int) -> Optional[Dict[str, Any]]:
+    """Increment a counter quest's progress; returns the updated quest or None if not active."""
+    doc = await users_col().find_one_and_update(
+        {"_id": user_id, "quests.active": {"$elemMatch": {"quest_id": quest_id, "type": "counter"}}},
+        {"$inc": {"quests.active.$.progress": amount}, "$set": {"updated_at": utcnow()}},
+        projection={"quests.active.$": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not doc:
+        return None
+    return ((doc.get("quests") or {}).get("active") or [None])[0]
+
+
+def target_reached(quest: Dict[str, Any]) -> bool:
+    target = quest.get("target")
+    return isinstance(target, (int, float)) and target > 0 and quest.get("progress", 0) >= target
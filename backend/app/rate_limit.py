@@ -0,0 +1,309 @@
+"""Rate limiting for the auth endpoints.
+
+`RateLimitMiddleware` runs before routing, so throttled requests never reach
+a DB lookup or bcrypt. An IP already over its limit is rejected before the
+body is read, and bodies over MAX_INSPECTED_BODY get a 413 instead of being
+buffered. Each request to a path in RATE_LIMIT_PATHS is charged
+to two keys, the client IP (see `client_ip`) and the normalized email from
+the JSON body. Each key has:
+
+* a token bucket (RATE_LIMIT_*_BURST tokens, refilled at LIMIT per window),
+  which absorbs bursts locally, and
+* a sliding-window count (previous window weighted by overlap plus the
+  current one), which caps sustained traffic at LIMIT per window.
+
+Window counts are per process between syncs. Every RATE_LIMIT_SYNC_SEC the
+`RateLimiter` pushes its unsynced hits to the `rate_limits` collection with one
+bulk `$inc`, then reads back the totals, so all workers converge on one count
+per key.
+"""
+import asyncio
+import ipaddress
+import json
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from pymongo import UpdateOne
+
+from .config import get_settings
+from .db import rate_limits_col, utcnow
+
+settings = get_settings()
+log = logging.getLogger(__name__)
+
+# Auth payloads are tiny; larger bodies on rate-limited paths get a 413 without being buffered.
+MAX_INSPECTED_BODY = 16 * 1024
+
+
+class _KeyState:
+    __slots__ = ("tokens", "refilled_at", "window", "count", "unsynced", "others", "prev_total", "seen_at")
+
+    def __init__(self, burst: int, now: float, window: int):
+        self.tokens = float(burst)
+        self.refilled_at = now
+        self.window = window
+        self.count = 0       # this process's hits in `window`
+        self.unsynced = 0    # part of `count` not yet pushed to Mongo
+        self.others = 0      # other processes' hits in `window` as of the last sync
+        self.prev_total = 0  # all processes' hits in `window - 1`
+        self.seen_at = now
+
+
+class RateLimiter:
+    def __init__(self, window_sec: int, max_keys: int):
+        self.window_sec = max(1, int(window_sec))
+        self.max_keys = max(1, int(max_keys))
+        self._states: "OrderedDict[str, _KeyState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.allowed = 0
+        self.rejected = 0
+
+    def _window(self, now_wall: float) -> int:
+        return int(now_wall // self.window_sec)
+
+    def _state(self, key: str, burst: int, now: float, window: int) -> _KeyState:
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _KeyState(burst, now, window)
+            while len(self._states) > self.max_keys:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(key)
+        if state.window != window:
+            total = state.count + state.others
+            state.prev_total = total if state.window == window - 1 else 0
+            state.window, state.count, state.others = window, 0, 0
+            # Hits still unsynced belong to the old window; they are dropped rather than misfiled.
+            state.unsynced = 0
+        return state
+
+    def _assess(self, rules: Iterable[Tuple[str, int, int]]) -> Tuple[int, List[_KeyState]]:
+        """Refill and inspect each rule's key; (Retry-After or 0, states). Caller holds the lock."""
+        now, now_wall = time.monotonic(), time.time()
+        window = self._window(now_wall)
+        elapsed = (now_wall % self.window_sec) / self.window_sec
+        states: List[_KeyState] = []
+        retry_after = 0
+        for key, limit, burst in rules:
+            state = self._state(key, burst, now, window)
+            rate = limit / self.window_sec
+            state.tokens = min(float(burst), state.tokens + (now - state.refilled_at) * rate)
+            state.refilled_at = state.seen_at = now
+            estimate = state.prev_total * (1 - elapsed) + state.count + state.others
+            if estimate + 1 > limit:
+                retry_after = max(retry_after, math.ceil(self.window_sec * (1 - elapsed)))
+            elif state.tokens < 1:
+                retry_after = max(retry_after, math.ceil((1 - state.tokens) / rate))
+            states.append(state)
+        return retry_after, states
+
+    def peek(self, rules: Iterable[Tuple[str, int, int]]) -> Optional[int]:
+        """Like `check`, but charges nothing when the request would be allowed."""
+        with self._lock:
+            retry_after, _ = self._assess(rules)
+            if retry_after:
+                self.rejected += 1
+                return retry_after
+            return None
+
+    def check(self, rules: Iterable[Tuple[str, int, int]]) -> Optional[int]:
+        """Charge one request to every (key, limit, burst) rule.
+
+        Returns None if allowed, otherwise the Retry-After in seconds. A
+        rejected request is not charged to any key.
+        """
+        with self._lock:
+            retry_after, states = self._assess(rules)
+            if retry_after:
+                self.rejected += 1
+                return retry_after
+            for state in states:
+                state.tokens -= 1
+                state.count += 1
+                state.unsynced += 1
+            self.allowed += 1
+            return None
+
+    async def sync(self) -> None:
+        """Push unsynced hits to Mongo and refresh other processes' counts."""
+        window = self._window(time.time())
+        with self._lock:
+            pushed = {key: state.unsynced for key, state in self._states.items() if state.window == window}
+            for key in pushed:
+                self._states[key].unsynced = 0
+        if not pushed:
+            return
+
+        expires_at = utcnow() + timedelta(seconds=2 * self.window_sec)
+        ops = [
+            UpdateOne({"_id": f"{key}:{window}"}, {"$inc": {"n": n}, "$setOnInsert": {"expires_at": expires_at}}, upsert=True)
+            for key, n in pushed.items() if n
+        ]
+        try:
+            if ops:
+                await rate_limits_col().bulk_write(ops, ordered=False)
+            docs = await rate_limits_col().find(
+                {"_id": {"$in": [f"{key}:{window}" for key in pushed]}}, {"n": 1}
+            ).to_list(length=None)
+        except Exception:
+            with self._lock:
+                for key, n in pushed.items():
+                    state = self._states.get(key)
+                    if state is not None and state.window == window:
+                        state.unsynced += n
+            raise
+
+        totals = {doc["_id"].rsplit(":", 1)[0]: int(doc.get("n", 0)) for doc in docs}
+        idle_before = time.monotonic() - 2 * self.window_sec
+        with self._lock:
+            for key, total in totals.items():
+                state = self._states.get(key)
+                if state is not None and state.window == window:
+                    state.others = max(0, total - (state.count - state.unsynced))
+            for key in [k for k, s in self._states.items() if s.seen_at < idle_before and not s.unsynced]:
+                del self._states[key]
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.RATE_LIMIT_SYNC_SEC)
+            try:
+                await self.sync()
+            except Exception:
+                log.exception("rate limit sync failed")
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"keys": len(self._states), "allowed": self.allowed, "rejected": self.rejected}
+
+
+rate_limiter = RateLimiter(window_sec=settings.RATE_LIMIT_WINDOW_SEC, max_keys=settings.RATE_LIMIT_MAX_KEYS)
+
+
+_trusted_proxies = [ipaddress.ip_network(net, strict=False) for net in settings.RATE_LIMIT_TRUSTED_PROXIES]
+
+
+def _is_trusted_proxy(host: str) -> bool:
+    if not _trusted_proxies:
+        return True
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(addr in net for net in _trusted_proxies)
+
+
+def client_ip(scope: Dict[str, Any]) -> str:
+    """The socket peer, or the address our own proxies recorded in X-Forwarded-For.
+
+    Clients can put anything on the left of X-Forwarded-For, so with N trusted
+    proxies only the Nth entry from the right (the one the outermost proxy
+    appended) is used, and only when the request came from a trusted proxy.
+    """
+    client = scope.get("client")
+    peer = client[0] if client else "unknown"
+    hops = settings.RATE_LIMIT_TRUSTED_PROXY_HOPS
+    if hops <= 0 or not _is_trusted_proxy(peer):
+        return peer
+    forwarded: List[str] = []
+    for name, value in scope.get("headers") or []:
+        if name == b"x-forwarded-for":
+            forwarded.extend(part.strip() for part in value.decode("latin-1").split(","))
+    forwarded = [part for part in forwarded if part]
+    if len(forwarded) < hops:
+        # Fewer entries than proxies: the request did not come through the whole chain.
+        return peer
+    return forwarded[-hops]
+
+
+def email_from_body(body: bytes) -> Optional[str]:
+    if not body or len(body) > MAX_INSPECTED_BODY:
+        return None
+    try:
+        email = json.loads(body).get("email")
+    except (ValueError, AttributeError):
+        return None
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+
+async def _reply(send, status: int, detail: str, headers: Optional[List[Tuple[bytes, bytes]]] = None) -> None:
+    payload = json.dumps({"detail": detail}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(payload)).encode()),
+            *(headers or []),
+        ],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+
+class RateLimitMiddleware:
+    """ASGI middleware that throttles RATE_LIMIT_PATHS per client IP and per email."""
+
+    def __init__(self, app, limiter: RateLimiter = rate_limiter):
+        self.app = app
+        self.limiter = limiter
+        self.paths = frozenset(settings.RATE_LIMIT_PATHS)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        # An IP that is already over its limit is turned away before any of the body is read.
+        rules = [(f"ip:{client_ip(scope)}", settings.RATE_LIMIT_IP_LIMIT, settings.RATE_LIMIT_IP_BURST)]
+        retry_after = self.limiter.peek(rules)
+        if retry_after is not None:
+            return await _reply(send, 429, "Too many requests, please retry later", [(b"retry-after", str(retry_after).encode())])
+
+        # Buffer the body (up to MAX_INSPECTED_BODY) to read the email, then replay it to the app.
+        length = dict(scope.get("headers") or []).get(b"content-length", b"")
+        if length.isdigit() and int(length) > MAX_INSPECTED_BODY:
+            return await _reply(send, 413, "Request body too large")
+        chunks: List[bytes] = []
+        size = 0
+        more = True
+        while more:
+            message = await receive()
+            if message["type"] != "http.request":
+                return await self.app(scope, receive, send)
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_INSPECTED_BODY:
+                return await _reply(send, 413, "Request body too large")
+            chunks.append(chunk)
+            more = message.get("more_body", False)
+        body = b"".join(chunks)
+
+        email = email_from_body(body)
+        if email:
+            rules.append((f"email:{email}", settings.RATE_LIMIT_EMAIL_LIMIT, settings.RATE_LIMIT_EMAIL_BURST))
+        retry_after = self.limiter.check(rules)
+        if retry_after is not None:
+            return await _reply(send, 429, "Too many requests, please retry later", [(b"retry-after", str(retry_after).encode())])
+
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, replay, send)
+
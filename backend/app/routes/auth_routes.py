@@ -1,12 +1,14 @@
-from datetime import timedelta
-from fastapi import APIRouter, HTTPException, BackgroundTasks, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends
 from pymongo.errors import DuplicateKeyError
 from ..config import get_settings
-from ..email.email_manager import send_email_sync, email_verification_html
+from ..email.email_manager import email_verification_html
+from ..email.outbox import enqueue_email
 from ..models import SignupRequest, LoginRequest, AuthResponse, ResendVerificationRequest, VerifyEmailRequest
-from ..db import users_col, utcnow, email_verifications_col
-from ..auth import hash_password, verify_password, rotate_token_for_user, get_user_by_email, normalize_email, \
-    generate_code, hash_code, codes_equal, authenticate_credentials
+from ..db import users_col, utcnow
+from .. import users, verification
+from ..auth import hash_password_async, rotate_token_for_user, get_user_by_email, normalize_email, \
+    authenticate_credentials
+from ..session_cache import session_cache
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
@@ -22,70 +24,40 @@ def doc_to_auth_response(doc) -> AuthResponse:
 settings = get_settings()
 
 @router.post("/verify-email")
-def verify_email(payload: VerifyEmailRequest):
+async def verify_email(payload: VerifyEmailRequest):
     email = normalize_email(payload.email)
-    now = utcnow()
-
-    user = users_col().find_one({"email": email})
-    if not user or user.get("verified") is True:
-        return {"status": "ok"}
 
-    ev = email_verifications_col().find_one(
-        {"email": email, "expires_at": {"$gt": now}},
-        sort=[("created_at", -1)]
-    )
-    if not ev:
-        raise HTTPException(status_code=400, detail="Code expired or not found")
+    outcome, ev = await verification.check_code(email, payload.code)
+    if outcome == verification.VERIFIED:
+        await verification.complete_verification(ev)
+        session_cache.invalidate_user(ev["user_id"])
+        return {"status": "verified"}
 
-    if int(ev.get("attempts", 0)) >= settings.VERIFICATION_MAX_ATTEMPTS:
+    if outcome == verification.TOO_MANY_ATTEMPTS:
         raise HTTPException(status_code=429, detail="Too many attempts. Request a new code")
-
-    if not codes_equal(ev.get("code_hash", ""), payload.code):
-        email_verifications_col().update_one(
-            {"_id": ev["_id"]},
-            {"$inc": {"attempts": 1}}
-        )
+    if outcome == verification.INVALID:
         raise HTTPException(status_code=400, detail="Invalid code")
 
-    users_col().update_one(
-        {"_id": user["_id"]},
-        {"$set": {"verified": True, "updated_at": now}}
-    )
-    email_verifications_col().delete_many({"user_id": user["_id"]})
-
-    return {"status": "verified"}
+    # No live code: unknown and already-verified addresses get the same answer as success.
+    user = await users.find_for_verification(email)
+    if not user or user.get("verified") is True:
+        return {"status": "ok"}
+    raise HTTPException(status_code=400, detail="Code expired or not found")
 
 
 @router.post("/resend-verification")
-def resend_verification(payload: ResendVerificationRequest, background_tasks: BackgroundTasks):
+async def resend_verification(payload: ResendVerificationRequest):
     email = normalize_email(payload.email)
-    now = utcnow()
 
-    user = users_col().find_one({"email": email})
+    user = await users.find_for_verification(email)
     if not user or user.get("verified"):
         return {"status": "ok"}
 
-    ev = email_verifications_col().find_one(
-        {"email": email},
-        sort=[("created_at", -1)]
-    )
-
-    if ev and ev.get("last_sent_at") and (now - ev["last_sent_at"]).total_seconds() < settings.VERIFICATION_RESEND_COOLDOWN_SEC:
+    code = await verification.issue_code(user["_id"], email, cooldown_sec=settings.VERIFICATION_RESEND_COOLDOWN_SEC)
+    if code is None:
         raise HTTPException(status_code=429, detail="Please wait before requesting another code")
 
-    code = generate_code()
-    email_verifications_col().insert_one({
-        "user_id": user["_id"],
-        "email": email,
-        "code_hash": hash_code(code),
-        "created_at": now,
-        "last_sent_at": now,
-        "expires_at": now + timedelta(minutes=settings.VERIFICATION_TTL_MIN),
-        "attempts": 0,
-    })
-
-    background_tasks.add_task(
-        send_email_sync,
+    await enqueue_email(
         to_email=email,
         subject=f"Your code is {code}",
         html=email_verification_html(user["name"], code),
@@ -95,13 +67,13 @@ def resend_verification(payload: ResendVerificationRequest, background_tasks: Ba
 
 
 @router.post("/signup")
-def signup(payload: SignupRequest, background_tasks: BackgroundTasks):
+async def signup(payload: SignupRequest):
     now = utcnow()
     email = normalize_email(payload.email)
-    password_hash = hash_password(payload.password)
+    password_hash = await hash_password_async(payload.password)
 
     try:
-        result = users_col().insert_one({
+        result = await users_col().insert_one({
             "name": payload.name,
             "email": email,
             "password_hash": password_hash,
@@ -110,7 +82,6 @@ def signup(payload: SignupRequest, background_tasks: BackgroundTasks):
             "auth": {
                 "provider": "password",
                 "last_login_at": None,
-                "failed_login_count": 0,
                 "mfa": {"enabled": False}
             },
 
@@ -133,7 +104,7 @@ def signup(payload: SignupRequest, background_tasks: BackgroundTasks):
 
             "wallet": {"coins_balance": 0},
             "streak": {"current": 0, "best": 0, "last_checkin_date": None},
-            "quests": {"active": [], "completed": []},
+            "quests": {"active": [], "recent": []},
 
             "token": None,
             "token_expiry": None,
@@ -146,19 +117,9 @@ def signup(payload: SignupRequest, background_tasks: BackgroundTasks):
             detail="This email address is already registered!"
         )
 
-    code = generate_code()
-    email_verifications_col().insert_one({
-        "user_id": result.inserted_id,
-        "email": email,
-        "code_hash": hash_code(code),
-        "created_at": now,
-        "last_sent_at": now,
-        "expires_at": now + timedelta(minutes=settings.VERIFICATION_TTL_MIN),
-        "attempts": 0,
-    })
-
-    background_tasks.add_task(
-        send_email_sync,
+    code = await verification.issue_code(result.inserted_id, email)
+
+    await enqueue_email(
         to_email=email,
         subject=f"Your code is {code}",
         html=email_verification_html(payload.name, code),
@@ -169,6 +130,6 @@ def signup(payload: SignupRequest, background_tasks: BackgroundTasks):
 
 
 @router.post("/login", response_model=AuthResponse)
-def login(user = Depends(authenticate_credentials)):
-    updated = rotate_token_for_user(user["_id"])
+async def login(user = Depends(authenticate_credentials)):
+    updated = await rotate_token_for_user(user["_id"])
     return doc_to_auth_response(updated)
\ No newline at end of file
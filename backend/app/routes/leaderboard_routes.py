@@ -0,0 +1,79 @@
+from typing import Annotated, List, Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel, NonNegativeInt, PositiveInt
+from ..auth import require_auth
+from ..config import get_settings
+from ..leaderboard import GLOBAL_BOARDS, WEEKLY_BOARDS, get_snapshot, current_score
+
+Authed = Annotated[dict, Depends(require_auth)]
+router = APIRouter(prefix="/protected/leaderboard", tags=["leaderboard"])
+settings = get_settings()
+
+Period = Literal["global", "weekly"]
+
+
+class LeaderboardEntryOut(BaseModel):
+    rank: PositiveInt
+    name: str
+    score: float
+    is_me: bool
+
+class LeaderboardOut(BaseModel):
+    board: str
+    period: Period
+    generated_at: Optional[str]
+    total: NonNegativeInt
+    offset: NonNegativeInt
+    entries: List[LeaderboardEntryOut]
+
+class MyRankOut(BaseModel):
+    board: str
+    period: Period
+    score: float
+    rank: PositiveInt
+    approximate: bool
+    total: NonNegativeInt
+
+
+def _check_board(board: str, period: str) -> None:
+    boards = GLOBAL_BOARDS if period == "global" else WEEKLY_BOARDS
+    if board not in boards:
+        raise HTTPException(status_code=404, detail=f"Unknown {period} leaderboard '{board}'")
+
+
+@router.get("/{board}", response_model=LeaderboardOut)
+async def leaderboard(
+    user: Authed,
+    board: str,
+    period: Period = "global",
+    offset: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+):
+    _check_board(board, period)
+    snap = await get_snapshot(board, period)
+    return LeaderboardOut(
+        board=board,
+        period=period,
+        generated_at=snap.generated_at.isoformat() if snap.generated_at else None,
+        total=snap.total,
+        offset=offset,
+        entries=[
+            LeaderboardEntryOut(rank=e["rank"], name=e["name"], score=e["score"], is_me=e["user_id"] == user["_id"])
+            for e in snap.page(offset, limit)
+        ],
+    )
+
+@router.get("/{board}/me", response_model=MyRankOut)
+async def my_rank(user: Authed, board: str, period: Period = "global"):
+    _check_board(board, period)
+    snap = await get_snapshot(board, period)
+    score = await current_score(user["_id"], board, period)
+    rank, approximate = snap.rank_of(user["_id"], score)
+    return MyRankOut(
+        board=board,
+        period=period,
+        score=score,
+        rank=rank,
+        approximate=approximate,
+        total=max(snap.total, rank),
+    )
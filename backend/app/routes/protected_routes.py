@@ -1,21 +1,27 @@
+import asyncio
+import json
 from typing import Annotated, Optional, List, Literal
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, EmailStr, Field, conint, NonNegativeInt, PositiveInt, confloat
 from ..auth import require_auth
+from ..config import get_settings
 from ..db import users_col, utcnow
-from ..ai.ai import fill_missing_active_quests
+from .. import users
+from ..ai.ai import ACTIVE_QUEST_TARGET, push_active_quests
+from ..ai.quest_pool import take_quests, return_quests
+from ..ai.quest_fill import request_quest_fill
 from ..models import Onboarding
+from ..quest_history import is_completed, history_page
+from ..quests import XP_PER_LEVEL, complete_active_quest, add_quest_progress, target_reached
+from ..quest_events import quest_events
+from ..quest_progress import progress_buffer
+from ..session_cache import session_cache
 
+settings = get_settings()
 Authed = Annotated[dict, Depends(require_auth)]
 router = APIRouter(prefix="/protected", tags=["protected"])
 
-def level_from_xp(total_xp: int) -> int:  # TODO: more complex level formula
-    return max(1, total_xp // 1000 + 1)
-
-def xp_to_next(total_xp: int) -> int:
-    return 1000 - (total_xp % 1000)
-
-
 class TokenStatus(BaseModel):
     ok: bool
 
@@ -27,6 +33,12 @@ class ProfileOut(BaseModel):
 class QuestIdIn(BaseModel):
     quest_id: str
 
+class QuestProgressIn(BaseModel):
+    quest_id: str
+    amount: conint(ge=1, le=100000)
+    # Merge into the server-side buffer instead of writing now (for step counters etc.).
+    coalesce: bool = False
+
 class OnboardingResult(BaseModel):
     ok: bool
     requires_onboarding: bool
@@ -65,24 +77,70 @@ class CompleteQuestOut(BaseModel):
     xp_total: NonNegativeInt
     xp_to_next_level: PositiveInt
 
+class QuestProgressOut(BaseModel):
+    quest_id: str
+    accepted: bool
+    progress: Optional[NonNegativeInt] = None
+    target: Optional[NonNegativeInt] = None
+    completed: bool = False
+    completion: Optional[CompleteQuestOut] = None
+
+class CompletedQuestOut(BaseModel):
+    quest_id: str
+    title: Optional[str] = None
+    type: Optional[str] = None
+    rewards: Rewards
+    completed_at: str
+
+class QuestHistoryOut(BaseModel):
+    items: List[CompletedQuestOut]
+    next_cursor: Optional[str] = None
+
 class CheckinOut(BaseModel):
     ok: bool
     streak_current: NonNegativeInt
     streak_best: NonNegativeInt
 
 
+def active_quest_out(a: dict) -> ActiveQuestOut:
+    return ActiveQuestOut(
+        quest_id=a["quest_id"],
+        title=a["title"],
+        type=a.get("type", "counter"),
+        started_at=(a.get("started_at").isoformat() if a.get("started_at") else ""),
+        rewards=Rewards(
+            xp=int((a.get("rewards") or {}).get("xp", 0)),
+            coins=int((a.get("rewards") or {}).get("coins", 0)),
+        ),
+    )
+
+
+def completion_out(doc: dict, quest: dict) -> dict:
+    rewards = quest.get("rewards", {}) or {}
+    progress = doc.get("progress") or {}
+    return {
+        "ok": True,
+        "completed": True,
+        "xp_awarded": int(rewards.get("xp", 0)),
+        "coins_awarded": int(rewards.get("coins", 0)),
+        "level": int(progress.get("level", 1)),
+        "xp_total": int(progress.get("xp_total", 0)),
+        "xp_to_next_level": int(progress.get("xp_to_next_level", XP_PER_LEVEL)),
+    }
+
+
 @router.get("/token", response_model=TokenStatus)
-def check_token(_: Authed):
+async def check_token(_: Authed):
     return {"ok": True}
 
 @router.get("/profile", response_model=ProfileOut)
-def profile(user: Authed):
+async def profile(user: Authed):
     return {"id": str(user["_id"]), "name": user["name"], "email": user["email"]}
 
 @router.put("/onboarding", response_model=OnboardingResult)
-def update_onboarding(user: Authed, payload: Onboarding):
+async def update_onboarding(user: Authed, payload: Onboarding):
     now = utcnow()
-    users_col().update_one(
+    await users_col().update_one(
         {"_id": user["_id"]},
         {
             "$set": {
@@ -97,89 +155,159 @@ def update_onboarding(user: Authed, payload: Onboarding):
             }
         },
     )
+    session_cache.invalidate_user(user["_id"])
     return {"ok": True, "requires_onboarding": False}
 
 @router.get("/quests/load", response_model=QuestsLoadOut)
-def load_quests(user: Authed, background: BackgroundTasks):
-    doc = users_col().find_one({"_id": user["_id"]}, {"quests.active": 1}) or {}
+async def load_quests(user: Authed):
+    doc = await users.find_fields(user["_id"], "quests.active")
     active = (doc.get("quests") or {}).get("active", []) or []
     count = len(active)
-    needed = max(0, 3 - count)
+    needed = max(0, ACTIVE_QUEST_TARGET - count)
 
+    # Serve from the pre-generated pool first; only the shortfall waits on the model.
+    if needed > 0:
+        now = utcnow()
+        onboarding = user.get("onboarding") or {}
+        pooled = await take_quests(onboarding, needed, now)
+        added = await push_active_quests(user["_id"], pooled, ACTIVE_QUEST_TARGET, now)
+        await return_quests(onboarding, pooled[added:])
+        active = active + pooled[:added]
+        needed = max(0, ACTIVE_QUEST_TARGET - len(active))
+
+    # Repeated loads find the fill already queued instead of adding another.
     generation_started = False
     if needed > 0:
-        background.add_task(fill_missing_active_quests, user["_id"], needed)
+        await request_quest_fill(user["_id"])
         generation_started = True
 
-    out: List[ActiveQuestOut] = []
-    for a in active:
-        out.append(ActiveQuestOut(
-            quest_id=a["quest_id"],
-            title=a["title"],
-            type=a.get("type", "counter"),
-            started_at=(a.get("started_at").isoformat() if a.get("started_at") else ""),
-            rewards=Rewards(
-                xp=int((a.get("rewards") or {}).get("xp", 0)),
-                coins=int((a.get("rewards") or {}).get("coins", 0)),
-            ),
-        ))
+    out: List[ActiveQuestOut] = [active_quest_out(a) for a in active]
     return QuestsLoadOut(active=out, needed=needed, generation_started=generation_started)
 
-@router.post("/quests/complete", response_model=CompleteQuestOut)
-def complete_quest(user: Authed, payload: QuestIdIn, background: BackgroundTasks):
-    now = utcnow()
-
-    doc = users_col().find_one(
-        {"_id": user["_id"], "quests.active.quest_id": payload.quest_id},
-        {"quests.active.$": 1, "progress": 1, "wallet": 1},
-    )
-    if not doc or "quests" not in doc or not doc["quests"].get("active"):
-        raise HTTPException(status_code=404, detail="Quest not active")
-
-    quest = doc["quests"]["active"][0]
-    rewards = quest.get("rewards", {}) or {}
-    xp_reward = int(rewards.get("xp", 0))
-    coin_reward = int(rewards.get("coins", 0))
-
-    users_col().update_one(
-        {"_id": user["_id"]},
-        {
-            "$pull": {"quests.active": {"quest_id": payload.quest_id}},
-            "$push": {"quests.completed": {**quest, "completed_at": now}},
-            "$inc": {
-                "progress.xp_total": xp_reward,
-                "progress.quests_completed_count": 1,
-                "wallet.coins_balance": coin_reward,
-            },
-            "$set": {"updated_at": now},
-        },
+def _sse(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+@router.get("/quests/stream")
+async def stream_quests(user: Authed, request: Request):
+    """Server-sent events: the current active quests, then each quest as it is added.
+
+    Events: `quest` (ActiveQuestOut), `snapshot` (counts after the initial
+    quests, like QuestsLoadOut without the list) and `fill_complete` when a
+    fill run by this process finishes. Comment lines keep the connection
+    alive; the server closes it after QUEST_STREAM_MAX_SEC and the client
+    reconnects.
+    """
+    user_id = user["_id"]
+
+    async def events():
+        # Subscribe before reading the snapshot so nothing added in between is missed.
+        queue = quest_events.subscribe(user_id)
+        try:
+            doc = await users.find_fields(user_id, "quests.active")
+            active = (doc.get("quests") or {}).get("active", []) or []
+            needed = max(0, ACTIVE_QUEST_TARGET - len(active))
+            if needed:
+                await request_quest_fill(user_id)
+
+            seen = {a["quest_id"] for a in active}
+            yield f"retry: {settings.QUEST_STREAM_RETRY_MS}\n\n"
+            for a in active:
+                yield _sse("quest", active_quest_out(a).model_dump_json())
+            yield _sse("snapshot", json.dumps({"active": len(active), "needed": needed, "generation_started": bool(needed)}))
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + settings.QUEST_STREAM_MAX_SEC
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), min(settings.QUEST_STREAM_HEARTBEAT_SEC, remaining))
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                if event == "quest":
+                    if data["quest_id"] in seen:
+                        continue
+                    seen.add(data["quest_id"])
+                    yield _sse(event, active_quest_out(data).model_dump_json())
+                else:
+                    yield _sse(event, json.dumps(data))
+        finally:
+            quest_events.unsubscribe(user_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-    # Recalculate level
-    fresh = users_col().find_one({"_id": user["_id"]}, {"progress": 1})
-    total_xp = int((fresh.get("progress") or {}).get("xp_total", 0))
-    lvl = level_from_xp(total_xp)
-    xp_next = xp_to_next(total_xp)
-    users_col().update_one(
-        {"_id": user["_id"]},
-        {"$set": {"progress.level": lvl, "progress.xp_to_next_level": xp_next}}
+@router.post("/quests/complete", response_model=CompleteQuestOut)
+async def complete_quest(user: Authed, payload: QuestIdIn):
+    # The update only matches while the quest is still active, so a retried or
+    # concurrent completion of the same quest_id cannot apply twice.
+    completed = await complete_active_quest(user["_id"], user.get("name", ""), payload.quest_id)
+    if not completed:
+        if await is_completed(user["_id"], payload.quest_id):
+            raise HTTPException(status_code=409, detail="Quest already completed")
+        raise HTTPException(status_code=404, detail="Quest not active")
+    return completion_out(*completed)
+
+@router.post("/quests/progress", response_model=QuestProgressOut)
+async def quest_progress(user: Authed, payload: QuestProgressIn, response: Response):
+    # Buffered increments are applied (and auto-complete) on the next flush; a
+    # full buffer falls through to the direct write below.
+    if payload.coalesce and progress_buffer.add(user["_id"], user.get("name", ""), payload.quest_id, payload.amount):
+        response.status_code = 202
+        return QuestProgressOut(quest_id=payload.quest_id, accepted=True)
+
+    quest = await add_quest_progress(user["_id"], payload.quest_id, payload.amount)
+    if quest is None:
+        if await is_completed(user["_id"], payload.quest_id):
+            raise HTTPException(status_code=409, detail="Quest already completed")
+        raise HTTPException(status_code=404, detail="Counter quest not active")
+
+    out = QuestProgressOut(
+        quest_id=payload.quest_id,
+        accepted=True,
+        progress=int(quest.get("progress", 0)),
+        target=int(quest["target"]) if quest.get("target") is not None else None,
     )
-
-    background.add_task(fill_missing_active_quests, user["_id"], 1)
-
-    return {
-        "ok": True,
-        "completed": True,
-        "xp_awarded": xp_reward,
-        "coins_awarded": coin_reward,
-        "level": lvl,
-        "xp_total": total_xp,
-        "xp_to_next_level": xp_next,
-    }
+    if target_reached(quest):
+        # A concurrent request may win the completion; either way the quest is done.
+        completed = await complete_active_quest(user["_id"], user.get("name", ""), payload.quest_id)
+        out.completed = True
+        if completed:
+            out.completion = CompleteQuestOut(**completion_out(*completed))
+    return out
+
+@router.get("/quests/history", response_model=QuestHistoryOut)
+async def quest_history(
+    user: Authed,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    cursor: Optional[str] = None,
+):
+    try:
+        docs, next_cursor = await history_page(user["_id"], limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    items = [
+        CompletedQuestOut(
+            quest_id=d["quest_id"],
+            title=d.get("title"),
+            type=d.get("type"),
+            rewards=Rewards(
+                xp=int((d.get("rewards") or {}).get("xp", 0)),
+                coins=int((d.get("rewards") or {}).get("coins", 0)),
+            ),
+            completed_at=d["completed_at"].isoformat(),
+        )
+        for d in docs
+    ]
+    return QuestHistoryOut(items=items, next_cursor=next_cursor)
 
 @router.get("/progress", response_model=ProgressOut)
-def get_progress(user: Authed):
-    doc = users_col().find_one({"_id": user["_id"]}, {"progress": 1}) or {}
+async def get_progress(user: Authed):
+    doc = await users.find_fields(user["_id"], "progress")
     p = doc.get("progress") or {}
     return {
         "level": int(p.get("level", 1)),
@@ -189,17 +317,17 @@ def get_progress(user: Authed):
     }
 
 @router.get("/wallet", response_model=WalletOut)
-def get_wallet(user: Authed):
-    doc = users_col().find_one({"_id": user["_id"]}, {"wallet": 1}) or {}
+async def get_wallet(user: Authed):
+    doc = await users.find_fields(user["_id"], "wallet")
     w = doc.get("wallet") or {}
     return {"coins_balance": int(w.get("coins_balance", 0))}
 
 from datetime import timedelta
 
 @router.post("/streak/checkin", response_model=CheckinOut)
-def streak_checkin(user: Authed):
+async def streak_checkin(user: Authed):
     now = utcnow().date()
-    doc = users_col().find_one({"_id": user["_id"]}, {"streak": 1}) or {}
+    doc = await users.find_fields(user["_id"], "streak")
     s = doc.get("streak") or {"current": 0, "best": 0, "last_checkin_date": None}
 
     last = s.get("last_checkin_date").date() if s.get("last_checkin_date") else None
@@ -210,7 +338,7 @@ def streak_checkin(user: Authed):
     current = s["current"] + 1 if consecutive else 1
     best = max(s["best"], current)
 
-    users_col().update_one(
+    await users_col().update_one(
         {"_id": user["_id"]},
         {"$set": {
             "streak": {"current": current, "best": best, "last_checkin_date": utcnow()},
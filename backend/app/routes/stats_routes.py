@@ -0,0 +1,87 @@
+from datetime import timedelta
+from typing import Annotated, Dict, List, Literal, Optional
+from fastapi import APIRouter, Depends, Query
+from pydantic import BaseModel, NonNegativeInt, NonNegativeFloat
+from ..auth import require_auth
+from ..db import utcnow
+from ..timeutil import day_start, week_start
+from ..workout_stats import METRICS, stats_range
+
+Authed = Annotated[dict, Depends(require_auth)]
+router = APIRouter(prefix="/protected/stats", tags=["stats"])
+
+DEFAULT_BUCKETS = {"day": 30, "week": 12}
+
+
+class StatsBucketOut(BaseModel):
+    key: str
+    start: str
+    sets: NonNegativeInt
+    sessions: NonNegativeInt
+    volume_lb: NonNegativeFloat
+    active_minutes: NonNegativeFloat
+    distance_m: NonNegativeFloat
+    tags: Dict[str, NonNegativeInt]
+
+class StatsTotalsOut(BaseModel):
+    sets: NonNegativeInt
+    sessions: NonNegativeInt
+    volume_lb: NonNegativeFloat
+    active_minutes: NonNegativeFloat
+    distance_m: NonNegativeFloat
+    tags: Dict[str, NonNegativeInt]
+
+class StatsOut(BaseModel):
+    period: Literal["day", "week"]
+    since: str
+    until: str
+    totals: StatsTotalsOut
+    buckets: List[StatsBucketOut]
+
+
+def _metrics_out(doc: dict) -> dict:
+    return {
+        "sets": int(doc.get("sets", 0)),
+        "sessions": int(doc.get("sessions", 0)),
+        "volume_lb": float(doc.get("volume_lb", 0)),
+        "active_minutes": round(doc.get("active_sec", 0) / 60, 1),
+        "distance_m": float(doc.get("distance_m", 0)),
+        "tags": {tag: int(n) for tag, n in (doc.get("tags") or {}).items()},
+    }
+
+
+@router.get("", response_model=StatsOut)
+async def workout_stats(
+    user: Authed,
+    period: Literal["day", "week"] = "day",
+    last: Annotated[Optional[int], Query(ge=1, le=366)] = None,
+):
+    """Rollups for the last `last` days or ISO weeks (UTC), including the current one."""
+    now = utcnow()
+    count = last or DEFAULT_BUCKETS[period]
+    if period == "day":
+        until = day_start(now) + timedelta(days=1)
+        since = until - timedelta(days=count)
+    else:
+        until = week_start(now) + timedelta(weeks=1)
+        since = until - timedelta(weeks=count)
+
+    docs = await stats_range(user["_id"], period, since, until)
+    totals: dict = {"sessions": 0, "tags": {}}
+    for doc in docs:
+        totals["sessions"] += int(doc.get("sessions", 0))
+        for name in METRICS:
+            totals[name] = totals.get(name, 0) + doc.get(name, 0)
+        for tag, n in (doc.get("tags") or {}).items():
+            totals["tags"][tag] = totals["tags"].get(tag, 0) + n
+
+    return StatsOut(
+        period=period,
+        since=since.isoformat(),
+        until=until.isoformat(),
+        totals=StatsTotalsOut(**_metrics_out(totals)),
+        buckets=[
+            StatsBucketOut(key=doc["key"], start=doc["start"].isoformat(), **_metrics_out(doc))
+            for doc in docs
+        ],
+    )
@@ -0,0 +1,67 @@
+import json
+from datetime import datetime
+from typing import Annotated, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, NonNegativeInt
+from ..auth import require_auth
+from ..config import get_settings
+from ..models import WorkoutBatchIn
+from ..workouts import ingest_sets, logs_query, iter_logs
+
+Authed = Annotated[dict, Depends(require_auth)]
+router = APIRouter(prefix="/protected/workouts", tags=["workouts"])
+settings = get_settings()
+
+# Lines are flushed to the client in chunks rather than one write per document.
+STREAM_CHUNK_LINES = 100
+
+
+class WorkoutIngestOut(BaseModel):
+    received: NonNegativeInt
+    inserted: NonNegativeInt
+    duplicates: NonNegativeInt
+
+
+@router.post("", response_model=WorkoutIngestOut)
+async def ingest_workouts(user: Authed, payload: WorkoutBatchIn):
+    inserted, duplicates = await ingest_sets(user["_id"], payload.items)
+    return WorkoutIngestOut(received=len(payload.items), inserted=inserted, duplicates=duplicates)
+
+
+async def _ndjson(lines):
+    chunk: List[str] = []
+    try:
+        async for line in lines:
+            chunk.append(json.dumps(line, separators=(",", ":"), default=str))
+            if len(chunk) >= STREAM_CHUNK_LINES:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+    finally:
+        # Closing the source right away (not at garbage collection) releases its Mongo cursor.
+        await lines.aclose()
+    if chunk:
+        yield "\n".join(chunk) + "\n"
+
+
+@router.get("")
+async def stream_workouts(
+    user: Authed,
+    tag: Annotated[Optional[List[str]], Query()] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1)] = 500,
+):
+    """Newest-first workout sets as NDJSON.
+
+    One set per line; the last line is {"next_cursor": ...}, null when there
+    are no more pages. Repeat `tag` to require several tags.
+    """
+    limit = min(limit, settings.WORKOUT_STREAM_MAX_LIMIT)
+    tags = sorted({t.strip().lower() for t in tag or [] if t.strip()})
+    try:
+        query = logs_query(user["_id"], tags=tags, since=since, until=until, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return StreamingResponse(_ndjson(iter_logs(query, limit)), media_type="application/x-ndjson")
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from .config import get_settings
+
+settings = get_settings()
+
+
+class SessionCache:
+    """Bounded token -> user lookup cache with TTL and LRU eviction.
+
+    Entries hold the projected user fields returned by `get_user_by_token`
+    (including `token_expiry`), so expiry/verification checks still run on
+    every request. Writers that change those fields must invalidate.
+
+    Invalidation only reaches this process. Other workers keep serving their
+    entry until its TTL runs out, so a rotated token can keep working there
+    for up to SESSION_CACHE_TTL_SEC. Entries for users still in the middle of
+    onboarding or verification are stored with the shorter
+    SESSION_CACHE_PENDING_TTL_SEC, since those fields are about to change.
+    """
+
+    def __init__(self, max_entries: int, ttl_sec: float):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_sec = float(ttl_sec)
+        # token -> (expires_at on the monotonic clock, user)
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._token_by_user: Dict[Any, str] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_sec > 0
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, user = entry
+            if now > expires_at:
+                self._drop(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def put(self, token: str, user: Dict[str, Any], ttl_sec: Optional[float] = None) -> None:
+        """Cache `user` for `ttl_sec` (capped at the cache TTL)."""
+        ttl = self.ttl_sec if ttl_sec is None else min(float(ttl_sec), self.ttl_sec)
+        if not self.enabled or ttl <= 0:
+            return
+        with self._lock:
+            user_id = user.get("_id")
+            previous = self._token_by_user.get(user_id)
+            if previous is not None and previous != token:
+                self._drop(previous)
+            self._entries[token] = (time.monotonic() + ttl, user)
+            self._entries.move_to_end(token)
+            self._token_by_user[user_id] = token
+            while len(self._entries) > self.max_entries:
+                oldest, _ = next(iter(self._entries.items()))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate_token(self, token: Optional[str]) -> None:
+        if not token:
+            return
+        with self._lock:
+            self._drop(token)
+
+    def invalidate_user(self, user_id) -> None:
+        with self._lock:
+            token = self._token_by_user.get(user_id)
+            if token is not None:
+                self._drop(token)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._token_by_user.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            }
+
+    def _drop(self, token: str) -> None:
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[1].get("_id")
+        if self._token_by_user.get(user_id) == token:
+            del self._token_by_user[user_id]
+
+
+session_cache = SessionCache(
+    max_entries=settings.SESSION_CACHE_MAX_ENTRIES,
+    ttl_sec=settings.SESSION_CACHE_TTL_SEC,
+)
@@ -0,0 +1,19 @@
+"""UTC day and ISO-week helpers shared by the leaderboards and workout stats."""
+from datetime import datetime, time, timedelta, timezone
+from typing import Optional
+
+from .db import utcnow
+
+
+def day_start(when: datetime) -> datetime:
+    return datetime.combine(when.astimezone(timezone.utc).date(), time(), tzinfo=timezone.utc)
+
+
+def week_start(when: datetime) -> datetime:
+    start = day_start(when)
+    return start - timedelta(days=start.weekday())
+
+
+def week_key(when: Optional[datetime] = None) -> str:
+    year, week, _ = (when or utcnow()).isocalendar()
+    return f"{year}-W{week:02d}"
@@ -0,0 +1,115 @@
+"""User document access with a named projection per use case.
+
+User documents carry onboarding, progress, wallet, streak, active quests and,
+for accounts that predate `quest_history`, the embedded completion history.
+None of the auth paths need most of that, so every read here asks for the
+fields its caller uses and nothing else. Writes that the caller needs to see
+the result of use `find_one_and_update(return_document=AFTER)` with the same
+kind of projection, instead of an update followed by a second read.
+"""
+from datetime import datetime
+from typing import Any, Dict, Mapping, Optional, TypedDict
+from pymongo import ReturnDocument
+
+from .db import users_col, utcnow
+from .models import AuthedUser
+
+# Fields checked by authenticate_credentials: hash and verification state.
+LOGIN_FIELDS = {
+    "name": 1,
+    "email": 1,
+    "password_hash": 1,
+    "verified": 1,
+}
+# Fields held in the session cache for require_auth.
+SESSION_FIELDS = {
+    "name": 1,
+    "email": 1,
+    "token_expiry": 1,
+    "verified": 1,
+    "onboarding": 1,
+}
+# Fields the verify/resend endpoints need: whether to proceed and who to greet.
+VERIFICATION_FIELDS = {
+    "name": 1,
+    "verified": 1,
+}
+# Fields returned by /auth/login.
+TOKEN_FIELDS = {
+    "name": 1,
+    "email": 1,
+    "token": 1,
+    "token_expiry": 1,
+}
+
+
+class LoginUser(TypedDict, total=False):
+    _id: object
+    name: str
+    email: str
+    password_hash: str
+    verified: bool
+
+
+class VerificationUser(TypedDict, total=False):
+    _id: object
+    name: str
+    verified: bool
+
+
+class TokenUser(TypedDict):
+    _id: object
+    name: str
+    email: str
+    token: str
+    token_expiry: datetime
+
+
+async def find_for_login(email: str) -> Optional[LoginUser]:
+    return await users_col().find_one({"email": email}, LOGIN_FIELDS)
+
+
+async def find_for_verification(email: str) -> Optional[VerificationUser]:
+    return await users_col().find_one({"email": email}, VERIFICATION_FIELDS)
+
+
+async def find_session(token: str) -> Optional[AuthedUser]:
+    return await users_col().find_one({"token": token}, SESSION_FIELDS)
+
+
+async def find_fields(user_id, *paths: str) -> Dict[str, Any]:
+    """Only `paths` of one user (plus _id); {} if the user is gone."""
+    return await users_col().find_one({"_id": user_id}, {p: 1 for p in paths}) or {}
+
+
+async def rotate_token(user_id, token: str, token_expiry: datetime) -> Optional[TokenUser]:
+    """Store a new session token and return the login response fields in the same round trip."""
+    now = utcnow()
+    return await users_col().find_one_and_update(
+        {"_id": user_id},
+        {
+            "$set": {
+                "token": token,
+                "token_expiry": token_expiry,
+                "auth.last_login_at": now,
+                "updated_at": now,
+            }
+        },
+        projection=TOKEN_FIELDS,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def replace_password_hash(user: Mapping[str, Any], new_hash: str) -> None:
+    """Swap the hash only if it is still the one the caller verified against."""
+    await users_col().update_one(
+        {"_id": user["_id"], "password_hash": user.get("password_hash", "")},
+        {"$set": {"password_hash": new_hash, "updated_at": utcnow()}},
+    )
+
+
+async def mark_verified(user_id) -> None:
+    await users_col().update_one(
+        {"_id": user_id},
+        {"$set": {"verified": True, "updated_at": utcnow()}},
+    )
@@ -0,0 +1,91 @@
+"""Email verification codes, one document per user.
+
+The `email_verifications` document for a user has the user's id as its
+`_id`. Signup and resend upsert it with a fresh code hash and zero attempts,
+so the collection holds at most one live code per unverified account and
+a resend replaces the previous code instead of adding another.
+
+`check_code` counts the attempt and reads the stored hash in a single
+`find_one_and_update`, guarded by `expires_at` and VERIFICATION_MAX_ATTEMPTS.
+The code is compared in constant time here. The extra read that tells
+"expired" apart from "too many attempts" only happens when the guard
+did not match.
+"""
+import asyncio
+from datetime import timedelta
+from typing import Any, Dict, Optional, Tuple
+from pymongo import DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from . import users
+from .auth import codes_equal, generate_code, hash_code
+from .config import get_settings
+from .db import email_verifications_col, utcnow
+
+settings = get_settings()
+
+# check_code outcomes
+VERIFIED = "verified"
+INVALID = "invalid"
+TOO_MANY_ATTEMPTS = "too_many_attempts"
+NOT_FOUND = "not_found"
+
+
+async def issue_code(user_id, email: str, cooldown_sec: float = 0) -> Optional[str]:
+    """Store a new code for the user and return it; None while the last one is within `cooldown_sec`."""
+    now = utcnow()
+    query: Dict[str, Any] = {"_id": user_id}
+    if cooldown_sec:
+        query["last_sent_at"] = {"$not": {"$gt": now - timedelta(seconds=cooldown_sec)}}
+    code = generate_code()
+    try:
+        # Inside the cooldown the filter misses and the upsert collides with the existing _id.
+        await email_verifications_col().update_one(
+            query,
+            {"$set": {
+                "user_id": user_id,
+                "email": email,
+                "code_hash": hash_code(code),
+                "attempts": 0,
+                "created_at": now,
+                "last_sent_at": now,
+                "expires_at": now + timedelta(minutes=settings.VERIFICATION_TTL_MIN),
+            }},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return None
+    return code
+
+
+async def check_code(email: str, code: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """(outcome, verification doc); the doc is only returned with VERIFIED."""
+    now = utcnow()
+    ev = await email_verifications_col().find_one_and_update(
+        {"email": email, "expires_at": {"$gt": now}, "attempts": {"$lt": settings.VERIFICATION_MAX_ATTEMPTS}},
+        {"$inc": {"attempts": 1}},
+        projection={"user_id": 1, "code_hash": 1},
+        # Documents from before one-per-user storage linger until their TTL; the newest code wins.
+        sort=[("expires_at", DESCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+    if ev is not None:
+        if codes_equal(ev.get("code_hash", ""), code):
+            return VERIFIED, ev
+        return INVALID, None
+
+    spent = await email_verifications_col().find_one(
+        {"email": email, "expires_at": {"$gt": now}}, {"_id": 1},
+    )
+    return (TOO_MANY_ATTEMPTS if spent else NOT_FOUND), None
+
+
+async def complete_verification(ev: Dict[str, Any]) -> None:
+    """Mark the user verified and drop the used code."""
+    # The two writes are independent and idempotent, so they go out together
+    # rather than in a transaction (which would need a replica set). The
+    # delete is by user_id so documents from before one-per-user storage go too.
+    await asyncio.gather(
+        users.mark_verified(ev["user_id"]),
+        email_verifications_col().delete_many({"user_id": ev["user_id"]}),
+    )
@@ -0,0 +1,92 @@
+"""Standalone background worker.
+
+    python -m app.worker [--concurrency N] [--types quest_fill,quest_pool_refill]
+                         [--no-outbox] [--metrics-port 9100]
+    python -m app.worker requeue-dead [--types quest_fill]
+
+`run` (the default) claims jobs from the `jobs` collection and, unless
+--no-outbox is given, also sends queued mail. It runs until SIGTERM or SIGINT,
+then lets in-flight jobs finish for up to JOB_SHUTDOWN_GRACE_SEC.
+
+Once dedicated workers are running, set JOB_WORKER_IN_API=False and
+OUTBOX_WORKER_ENABLED=False on the API processes so they only enqueue.
+"""
+import argparse
+import asyncio
+import signal
+import sys
+from typing import List, Optional
+
+from .config import get_settings
+from .db import ensure_indexes, close_client
+from .email.outbox import outbox_worker
+from .jobs import job_worker, requeue_dead_jobs
+# Imported for their @job_handler registrations.
+from .ai import quest_fill, quest_pool  # noqa: F401
+
+settings = get_settings()
+
+
+def _types(args: argparse.Namespace) -> Optional[List[str]]:
+    if not args.types:
+        return None
+    return [t.strip() for t in args.types.split(",") if t.strip()]
+
+
+async def run_worker(args: argparse.Namespace) -> None:
+    if settings.ENSURE_INDEXES_ON_STARTUP:
+        await ensure_indexes()
+    if settings.METRICS_ENABLED and args.metrics_port:
+        from prometheus_client import start_http_server
+
+        start_http_server(args.metrics_port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    job_worker.start(concurrency=args.concurrency, types=_types(args))
+    if not args.no_outbox:
+        outbox_worker.start()
+    print(f"worker started (concurrency={args.concurrency or settings.JOB_WORKER_CONCURRENCY})")
+    await stop.wait()
+    print("worker stopping")
+    await job_worker.stop()
+    await outbox_worker.stop()
+
+
+async def requeue_dead(args: argparse.Namespace) -> None:
+    types = _types(args)
+    total = 0
+    for job_type in types or [None]:
+        total += await requeue_dead_jobs(job_type)
+    print(f"requeued {total} dead jobs")
+
+
+COMMANDS = {
+    "run": run_worker,
+    "requeue-dead": requeue_dead,
+}
+
+
+async def run(args: argparse.Namespace) -> int:
+    try:
+        await COMMANDS[args.command](args)
+    finally:
+        await close_client()
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.worker")
+    parser.add_argument("command", nargs="?", default="run", choices=sorted(COMMANDS))
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--types", default="", help="comma-separated job types (default: all)")
+    parser.add_argument("--no-outbox", action="store_true", help="do not send queued mail from this worker")
+    parser.add_argument("--metrics-port", type=int, default=0)
+    return asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""Per-user daily and weekly workout rollups.
+
+`apply_rollups` folds newly inserted workout sets into `workout_stats` with
+`$inc` upserts, so stats reads cost one document per day or week instead of a
+scan over `workout_logs`. `backfill_rollups` rebuilds the rollups from the logs
+with the aggregation framework, a batch of users at a time.
+
+A session is a day with at least one logged set: daily documents always have
+sessions=1 and weekly documents count their active days. Days and ISO weeks
+are in UTC.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Tuple
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
+
+from .db import users_col, workout_logs_col, workout_stats_col, utcnow
+from .timeutil import day_start, week_key, week_start
+
+log = logging.getLogger(__name__)
+
+METRICS = ("sets", "volume_lb", "active_sec", "distance_m")
+
+
+def stats_id(user_id, period: str, key: str) -> str:
+    return f"{user_id}:{period}:{key}"
+
+
+def set_metrics(doc: Dict[str, Any]) -> Dict[str, float]:
+    reps, weight = doc.get("reps"), doc.get("weight_lb")
+    return {
+        "sets": 1,
+        "volume_lb": reps * weight if reps and weight else 0,
+        "active_sec": doc.get("duration_sec") or 0,
+        "distance_m": doc.get("distance_m") or 0,
+    }
+
+
+def _add(into: Dict[str, Any], metrics: Dict[str, Any], tags: Dict[str, int]) -> None:
+    for name in METRICS:
+        into[name] = into.get(name, 0) + metrics.get(name, 0)
+    into_tags = into.setdefault("tags", {})
+    for tag, n in tags.items():
+        into_tags[tag] = into_tags.get(tag, 0) + n
+
+
+def _inc(totals: Dict[str, Any]) -> Dict[str, Any]:
+    inc = {name: totals.get(name, 0) for name in METRICS}
+    inc.update({f"tags.{tag}": n for tag, n in totals.get("tags", {}).items()})
+    return inc
+
+
+async def apply_rollups(user_id, docs: Iterable[Dict[str, Any]]) -> None:
+    """Add freshly inserted workout sets to the user's daily and weekly rollups."""
+    days: Dict[str, Dict[str, Any]] = {}
+    for doc in docs:
+        start = day_start(doc["performed_at"])
+        _add(days.setdefault(start.date().isoformat(), {"start": start}),
+             set_metrics(doc), {t: 1 for t in doc.get("tags") or []})
+    if not days:
+        return
+
+    now = utcnow()
+    day_keys = list(days)
+    result = await workout_stats_col().bulk_write([
+        UpdateOne(
+            {"_id": stats_id(user_id, "day", key)},
+            {
+                "$inc": _inc(days[key]),
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"user_id": user_id, "period": "day", "key": key, "start": days[key]["start"], "sessions": 1},
+            },
+            upsert=True,
+        )
+        for key in day_keys
+    ], ordered=False)
+    new_days = {day_keys[i] for i in result.upserted_ids}
+
+    weeks: Dict[str, Dict[str, Any]] = {}
+    for key, totals in days.items():
+        week = weeks.setdefault(week_key(totals["start"]), {"start": week_start(totals["start"]), "sessions": 0})
+        _add(week, totals, totals.get("tags", {}))
+        week["sessions"] += key in new_days
+    await workout_stats_col().bulk_write([
+        UpdateOne(
+            {"_id": stats_id(user_id, "week", key)},
+            {
+                "$inc": {**_inc(totals), "sessions": totals["sessions"]},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"user_id": user_id, "period": "week", "key": key, "start": totals["start"]},
+            },
+            upsert=True,
+        )
+        for key, totals in weeks.items()
+    ], ordered=False)
+
+
+def _day_group(user_ids: List[Any], *extra: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"$match": {"user_id": {"$in": user_ids}}}, *extra, {"$set": {
+        "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$performed_at"}},
+    }}]
+
+
+def daily_metrics_pipeline(user_ids: List[Any]) -> List[Dict[str, Any]]:
+    return _day_group(user_ids) + [{"$group": {
+        "_id": {"user_id": "$user_id", "day": "$day"},
+        "sets": {"$sum": 1},
+        "volume_lb": {"$sum": {"$multiply": [{"$ifNull": ["$reps", 0]}, {"$ifNull": ["$weight_lb", 0]}]}},
+        "active_sec": {"$sum": {"$ifNull": ["$duration_sec", 0]}},
+        "distance_m": {"$sum": {"$ifNull": ["$distance_m", 0]}},
+    }}]
+
+
+def daily_tags_pipeline(user_ids: List[Any]) -> List[Dict[str, Any]]:
+    return _day_group(user_ids, {"$unwind": "$tags"}) + [{"$group": {
+        "_id": {"user_id": "$user_id", "day": "$day", "tag": "$tags"},
+        "n": {"$sum": 1},
+    }}]
+
+
+async def _rebuild_users(user_ids: List[Any], now: datetime) -> int:
+    days: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+    cursor = await workout_logs_col().aggregate(daily_metrics_pipeline(user_ids), allowDiskUse=True)
+    async for row in cursor:
+        days[(row["_id"]["user_id"], row["_id"]["day"])] = {
+            **{name: row.get(name, 0) for name in METRICS}, "tags": {},
+        }
+    cursor = await workout_logs_col().aggregate(daily_tags_pipeline(user_ids), allowDiskUse=True)
+    async for row in cursor:
+        day = days.get((row["_id"]["user_id"], row["_id"]["day"]))
+        if day is not None:
+            day["tags"][row["_id"]["tag"]] = row["n"]
+
+    ops: List[ReplaceOne] = []
+    weeks: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+    for (user_id, key), totals in days.items():
+        start = datetime.fromisoformat(key).replace(tzinfo=timezone.utc)
+        ops.append(ReplaceOne(
+            {"_id": stats_id(user_id, "day", key)},
+            {"user_id": user_id, "period": "day", "key": key, "start": start, "sessions": 1, **totals, "updated_at": now},
+            upsert=True,
+        ))
+        week = weeks.setdefault((user_id, week_key(start)), {"start": week_start(start), "sessions": 0})
+        _add(week, totals, totals["tags"])
+        week["sessions"] += 1
+    for (user_id, key), totals in weeks.items():
+        ops.append(ReplaceOne(
+            {"_id": stats_id(user_id, "week", key)},
+            {"user_id": user_id, "period": "week", "key": key, **totals, "updated_at": now},
+            upsert=True,
+        ))
+    if ops:
+        await workout_stats_col().bulk_write(ops, ordered=False)
+    # Rollups whose logs are gone were not rewritten above.
+    await workout_stats_col().delete_many({"user_id": {"$in": user_ids}, "updated_at": {"$lt": now}})
+    return len(ops)
+
+
+async def backfill_rollups(batch_size: int = 100) -> int:
+    """Recompute every user's rollups from workout_logs; returns the number of users processed.
+
+    Sets ingested for a user while their batch is being rebuilt can be
+    counted twice or not at all, so run this while ingest is quiet or rerun it.
+    """
+    processed = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        users = await users_col().find(query, {"_id": 1}).sort("_id", ASCENDING) \
+            .limit(batch_size).to_list(length=batch_size)
+        if not users:
+            return processed
+        user_ids = [u["_id"] for u in users]
+        await _rebuild_users(user_ids, utcnow())
+        processed += len(user_ids)
+        last_id = user_ids[-1]
+        log.info("rebuilt workout rollups for %d users", processed)
+
+
+async def stats_range(user_id, period: str, since: datetime, until: datetime) -> List[Dict[str, Any]]:
+    return await workout_stats_col().find(
+        {"user_id": user_id, "period": period, "start": {"$gte": since, "$lt": until}},
+        {"_id": 0, "user_id": 0, "period": 0, "updated_at": 0},
+    ).sort("start", ASCENDING).to_list(length=None)
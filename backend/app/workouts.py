@@ -0,0 +1,126 @@
+"""Workout log storage.
+
+Wearable syncs upload sets in batches; `ingest_sets` writes them with a single
+unordered insert_many, relies on the unique (user_id, idempotency_key) index
+to drop re-uploads and folds the new sets into the stats rollups. `iter_logs`
+walks (user_id, performed_at, _id) with a keyset cursor so reads never load a
+whole history into memory.
+"""
+import hashlib
+import json
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError
+
+from .config import get_settings
+from .db import workout_logs_col, utcnow
+from .models import WorkoutSetIn
+from .quest_history import encode_cursor, decode_cursor
+from .workout_stats import apply_rollups
+
+settings = get_settings()
+
+SORT = [("performed_at", DESCENDING), ("_id", DESCENDING)]
+
+
+def _as_utc(when: datetime) -> datetime:
+    return when.astimezone(timezone.utc) if when.tzinfo else when.replace(tzinfo=timezone.utc)
+
+
+def idempotency_key(item: WorkoutSetIn) -> str:
+    if item.idempotency_key:
+        return item.idempotency_key
+    content = item.model_dump(mode="json", exclude={"idempotency_key", "tags", "source"})
+    content["performed_at"] = _as_utc(item.performed_at).isoformat()
+    digest = hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"sha256:{digest}"
+
+
+def workout_doc(user_id, item: WorkoutSetIn, now: datetime) -> Dict[str, Any]:
+    doc = item.model_dump(exclude={"idempotency_key"}, exclude_none=True)
+    doc.update({
+        "user_id": user_id,
+        "idempotency_key": idempotency_key(item),
+        "performed_at": _as_utc(item.performed_at),
+        "created_at": now,
+    })
+    return doc
+
+
+async def ingest_sets(user_id, items: List[WorkoutSetIn]) -> Tuple[int, int]:
+    """Insert a batch in one round-trip; returns (inserted, duplicates)."""
+    now = utcnow()
+    docs: Dict[str, Dict[str, Any]] = {}
+    for item in items:
+        doc = workout_doc(user_id, item, now)
+        docs.setdefault(doc["idempotency_key"], doc)
+    batch = list(docs.values())
+    try:
+        await workout_logs_col().insert_many(batch, ordered=False)
+        inserted = batch
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in errors):
+            raise
+        failed = {err["index"] for err in errors}
+        inserted = [doc for i, doc in enumerate(batch) if i not in failed]
+    await apply_rollups(user_id, inserted)
+    return len(inserted), len(items) - len(inserted)
+
+
+def logs_query(
+    user_id,
+    tags: Optional[List[str]] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Build the find filter; raises ValueError on a malformed cursor."""
+    query: Dict[str, Any] = {"user_id": user_id}
+    if tags:
+        query["tags"] = {"$all": tags}
+    performed: Dict[str, Any] = {}
+    if since:
+        performed["$gte"] = _as_utc(since)
+    if until:
+        performed["$lt"] = _as_utc(until)
+    if performed:
+        query["performed_at"] = performed
+    if cursor:
+        performed_at, oid = decode_cursor(cursor)
+        query["$and"] = [{"$or": [
+            {"performed_at": {"$lt": performed_at}},
+            {"performed_at": performed_at, "_id": {"$lt": oid}},
+        ]}]
+    return query
+
+
+def log_out(doc: Dict[str, Any]) -> Dict[str, Any]:
+    out = {k: v for k, v in doc.items() if k not in ("_id", "user_id", "created_at")}
+    out["id"] = str(doc["_id"])
+    out["performed_at"] = doc["performed_at"].isoformat()
+    return out
+
+
+async def iter_logs(query: Dict[str, Any], limit: int) -> AsyncIterator[Dict[str, Any]]:
+    """Yield up to `limit` log documents newest first, then {"next_cursor": ...}."""
+    cursor = workout_logs_col().find(query, {"user_id": 0, "created_at": 0}) \
+        .sort(SORT) \
+        .limit(limit + 1) \
+        .batch_size(min(limit + 1, settings.WORKOUT_STREAM_BATCH_SIZE))
+    sent = 0
+    last: Optional[Dict[str, Any]] = None
+    next_cursor: Optional[str] = None
+    # A client that disconnects mid-stream closes the generator; the finally kills the server-side cursor.
+    try:
+        async for doc in cursor:
+            if sent == limit:
+                next_cursor = encode_cursor(last, "performed_at")
+                break
+            last = doc
+            sent += 1
+            yield log_out(doc)
+    finally:
+        await cursor.close()
+    yield {"next_cursor": next_cursor}
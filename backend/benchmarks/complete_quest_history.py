@@ -0,0 +1,118 @@
+"""complete_quest latency as a function of completed-quest history size.
+
+"embedded" reproduces the old layout (history pushed onto quests.completed in
+the user document); "collection" is the current layout (bounded quests.recent
+plus the quest_history collection). Needs a real MongoDB:
+
+    cd backend && MONGO_URI=mongodb://localhost:27017 DB_NAME=bench \\
+        python -m benchmarks.complete_quest_history --sizes 0 1000 10000 --iterations 200
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from uuid import uuid4
+
+from pymongo import ReturnDocument
+
+from app import db
+from app.quest_history import history_doc
+from app.quests import apply_completion
+
+
+def make_quest():
+    now = db.utcnow()
+    return {
+        "quest_id": str(uuid4()),
+        "title": "Walk 5,000 steps",
+        "type": "counter",
+        "target": 5000,
+        "progress": 0,
+        "rewards": {"xp": 50, "coins": 5},
+        "created_at": now,
+        "started_at": now,
+        "completed_at": now,
+    }
+
+
+async def complete_embedded(user_id, quest_id):
+    now = db.utcnow()
+    await db.users_col().find_one_and_update(
+        {"_id": user_id, "quests.active.quest_id": quest_id},
+        [
+            {"$set": {"_completing": {"$arrayElemAt": [
+                {"$filter": {"input": "$quests.active", "cond": {"$eq": ["$$this.quest_id", quest_id]}}}, 0,
+            ]}}},
+            {"$set": {
+                "quests.active": {"$filter": {"input": "$quests.active", "cond": {"$ne": ["$$this.quest_id", quest_id]}}},
+                "quests.completed": {"$concatArrays": ["$quests.completed", [{"$mergeObjects": ["$_completing", {"completed_at": now}]}]]},
+                "progress.xp_total": {"$add": ["$progress.xp_total", "$_completing.rewards.xp"]},
+            }},
+            {"$unset": "_completing"},
+        ],
+        projection={"progress": 1, "quests.completed": {"$slice": -1}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def complete_collection(user_id, quest_id):
+    # The app's own write path: guarded rewards update, then the history upsert.
+    await apply_completion(user_id, quest_id)
+
+
+async def seed(layout, size):
+    history = [make_quest() for _ in range(size)]
+    user = {
+        "email": f"bench-{uuid4()}@example.com",
+        "progress": {"xp_total": 0, "level": 1, "xp_to_next_level": 1000, "quests_completed_count": size},
+        "wallet": {"coins_balance": 0},
+        "quests": {"active": [], "completed": history} if layout == "embedded" else {"active": [], "recent": history[-10:]},
+    }
+    user_id = (await db.users_col().insert_one(user)).inserted_id
+    if layout == "collection" and history:
+        await db.quest_history_col().insert_many([history_doc(user_id, q) for q in history])
+    return user_id
+
+
+async def measure(layout, size, iterations):
+    user_id = await seed(layout, size)
+    complete = complete_embedded if layout == "embedded" else complete_collection
+    timings = []
+    try:
+        for _ in range(iterations):
+            quest = make_quest()
+            await db.users_col().update_one({"_id": user_id}, {"$push": {"quests.active": quest}})
+            started = time.perf_counter()
+            await complete(user_id, quest["quest_id"])
+            timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        await db.users_col().delete_one({"_id": user_id})
+        await db.quest_history_col().delete_many({"user_id": user_id})
+    timings.sort()
+    return {
+        "layout": layout,
+        "history_size": size,
+        "mean_ms": statistics.fmean(timings),
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+    }
+
+
+async def main(sizes, iterations):
+    await db.ensure_indexes()
+    results = []
+    try:
+        for size in sizes:
+            for layout in ("embedded", "collection"):
+                results.append(await measure(layout, size, iterations))
+    finally:
+        await db.close_client()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[0, 1000, 10000])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.iterations))
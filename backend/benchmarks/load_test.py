@@ -0,0 +1,323 @@
+"""End-to-end load test of the API against local stand-ins.
+
+Boots `app.main:app` under uvicorn in a subprocess against MONGO_URI (a fresh
+database per run), the fake OpenAI server and the SMTP sink from
+benchmarks.standins, then drives one of these scenarios:
+
+* journey: signup -> verify (code read from the SMTP sink) -> login ->
+  onboarding -> `--loops` rounds of quest load + complete, per user.
+* login_storm: creates `--users` verified users, then fires `--logins`
+  logins at `--concurrency`.
+
+Reports p50/p95/p99 latency and requests/second per operation, Mongo
+commands per request per route, and model retries and parse outcomes (read
+from the app's /metrics, so keep `--workers 1` for exact numbers). Results are JSON and can be compared:
+
+    cd backend && MONGO_URI=mongodb://localhost:27017 \\
+        python -m benchmarks.load_test --scenario journey --users 50 --concurrency 20 --out base.json
+    python -m benchmarks.load_test --compare base.json new.json --threshold 0.10
+
+Needs httpx, uvicorn and aiosmtpd (benchmarks only) and a real MongoDB:
+mongomock cannot run the update pipelines used by quest completion.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+import httpx
+
+from benchmarks.standins import SMTPSink, fake_openai_app, serve_fake_openai
+
+ONBOARDING = {
+    "height_in": 70, "weight_lb": 170, "primary_goal": "build strength",
+    "experience": "intermediate", "equipment": "full_gym", "preferred_days_per_week": 4, "age": 30,
+}
+PASSWORD = "benchmark-password"
+METRIC_LINE = re.compile(r'^http_request_mongo_commands_(sum|count)\{method="([^"]+)",route="([^"]+)"\} ([0-9.e+-]+)$')
+LLM_COUNTER_LINE = re.compile(r'^(llm_retries_total|llm_response_parse_total)\{(?:reason|outcome)="([^"]+)"\} ([0-9.e+-]+)$')
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, Counter] = defaultdict(Counter)
+
+    async def call(self, client: httpx.AsyncClient, op: str, method: str, url: str, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.errors[op][type(e).__name__] += 1
+            raise
+        self.latencies[op].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[op][str(response.status_code)] += 1
+        return response
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        ops = {}
+        for op in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(op, []))
+            ops[op] = {
+                "count": len(values),
+                "errors": dict(self.errors.get(op, {})),
+                "rps": len(values) / elapsed if elapsed else None,
+                **{f"p{p}_ms": (v * 1000 if (v := percentile(values, p)) is not None else None) for p in (50, 95, 99)},
+            }
+        total = sum(len(v) for v in self.latencies.values())
+        return {"elapsed_sec": elapsed, "requests": total, "rps": total / elapsed if elapsed else None, "ops": ops}
+
+
+async def signup_verified(client: httpx.AsyncClient, rec: Recorder, sink: SMTPSink, email: str) -> str:
+    await rec.call(client, "signup", "POST", "/auth/signup", json={"name": "Bench User", "email": email, "password": PASSWORD})
+    code = await sink.wait_for_code(email)
+    await rec.call(client, "verify_email", "POST", "/auth/verify-email", json={"email": email, "code": code})
+    r = await rec.call(client, "login", "POST", "/auth/login", json={"email": email, "password": PASSWORD})
+    r.raise_for_status()
+    return r.json()["token"]
+
+
+async def journey(client: httpx.AsyncClient, rec: Recorder, sink: SMTPSink, email: str, loops: int) -> None:
+    token = await signup_verified(client, rec, sink, email)
+    headers = {"Authorization": f"Bearer {token}"}
+    await rec.call(client, "onboarding", "PUT", "/protected/onboarding", json=ONBOARDING, headers=headers)
+    for _ in range(loops):
+        r = await rec.call(client, "quests_load", "GET", "/protected/quests/load", headers=headers)
+        active = r.json().get("active") or [] if r.status_code == 200 else []
+        if not active:
+            await asyncio.sleep(0.2)  # the fill is running in the background
+            continue
+        await rec.call(client, "quests_complete", "POST", "/protected/quests/complete",
+                       json={"quest_id": active[0]["quest_id"]}, headers=headers)
+
+
+async def run_limited(concurrency: int, jobs) -> None:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(job):
+        async with sem:
+            try:
+                await job
+            except Exception as e:  # recorded by Recorder where it matters; keep the run going
+                print(f"job failed: {type(e).__name__}: {e}", file=sys.stderr)
+
+    await asyncio.gather(*(one(job) for job in jobs))
+
+
+async def scrape_metrics(client: httpx.AsyncClient) -> Dict[str, Dict[str, Dict[str, float]]]:
+    r = await client.get(os.environ.get("METRICS_PATH", "/metrics"))
+    mongo: Dict[str, Dict[str, float]] = defaultdict(dict)
+    llm: Dict[str, Dict[str, float]] = defaultdict(dict)
+    if r.status_code != 200:
+        return {"mongo": mongo, "llm": llm}
+    for line in r.text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            kind, method, route, value = match.groups()
+            mongo[f"{method} {route}"][kind] = float(value)
+            continue
+        match = LLM_COUNTER_LINE.match(line)
+        if match:
+            name, label, value = match.groups()
+            llm[name.replace("_total", "")][label] = float(value)
+    return {"mongo": mongo, "llm": llm}
+
+
+def counter_deltas(before, after) -> Dict[str, Dict[str, float]]:
+    return {
+        name: {label: value - before.get(name, {}).get(label, 0) for label, value in labels.items()}
+        for name, labels in after.items()
+    }
+
+
+def mongo_commands_per_request(before, after) -> Dict[str, float]:
+    out = {}
+    for route, now in after.items():
+        prev = before.get(route, {})
+        count = now.get("count", 0) - prev.get("count", 0)
+        if count > 0:
+            out[route] = round((now.get("sum", 0) - prev.get("sum", 0)) / count, 2)
+    return out
+
+
+def start_app(args, port: int, openai_url: str, sink: SMTPSink, db_name: str) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "MONGO_URI": args.mongo_uri,
+        "DB_NAME": db_name,
+        "OPENAI_BASE_URL": openai_url,
+        "API_TOKEN": "benchmark",
+        "SMTP_HOST": sink.host,
+        "SMTP_PORT": str(sink.port),
+        "SMTP_STARTTLS": "False",
+        "METRICS_ENABLED": "True",
+        "RATE_LIMIT_ENABLED": str(args.rate_limit),
+        "BCRYPT_ROUNDS": str(args.bcrypt_rounds),
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        env=env,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, proc: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app exited with code {proc.returncode}")
+        try:
+            if (await client.get("/")).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("app did not start")
+
+
+async def run(args) -> Dict[str, Any]:
+    run_id = uuid4().hex[:8]
+    db_name = f"bench_{run_id}"
+    sink = SMTPSink(port=free_port()).start()
+    openai_port, app_port = free_port(), free_port()
+    openai_app = fake_openai_app(args.llm_latency_ms, args.llm_jitter_ms, args.llm_failure_rate, args.llm_fence_rate)
+    openai_server, openai_task = await serve_fake_openai(openai_app, "127.0.0.1", openai_port)
+    proc = start_app(args, app_port, f"http://127.0.0.1:{openai_port}/v1", sink, db_name)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{app_port}", timeout=60, limits=limits) as client:
+            await wait_ready(client, proc)
+            rec = Recorder()
+            emails = [f"bench-{run_id}-{i}@example.com" for i in range(args.users)]
+
+            if args.scenario == "login_storm":
+                setup = Recorder()
+                await run_limited(args.concurrency, [signup_verified(client, setup, sink, e) for e in emails])
+                jobs = [
+                    rec.call(client, "login", "POST", "/auth/login",
+                             json={"email": emails[i % len(emails)], "password": PASSWORD})
+                    for i in range(args.logins)
+                ]
+            else:
+                jobs = [journey(client, rec, sink, e, args.loops) for e in emails]
+
+            before = await scrape_metrics(client)
+            started = time.perf_counter()
+            await run_limited(args.concurrency, jobs)
+            elapsed = time.perf_counter() - started
+            after = await scrape_metrics(client)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        openai_server.should_exit = True
+        await openai_task
+        sink.stop()
+        if not args.keep_db:
+            from pymongo import MongoClient
+            MongoClient(args.mongo_uri).drop_database(db_name)
+
+    return {
+        "scenario": args.scenario,
+        "run_at": datetime.now(timezone.utc).isoformat(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "out", "mongo_uri")},
+        **rec.summary(elapsed),
+        "mongo_commands_per_request": mongo_commands_per_request(before["mongo"], after["mongo"]),
+        "llm": {
+            "calls": openai_app.state.calls,
+            "injected_failures": openai_app.state.failures,
+            **counter_deltas(before["llm"], after["llm"]),
+        },
+        "emails_received": sink.messages,
+    }
+
+
+def compare(base_path: str, new_path: str, threshold: float) -> int:
+    """Print per-op deltas; returns 1 if any op regressed by more than `threshold`."""
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    regressed = False
+    print(f"{'op':<18}{'metric':<8}{'base':>12}{'new':>12}{'change':>10}")
+    for op in sorted(set(base["ops"]) | set(new["ops"])):
+        b, n = base["ops"].get(op, {}), new["ops"].get(op, {})
+        for metric, higher_is_worse in (("p50_ms", True), ("p95_ms", True), ("p99_ms", True), ("rps", False)):
+            old, cur = b.get(metric), n.get(metric)
+            if not old or cur is None:
+                continue
+            change = (cur - old) / old
+            worse = change > threshold if higher_is_worse else change < -threshold
+            regressed |= worse and metric in ("p95_ms", "rps")
+            flag = "  REGRESSION" if worse else ""
+            print(f"{op:<18}{metric:<8}{old:>12.1f}{cur:>12.1f}{change:>+10.1%}{flag}")
+    for label, result in (("base", base), ("new", new)):
+        llm = result.get("llm") or {}
+        if llm.get("calls"):
+            retries = sum((llm.get("llm_retries") or {}).values())
+            print(f"{label}: {llm['calls']} model calls, retry rate {retries / llm['calls']:.1%}")
+    for route, cur in sorted(new.get("mongo_commands_per_request", {}).items()):
+        old = base.get("mongo_commands_per_request", {}).get(route)
+        if old is not None and cur != old:
+            print(f"mongo commands/request {route}: {old} -> {cur}")
+    return 1 if regressed else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load_test")
+    parser.add_argument("--scenario", choices=["journey", "login_storm"], default="journey")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--loops", type=int, default=5, help="quest load/complete rounds per user (journey)")
+    parser.add_argument("--logins", type=int, default=500, help="login requests (login_storm)")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--mongo-uri", default=os.environ.get("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-jitter-ms", type=float, default=100)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--llm-fence-rate", type=float, default=0.0, help="share of replies wrapped in a code fence and prose")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--rate-limit", action="store_true", help="keep auth rate limiting on")
+    parser.add_argument("--keep-db", action="store_true")
+    parser.add_argument("--out", help="write the JSON result here as well as to stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two result files and exit")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative p95/rps change counted as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare, args.threshold)
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
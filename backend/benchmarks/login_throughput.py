@@ -0,0 +1,75 @@
+"""Login (bcrypt verify) throughput on the hashing pool at several pool sizes.
+
+Fires `--concurrency` simultaneous verifies through app.hashing.run_hashing,
+the same path authenticate_credentials uses, and reports verifies/second and
+how many requests were shed with 503 once HASH_QUEUE_MAX was reached.
+
+    cd backend && python -m benchmarks.login_throughput --sizes 1 2 4 8 --logins 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from fastapi import HTTPException
+
+from app import hashing
+
+
+async def storm(logins: int, concurrency: int, hashed: str) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    shed = 0
+    latencies = []
+
+    async def one():
+        nonlocal shed
+        async with sem:
+            started = time.perf_counter()
+            try:
+                await hashing.run_hashing(hashing.bcrypt_verify, "correct horse battery", hashed)
+            except HTTPException:
+                shed += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    # Warm the pool so worker start-up isn't counted.
+    await asyncio.gather(*(
+        hashing.run_hashing(hashing.bcrypt_verify, "warm-up", hashed) for _ in range(hashing.pool_size())
+    ))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "logins_per_sec": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+        "shed": shed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=hashing.settings.BCRYPT_ROUNDS)
+    parser.add_argument("--executor", choices=["process", "thread"], default="process")
+    args = parser.parse_args()
+
+    hashed = hashing.bcrypt_hash("correct horse battery", args.rounds)
+    results = []
+    for size in args.sizes:
+        hashing.settings.HASH_POOL_SIZE = size
+        hashing.settings.HASH_EXECUTOR = args.executor
+        hashing.shutdown_executor()
+        result = asyncio.run(storm(args.logins, args.concurrency, hashed))
+        results.append({"pool_size": size, "executor": args.executor, "rounds": args.rounds, **result})
+    hashing.shutdown_executor()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Per-request Mongo command counts: per-call index creation vs one-time bootstrap.
+
+Replays the collection-accessor pattern of `complete_quest` (four
+`users_col()` calls, one command each) against a real MongoDB and counts the
+commands the driver actually sends.
+
+    cd backend && MONGO_URI=mongodb://localhost:27017 DB_NAME=bench \\
+        python -m benchmarks.mongo_command_counts --requests 200
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+from pymongo import monitoring
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.counts = Counter()
+
+    def started(self, event):
+        self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        self.counts.clear()
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+counter = CommandCounter()
+monitoring.register(counter)
+
+from app import db  # noqa: E402  (listener must be registered before the client exists)
+
+
+async def legacy_users_col():
+    col = db._db["users"]
+    for index in db.INDEX_SPECS["users"]:
+        doc = dict(index.document)
+        keys = list(doc.pop("key").items())
+        await col.create_index(keys, **doc)
+    return col
+
+
+async def cached_users_col():
+    return db.users_col()
+
+
+async def simulate_complete_quest(accessor, user_id):
+    await (await accessor()).find_one({"_id": user_id}, {"progress": 1})
+    await (await accessor()).update_one({"_id": user_id}, {"$inc": {"progress.xp_total": 0}})
+    await (await accessor()).find_one({"_id": user_id}, {"progress": 1})
+    await (await accessor()).update_one({"_id": user_id}, {"$set": {"progress.level": 1}})
+
+
+async def run(name, accessor, user_id, requests):
+    counter.reset()
+    started = time.perf_counter()
+    for _ in range(requests):
+        await simulate_complete_quest(accessor, user_id)
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": name,
+        "requests": requests,
+        "commands_per_request": counter.total / requests,
+        "by_command": {k: v / requests for k, v in sorted(counter.counts.items())},
+        "ms_per_request": elapsed * 1000 / requests,
+    }
+
+
+async def main(requests):
+    await db.ensure_indexes()
+    inserted = await db.users_col().insert_one({"email": f"bench-{time.time_ns()}@example.com"})
+    user_id = inserted.inserted_id
+    try:
+        results = [
+            await run("before", legacy_users_col, user_id, requests),
+            await run("after", cached_users_col, user_id, requests),
+        ]
+    finally:
+        await db.users_col().delete_one({"_id": user_id})
+        await db.close_client()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    asyncio.run(main(parser.parse_args().requests))
@@ -0,0 +1,189 @@
+"""Local stand-ins for the API's external services, used by benchmarks.load_test.
+
+* `fake_openai_app`: an OpenAI-compatible `POST /v1/responses` that returns
+  the number of quests asked for in the prompt (wrapped in `{"quests": ...}`
+  when a json_schema format is requested), after a configurable latency, and
+  fails a configurable fraction of calls (HTTP 500 or unparseable output).
+  `fence_rate` wraps valid replies in a code fence and prose.
+* `SMTPSink`: an aiosmtpd server that keeps the verification code from each
+  message's subject, so a driver can complete signup without a real inbox.
+
+    cd backend && python -m benchmarks.standins --openai-port 8090 --smtp-port 8025
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from typing import Dict, Optional
+from uuid import uuid4
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+QUESTS_REQUESTED = re.compile(r"Quests requested:\s*(\d+)")
+CODE_IN_SUBJECT = re.compile(r"(\d{6})")
+
+
+def fake_quest(i: int) -> dict:
+    target = random.choice([10, 20, 30, 5000])
+    return {
+        "title": f"Benchmark quest {i}: {target} reps",
+        "type": "counter",
+        "target": target,
+        "rewards": {"xp": random.choice([100, 250, 400]), "coins": random.choice([5, 10, 20])},
+    }
+
+
+def usage(body: dict, text: str, cache_keys: set) -> dict:
+    """Rough token counts (4 chars each); the instructions count as cached after the first call per cache key."""
+    instructions = len(str(body.get("instructions") or "")) // 4
+    prompt = instructions + len(str(body.get("input", ""))) // 4
+    key = body.get("prompt_cache_key")
+    cached = instructions if key and key in cache_keys else 0
+    if key:
+        cache_keys.add(key)
+    return {
+        "input_tokens": prompt,
+        "input_tokens_details": {"cached_tokens": cached},
+        "output_tokens": len(text) // 4,
+        "output_tokens_details": {"reasoning_tokens": 0},
+        "total_tokens": prompt + len(text) // 4,
+    }
+
+
+def fake_openai_app(
+    latency_ms: float = 300, jitter_ms: float = 100, failure_rate: float = 0.0, fence_rate: float = 0.0
+) -> FastAPI:
+    app = FastAPI()
+    app.state.calls = 0
+    app.state.failures = 0
+    app.state.cache_keys = set()
+
+    @app.post("/v1/responses")
+    async def responses(request: Request):
+        body = await request.json()
+        app.state.calls += 1
+        await asyncio.sleep(max(0.0, random.gauss(latency_ms, jitter_ms)) / 1000)
+
+        if random.random() < failure_rate:
+            app.state.failures += 1
+            if random.random() < 0.5:
+                return JSONResponse({"error": {"message": "injected failure", "type": "server_error"}}, status_code=500)
+            text = "Sorry, I can't help with that."
+        else:
+            match = QUESTS_REQUESTED.search(str(body.get("input", "")))
+            count = int(match.group(1)) if match else 1
+            quests = [fake_quest(i) for i in range(count)]
+            structured = ((body.get("text") or {}).get("format") or {}).get("type") == "json_schema"
+            text = json.dumps({"quests": quests} if structured else quests)
+            if random.random() < fence_rate:
+                text = f"Here are your quests:\n```json\n{text}\n```\nHave fun!"
+
+        return {
+            "id": f"resp_{uuid4().hex}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model", "fake"),
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": f"msg_{uuid4().hex}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "usage": usage(body, text, app.state.cache_keys),
+            "parallel_tool_calls": False,
+            "tool_choice": "auto",
+            "tools": [],
+        }
+
+    return app
+
+
+class SMTPSink:
+    """Accepts every message; remembers the latest verification code per recipient."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8025):
+        from aiosmtpd.controller import Controller  # benchmark-only dependency
+
+        self.host, self.port = host, port
+        self.codes: Dict[str, str] = {}
+        self.messages = 0
+        self._cond = threading.Condition()
+        self._controller = Controller(self, hostname=host, port=port)
+
+    async def handle_DATA(self, server, session, envelope):
+        subject = ""
+        for line in envelope.content.decode("utf-8", "replace").splitlines():
+            if line.lower().startswith("subject:"):
+                subject = line.split(":", 1)[1]
+                break
+        match = CODE_IN_SUBJECT.search(subject)
+        with self._cond:
+            self.messages += 1
+            if match:
+                for rcpt in envelope.rcpt_tos:
+                    self.codes[rcpt.lower()] = match.group(1)
+            self._cond.notify_all()
+        return "250 Message accepted for delivery"
+
+    def start(self) -> "SMTPSink":
+        self._controller.start()
+        return self
+
+    def stop(self) -> None:
+        self._controller.stop()
+
+    def pop_code(self, email: str) -> Optional[str]:
+        with self._cond:
+            return self.codes.pop(email.lower(), None)
+
+    async def wait_for_code(self, email: str, timeout: float = 30.0) -> str:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            code = self.pop_code(email)
+            if code:
+                return code
+            await asyncio.sleep(0.05)
+        raise TimeoutError(f"no verification email for {email} within {timeout}s")
+
+
+async def serve_fake_openai(app: FastAPI, host: str, port: int):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="off"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the fake OpenAI server and SMTP sink standalone.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--openai-port", type=int, default=8090)
+    parser.add_argument("--smtp-port", type=int, default=8025)
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-jitter-ms", type=float, default=100)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--llm-fence-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.smtp_port).start()
+    app = fake_openai_app(args.llm_latency_ms, args.llm_jitter_ms, args.llm_failure_rate, args.llm_fence_rate)
+    print(f"OPENAI_BASE_URL=http://{args.host}:{args.openai_port}/v1 SMTP_HOST={args.host} SMTP_PORT={args.smtp_port}")
+    try:
+        import uvicorn
+        uvicorn.run(app, host=args.host, port=args.openai_port, log_level="warning")
+    finally:
+        sink.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Bytes Mongo returns per endpoint for a user with a large document.
+
+Seeds users whose documents carry a big legacy `quests.completed` history,
+calls the auth and profile endpoints in-process (httpx ASGITransport) and
+sums the reply sizes of the commands each request sends, per collection.
+Exits 1 if any endpoint reads more than `--max-bytes` from `users`, i.e. if a
+path has gone back to fetching the whole document. Needs a real MongoDB:
+
+    cd backend && MONGO_URI=mongodb://localhost:27017 DB_NAME=bench \\
+        python -m benchmarks.user_read_bytes --history 2000 --max-bytes 4096
+"""
+import argparse
+import asyncio
+import json
+import sys
+from collections import Counter
+from datetime import timedelta
+from uuid import uuid4
+
+import bson
+from pymongo import monitoring
+
+
+class ReplyBytes(monitoring.CommandListener):
+    def __init__(self):
+        self.by_collection = Counter()
+        self.commands = Counter()
+        self._pending = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        self._pending[event.request_id] = target if isinstance(target, str) else event.command_name
+
+    def succeeded(self, event):
+        collection = self._pending.pop(event.request_id, event.command_name)
+        self.by_collection[collection] += len(bson.encode(event.reply))
+        self.commands[collection] += 1
+
+    def failed(self, event):
+        self._pending.pop(event.request_id, None)
+
+    def reset(self):
+        self.by_collection.clear()
+        self.commands.clear()
+
+
+meter = ReplyBytes()
+monitoring.register(meter)
+
+import httpx  # noqa: E402
+from app import db  # noqa: E402  (listener must be registered before the client exists)
+from app.ai.ai import ACTIVE_QUEST_TARGET  # noqa: E402
+from app.auth import hash_code, hash_password  # noqa: E402
+from app.main import app  # noqa: E402
+
+PASSWORD = "benchmark-password"
+CODE = "123456"
+
+
+def fat_user(email: str, history: int, verified: bool) -> dict:
+    now = db.utcnow()
+    quest = lambda i: {  # noqa: E731
+        "quest_id": str(uuid4()), "title": f"Benchmark quest {i}", "type": "counter",
+        "target": 10, "progress": 0, "rewards": {"xp": 50, "coins": 5},
+        "created_at": now, "started_at": now, "completed_at": now,
+    }
+    return {
+        "name": "Bench User",
+        "email": email,
+        "password_hash": hash_password(PASSWORD),
+        "verified": verified,
+        "auth": {"provider": "password", "last_login_at": None, "mfa": {"enabled": False}},
+        "onboarding": {
+            "height_in": 70.0, "weight_lb": 170.0, "primary_goal": "build strength", "experience": "intermediate",
+            "equipment": "full_gym", "preferred_days_per_week": 4, "age": 30,
+        },
+        "progress": {"level": 3, "xp_total": 2500, "xp_to_next_level": 500, "quests_completed_count": history},
+        "wallet": {"coins_balance": 250},
+        "streak": {"current": 0, "best": 0, "last_checkin_date": None},
+        "quests": {
+            "active": [quest(i) for i in range(ACTIVE_QUEST_TARGET)],
+            "recent": [quest(i) for i in range(50)],
+            "completed": [quest(i) for i in range(history)],
+        },
+        "token": None,
+        "token_expiry": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+async def measure(client: httpx.AsyncClient, name: str, method: str, url: str, **kwargs) -> dict:
+    meter.reset()
+    response = await client.request(method, url, **kwargs)
+    return {
+        "endpoint": name,
+        "status": response.status_code,
+        "reply_bytes": dict(meter.by_collection),
+        "commands": dict(meter.commands),
+    }
+
+
+async def main(history: int, max_bytes: int) -> int:
+    await db.ensure_indexes()
+    run = uuid4().hex[:8]
+    emails = {k: f"bench-{run}-{k}@example.com" for k in ("login", "verify", "resend")}
+    docs = {
+        "login": fat_user(emails["login"], history, verified=True),
+        "verify": fat_user(emails["verify"], history, verified=False),
+        "resend": fat_user(emails["resend"], history, verified=False),
+    }
+    ids = {k: (await db.users_col().insert_one(doc)).inserted_id for k, doc in docs.items()}
+    now = db.utcnow()
+    await db.email_verifications_col().insert_one({
+        "_id": ids["verify"], "user_id": ids["verify"], "email": emails["verify"], "code_hash": hash_code(CODE),
+        "created_at": now, "last_sent_at": now, "expires_at": now + timedelta(minutes=10), "attempts": 0,
+    })
+    full_document_bytes = len(bson.encode(docs["login"]))
+
+    results = []
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            login = await measure(client, "POST /auth/login", "POST", "/auth/login",
+                                  json={"email": emails["login"], "password": PASSWORD})
+            results.append(login)
+            token = (await db.users_col().find_one({"_id": ids["login"]}, {"token": 1}))["token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            results.append(await measure(client, "POST /auth/verify-email", "POST", "/auth/verify-email",
+                                         json={"email": emails["verify"], "code": CODE}))
+            results.append(await measure(client, "POST /auth/resend-verification", "POST",
+                                         "/auth/resend-verification", json={"email": emails["resend"]}))
+            for path in ("/protected/progress", "/protected/wallet", "/protected/quests/load"):
+                results.append(await measure(client, f"GET {path}", "GET", path, headers=headers))
+    finally:
+        await db.users_col().delete_many({"_id": {"$in": list(ids.values())}})
+        await db.email_verifications_col().delete_many({"user_id": {"$in": list(ids.values())}})
+        await db.email_outbox_col().delete_many({"to": emails["resend"]})
+        await db.close_client()
+
+    failures = [r["endpoint"] for r in results if r["reply_bytes"].get("users", 0) > max_bytes]
+    print(json.dumps({
+        "history": history,
+        "full_document_bytes": full_document_bytes,
+        "max_users_bytes": max_bytes,
+        "endpoints": results,
+        "over_budget": failures,
+    }, indent=2))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=int, default=2000, help="legacy quests.completed entries per user")
+    parser.add_argument("--max-bytes", type=int, default=4096, help="budget for users replies per request")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.history, args.max_bytes)))